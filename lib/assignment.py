@@ -0,0 +1,210 @@
+import logging
+
+import numpy as np
+
+from lib.subset_sum import find_subsets
+
+logger = logging.getLogger(__name__)
+
+_MAX_STARS = 100  # sets of nodes per center among which the heaviest is chosen
+
+
+def connected_components(left: np.ndarray, right: np.ndarray, num_left: int, num_right: int) -> np.ndarray:
+    """Compute the connected components of a bipartite graph by propagating the smallest node label along the edges.
+
+    Args:
+        left: The left node of each edge.
+        right: The right node of each edge.
+        num_left: The number of left nodes.
+        num_right: The number of right nodes.
+
+    Returns:
+        The component label of each edge.
+    """
+    labels = np.arange(num_left + num_right)
+    right = right + num_left
+    while True:
+        edge_labels = np.minimum(labels[left], labels[right])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, left, edge_labels)
+        np.minimum.at(new_labels, right, edge_labels)
+        new_labels = new_labels[new_labels]  # pointer jumping shortens long paths
+        if np.array_equal(new_labels, labels):
+            return labels[left]
+        labels = new_labels
+
+
+def hungarian(weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Find the one-to-one assignment of rows to columns with the maximum total weight.
+
+    Args:
+        weights: The dense weight matrix, zero for pairs that must not be assigned.
+
+    Returns:
+        The row indices and column indices of the assigned pairs with positive weight.
+    """
+    transposed = weights.shape[0] > weights.shape[1]
+    cost = -(weights.T if transposed else weights)
+    n, m = cost.shape
+    # potentials and matching with 1-based indices, column 0 is a virtual column
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    match_col = np.zeros(m + 1, dtype=np.int64)  # row matched to each column
+    way = np.zeros(m + 1, dtype=np.int64)
+    for row in range(1, n + 1):
+        match_col[0] = row
+        col0 = 0
+        min_v = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[col0] = True
+            row0 = match_col[col0]
+            free = ~used[1:]
+            reduced = cost[row0 - 1] - u[row0] - v[1:]
+            improve = free & (reduced < min_v[1:])
+            min_v[1:][improve] = reduced[improve]
+            way[1:][improve] = col0
+            candidates = np.where(free, min_v[1:], np.inf)
+            col1 = int(np.argmin(candidates)) + 1
+            delta = candidates[col1 - 1]
+            u[match_col[used]] += delta
+            v[used] -= delta
+            min_v[1:][free] -= delta
+            col0 = col1
+            if match_col[col0] == 0:
+                break
+        while col0 != 0:
+            col1 = way[col0]
+            match_col[col0] = match_col[col1]
+            col0 = col1
+
+    cols = np.flatnonzero(match_col[1:]) + 1
+    rows = match_col[cols] - 1
+    cols = cols - 1
+    if transposed:
+        rows, cols = cols, rows
+    keep = weights[rows, cols] > 0
+    return rows[keep], cols[keep]
+
+
+def _star_candidates(
+        center_edges: dict[int, list[int]],
+        neighbors: np.ndarray,
+        neighbor_amounts: np.ndarray,
+        center_amounts: np.ndarray,
+        tolerances: np.ndarray,
+        weights: np.ndarray,
+        max_nodes: int
+) -> list[tuple[float, list[int]]]:
+    # for each center with several edges, the heaviest set of edges whose neighbors add up to the center's amount,
+    # the amounts are integers that are negative if unknown
+    stars = []
+    for center, edges in center_edges.items():
+        if len(edges) < 2 or center_amounts[center] < 0:
+            continue
+        edges = np.asarray(edges)
+        amounts = neighbor_amounts[neighbors[edges]]
+        low, high = center_amounts[center] - tolerances[center], center_amounts[center] + tolerances[center]
+        if amounts[amounts > 0].sum() < low:
+            continue
+        result = find_subsets(amounts, low, high, min_size=2, max_size=len(edges), max_nodes=max_nodes,
+                              max_subsets=_MAX_STARS)
+        if len(result.subsets) > 0:
+            best = max(result.subsets, key=lambda subset: weights[edges[list(subset)]].sum())
+            stars.append((float(weights[edges[list(best)]].sum()), edges[list(best)].tolist()))
+    return stars
+
+
+def solve_assignment(
+        left: np.ndarray,
+        right: np.ndarray,
+        scores: np.ndarray,
+        left_amounts: np.ndarray,
+        right_amounts: np.ndarray,
+        tolerances: np.ndarray,
+        *,
+        threshold: float = 0.5,
+        max_component_size: int = 200,
+        max_nodes: int = 10_000
+) -> np.ndarray:
+    """Select a consistent set of matching pairs from sparse pairwise scores.
+
+    Only pairs with a score above the threshold can be selected. Each connected component of these pairs is solved on
+    its own: first, one left node with several right nodes (or one right node with several left nodes) is selected if
+    their amounts add up to the node's amount within the tolerance, heaviest first and without sharing nodes. The
+    remaining nodes are then matched one-to-one with the Hungarian algorithm, or greedily by score in components with
+    more than max_component_size nodes.
+
+    Args:
+        left: The left node of each pair, e.g., the invoice row index.
+        right: The right node of each pair, e.g., the payment row index.
+        scores: The score of each pair, e.g., the probability of "Yes" or the share of "Yes" votes.
+        left_amounts: The amount of each left node in cents, NaN if unknown.
+        right_amounts: The amount of each right node in cents, NaN if unknown.
+        tolerances: The tolerance in cents for sums at each right node, which also applies to the left nodes that
+            are connected to it.
+        threshold: The score above which a pair can be selected.
+        max_component_size: The maximum number of nodes of a component that is solved with the Hungarian algorithm.
+        max_nodes: The search budget for the sets of nodes whose amounts add up.
+
+    Returns:
+        A boolean array that is True for the selected pairs.
+    """
+    selected = np.zeros(len(scores), dtype=bool)
+    candidates = np.flatnonzero(scores > threshold)
+    if len(candidates) == 0:
+        return selected
+    weights = np.zeros(len(scores))
+    weights[candidates] = scores[candidates] - threshold
+
+    left_codes = np.unique(left[candidates], return_inverse=True)[1]
+    right_codes = np.unique(right[candidates], return_inverse=True)[1]
+    labels = connected_components(left_codes, right_codes, left_codes.max() + 1, right_codes.max() + 1)
+
+    left_amounts = np.nan_to_num(left_amounts, nan=-1).round().astype(np.int64)
+    right_amounts = np.nan_to_num(right_amounts, nan=-1).round().astype(np.int64)
+    tolerances = np.ceil(tolerances).astype(np.int64)
+    left_tolerances = np.zeros(int(left.max()) + 1, dtype=np.int64)
+    np.maximum.at(left_tolerances, left[candidates], tolerances[right[candidates]])
+
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    for component in np.split(candidates[order], boundaries):
+        if len(component) == 1:
+            selected[component] = True
+            continue
+
+        by_left, by_right = {}, {}
+        for edge in component:
+            by_left.setdefault(int(left[edge]), []).append(edge)
+            by_right.setdefault(int(right[edge]), []).append(edge)
+
+        stars = _star_candidates(by_right, left, left_amounts, right_amounts, tolerances, weights, max_nodes)
+        stars += _star_candidates(by_left, right, right_amounts, left_amounts, left_tolerances, weights, max_nodes)
+        used_left, used_right = set(), set()
+        for _, edges in sorted(stars, key=lambda star: -star[0]):
+            if any(left[e] in used_left or right[e] in used_right for e in edges):
+                continue
+            selected[edges] = True
+            used_left.update(int(left[e]) for e in edges)
+            used_right.update(int(right[e]) for e in edges)
+
+        remaining = [e for e in component if left[e] not in used_left and right[e] not in used_right]
+        if len(remaining) == 0:
+            continue
+        remaining = np.asarray(remaining)
+        rows, row_ix = np.unique(left[remaining], return_inverse=True)
+        cols, col_ix = np.unique(right[remaining], return_inverse=True)
+        if len(rows) + len(cols) <= max_component_size:
+            matrix = np.zeros((len(rows), len(cols)))
+            edge_matrix = np.zeros((len(rows), len(cols)), dtype=np.int64)
+            matrix[row_ix, col_ix] = weights[remaining]
+            edge_matrix[row_ix, col_ix] = remaining
+            assigned_rows, assigned_cols = hungarian(matrix)
+            selected[edge_matrix[assigned_rows, assigned_cols]] = True
+        else:
+            for edge in remaining[np.argsort(-weights[remaining], kind="stable")]:
+                if left[edge] not in used_left and right[edge] not in used_right:
+                    selected[edge] = True
+                    used_left.add(int(left[edge]))
+                    used_right.add(int(right[edge]))
+    return selected
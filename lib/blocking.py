@@ -0,0 +1,123 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def encode_keys(*columns: pd.Series) -> list[np.ndarray]:
+    """Encode the values of several columns as integer codes that are comparable across the columns.
+
+    Missing values get the code -1 and never match.
+
+    Args:
+        *columns: The columns, e.g., a column of the left table and a column of the right table.
+
+    Returns:
+        An int64 array of codes for each column.
+    """
+    codes, _ = pd.factorize(pd.concat(columns, ignore_index=True))
+    codes = codes.astype(np.int64)
+    splits = np.cumsum([len(column.index) for column in columns])[:-1]
+    return np.split(codes, splits)
+
+
+def range_join(
+        left_keys: np.ndarray,
+        left_values: np.ndarray,
+        right_keys: np.ndarray,
+        right_lows: np.ndarray,
+        right_highs: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Join the rows whose keys are equal and whose left value is within the right row's closed value range.
+
+    The join sorts the left rows by key and value and looks up the range of each right row with a binary search, so
+    it never materializes the cross product. Rows with negative keys never match.
+
+    Args:
+        left_keys: The integer keys of the left rows.
+        left_values: The integer values of the left rows.
+        right_keys: The integer keys of the right rows.
+        right_lows: The lower bounds of the right rows' value ranges.
+        right_highs: The upper bounds of the right rows' value ranges.
+
+    Returns:
+        The left row indices and the right row indices of the joined pairs.
+    """
+    left_keep = np.flatnonzero(left_keys >= 0)
+    right_keep = np.flatnonzero((right_keys >= 0) & (right_lows <= right_highs))
+    if len(left_keep) == 0 or len(right_keep) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # combine key and value into a single sortable integer
+    offset = min(left_values[left_keep].min(), right_lows[right_keep].min())
+    stride = max(left_values[left_keep].max(), right_highs[right_keep].max()) - offset + 1
+    num_keys = max(left_keys.max(), right_keys.max()) + 1
+    if num_keys * stride >= 2 ** 62:
+        raise AssertionError(f"Cannot combine {num_keys} keys with a value range of {stride}!")
+    left_combined = left_keys[left_keep] * stride + (left_values[left_keep] - offset)
+    order = np.argsort(left_combined, kind="stable")
+    left_sorted = left_combined[order]
+
+    right_base = right_keys[right_keep] * stride - offset
+    starts = np.searchsorted(left_sorted, right_base + right_lows[right_keep], side="left")
+    ends = np.searchsorted(left_sorted, right_base + right_highs[right_keep], side="right")
+
+    counts = ends - starts
+    right_ix = np.repeat(right_keep, counts)
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    left_ix = left_keep[order[positions]]
+    return left_ix, right_ix
+
+
+def union_pairs(pairs: list[tuple[np.ndarray, np.ndarray]], num_right: int) -> tuple[np.ndarray, np.ndarray]:
+    """Union several sets of pairs without duplicates.
+
+    Args:
+        pairs: The left row indices and the right row indices of each set of pairs.
+        num_right: The number of right rows.
+
+    Returns:
+        The left row indices and the right row indices of the union, sorted by left and then right row index.
+    """
+    if len(pairs) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    codes = np.unique(np.concatenate([left_ix.astype(np.int64) * num_right + right_ix for left_ix, right_ix in pairs]))
+    return codes // num_right, codes % num_right
+
+
+def pair_completeness(
+        candidates: tuple[np.ndarray, np.ndarray],
+        true_pairs: tuple[np.ndarray, np.ndarray],
+        num_right: int
+) -> np.ndarray:
+    """Determine which of the true pairs are in the candidate set.
+
+    Args:
+        candidates: The left row indices and the right row indices of the candidate pairs.
+        true_pairs: The left row indices and the right row indices of the true pairs.
+        num_right: The number of right rows.
+
+    Returns:
+        A boolean array that is True for the true pairs that are candidates.
+    """
+    candidate_codes = candidates[0].astype(np.int64) * num_right + candidates[1]
+    true_codes = true_pairs[0].astype(np.int64) * num_right + true_pairs[1]
+    return np.isin(true_codes, candidate_codes)
+
+
+def reduction_ratio(num_candidates: int, num_left: int, num_right: int) -> float:
+    """Share of all possible pairs that the blocking excludes.
+
+    Args:
+        num_candidates: The number of candidate pairs.
+        num_left: The number of left rows.
+        num_right: The number of right rows.
+
+    Returns:
+        The reduction ratio.
+    """
+    if num_left * num_right == 0:
+        return 1.0
+    return 1 - num_candidates / (num_left * num_right)
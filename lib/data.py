@@ -1,8 +1,15 @@
+import io
 import json
 import logging
 import os
 import pathlib
+import re
 import shutil
+from typing import Any, Iterable, Iterator
+
+import attrs
+import numpy as np
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
@@ -127,6 +134,21 @@ def get_results_dir(task_name: str, dataset_name: str, exp_name: str, clear: boo
     return _prepare_directory(exp_name, "results", task_name, dataset_name, clear)
 
 
+def get_blocking_dir(task_name: str, dataset_name: str, exp_name: str, clear: bool = False) -> pathlib.Path:
+    """Directory in which to place the **candidate pairs** of the blocking stage.
+
+    Args:
+        task_name: The name of the task.
+        dataset_name: The name of the dataset.
+        exp_name: The name of the current experiment.
+        clear: Whether to clear the directory.
+
+    Returns:
+        A pathlib.Path to the directory.
+    """
+    return _prepare_directory(exp_name, "blocking", task_name, dataset_name, clear)
+
+
 def load_json(path: pathlib.Path) -> dict | list | str | int | None:
     """Load the JSON object from the given file path.
 
@@ -143,12 +165,32 @@ def load_json(path: pathlib.Path) -> dict | list | str | int | None:
 def dump_json(obj: dict | list | str | int | None, path: pathlib.Path) -> None:
     """Dump the given JSON object to the given file path.
 
+    An existing file is replaced instead of overwritten, so that files shared through hard links stay unchanged.
+
     Args:
         obj: The JSON object.
         path: The pathlib.Path to the JSON file.
     """
-    with open(path, "w", encoding="utf-8") as file:
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
         json.dump(obj, file)
+    os.replace(tmp_path, path)
+
+
+def sort_names(names: Iterable[str]) -> list[str]:
+    """Sort the names numerically by their stems if all stems are integers, e.g., "2.json" before "10.json".
+
+    Args:
+        names: The names, e.g., of instances or of the JSON files of requests and responses.
+
+    Returns:
+        The names in the numerical order of their stems, or in text order if a stem is not an integer.
+    """
+    names = list(names)
+    stems = [name.split(".", 1)[0] for name in names]
+    if all(stem.isdigit() for stem in stems):
+        return [name for _, name in sorted(zip([int(stem) for stem in stems], names))]
+    return sorted(names)
 
 
 def load_str(path: pathlib.Path) -> str:
@@ -173,3 +215,438 @@ def dump_str(s: str, path: pathlib.Path) -> None:
     """
     with open(path, "w", encoding="utf-8") as file:
         file.write(s)
+
+
+@attrs.define
+class StoreTable:
+    """Table whose rows the instances of an instance store reference by ID."""
+    rows: pd.DataFrame  # the table without its ID column, the rows are saved as written by pd.DataFrame.to_csv
+    key: str  # the instance column that contains the row IDs, e.g., "invoice_id"
+    row_index: dict[int, np.ndarray] | None = None  # row positions by ID, None if every ID references all rows
+    shared: bool = False  # whether every ID references all rows unless only the rows joined to it are requested
+
+
+def _column_kind(values: list) -> str:
+    if all(isinstance(value, (bool, np.bool_)) for value in values):
+        return "bool"
+    elif all(isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_)) for value in values):
+        return "int"
+    elif all(isinstance(value, str) for value in values):
+        return "category"
+    raise AssertionError(f"Unsupported values in instance store column: {values[:5]}!")
+
+
+def _encode_column(values: list) -> tuple[np.ndarray, dict]:
+    kind = _column_kind(values)
+    if kind == "bool":
+        return np.asarray(values, dtype=bool), {"kind": kind}
+    elif kind == "int":
+        return np.asarray(values, dtype=np.int64), {"kind": kind}
+    else:
+        codes, categories = pd.factorize(pd.Series(values, dtype=object))
+        return codes.astype(np.int32), {"kind": kind, "categories": categories.tolist()}
+
+
+def _csv_lines(table: pd.DataFrame) -> tuple[str, list[str]]:
+    header = table.iloc[:0].to_csv(index=False)
+    lines = table.to_csv(index=False, header=False).splitlines(keepends=True)
+    if len(lines) != len(table.index):  # quoted values with line breaks span multiple lines
+        lines = [table.iloc[[ix]].to_csv(index=False, header=False) for ix in range(len(table.index))]
+    return header, lines
+
+
+def dump_instance_store(instances: list[dict], tables: dict[str, StoreTable], path: pathlib.Path) -> None:
+    """Save the instances and the tables of their rows as a columnar instance store.
+
+    Each key of the instances becomes a typed column: booleans, integers, strings (as category codes), or lists of
+    them (as flattened values and offsets). Instances without a key have a missing value in its column. The rows of
+    each table are saved once, and the instances reference them by the IDs in the table's key column. This includes
+    shared tables like reference tables, whose rows every instance references as a whole.
+
+    Args:
+        instances: The instances, e.g., the ground truths of the pairs.
+        tables: The tables by name, in the order in which the rows of an instance are shown.
+        path: The pathlib.Path to the directory of the instance store.
+    """
+    (path / "columns").mkdir(parents=True, exist_ok=True)
+    (path / "tables").mkdir(parents=True, exist_ok=True)
+
+    columns = {}
+    names = list(dict.fromkeys(name for instance in instances for name in instance.keys()))
+    for name in names:
+        missing = np.asarray([instance.get(name) is None for instance in instances], dtype=bool)
+        values = [instance[name] for instance in instances if instance.get(name) is not None]
+        if all(isinstance(value, list) for value in values):
+            offsets = np.cumsum([0] + [len(value) for value in values], dtype=np.int64)
+            elements, meta = _encode_column([element for value in values for element in value])
+            np.save(path / "columns" / f"{name}_offsets.npy", offsets)
+            meta = {**meta, "list": True}
+        else:
+            elements, meta = _encode_column(values)
+            meta = {**meta, "list": False}
+        np.save(path / "columns" / f"{name}.npy", elements)
+        np.save(path / "columns" / f"{name}_missing.npy", missing)
+        columns[name] = meta
+
+    for name, table in tables.items():
+        header, lines = _csv_lines(table.rows)
+        encoded = [header.encode("utf-8")] + [line.encode("utf-8") for line in lines]
+        with open(path / "tables" / f"{name}.csv", "wb") as file:
+            file.write(b"".join(encoded))
+        np.save(path / "tables" / f"{name}_offsets.npy", np.cumsum([len(line) for line in encoded], dtype=np.int64))
+        if table.row_index is not None:
+            ids = np.asarray(sorted(table.row_index.keys()), dtype=np.int64)
+            positions = [np.asarray(table.row_index[row_id], dtype=np.int64) for row_id in ids.tolist()]
+            np.savez(path / "tables" / f"{name}_index.npz", ids=ids,
+                     offsets=np.cumsum([0] + [len(p) for p in positions], dtype=np.int64),
+                     positions=np.concatenate(positions) if len(positions) > 0 else np.empty(0, dtype=np.int64))
+
+    dump_json({
+        "num_instances": len(instances),
+        "columns": columns,
+        "tables": {name: {"key": table.key, "indexed": table.row_index is not None, "shared": table.shared}
+                   for name, table in tables.items()}
+    }, path / "store.json")
+
+
+@attrs.define
+class InstanceStore:
+    """Columnar instance store saved by dump_instance_store, whose arrays are memory-mapped.
+
+    The instances are numbered from 0 and named by their number, like the former per-instance directories.
+    """
+    path: pathlib.Path
+    num_instances: int
+    _columns: dict[str, dict]
+    _tables: dict[str, dict]
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "InstanceStore":
+        """Load the instance store from the given directory.
+
+        Args:
+            path: The pathlib.Path to the directory of the instance store.
+
+        Returns:
+            The instance store.
+        """
+        if not (path / "store.json").is_file():
+            raise AssertionError(f"Missing instance store in {path}, run the preprocessing first!")
+        meta = load_json(path / "store.json")
+        columns = {}
+        for name, column in meta["columns"].items():
+            columns[name] = {
+                **column,
+                "values": np.load(path / "columns" / f"{name}.npy", mmap_mode="r"),
+                "missing": np.load(path / "columns" / f"{name}_missing.npy", mmap_mode="r"),
+                "offsets": np.load(path / "columns" / f"{name}_offsets.npy", mmap_mode="r") if column["list"] else None
+            }
+            # values are stored only for the instances that have them
+            columns[name]["positions"] = np.cumsum(~columns[name]["missing"]) - 1
+        tables = {}
+        for name, table in meta["tables"].items():
+            tables[name] = {
+                **table,
+                "data": np.memmap(path / "tables" / f"{name}.csv", dtype=np.uint8, mode="r"),
+                "offsets": np.load(path / "tables" / f"{name}_offsets.npy", mmap_mode="r"),
+            }
+            if table["indexed"]:
+                with np.load(path / "tables" / f"{name}_index.npz") as index:
+                    tables[name].update(ids=index["ids"], index_offsets=index["offsets"], positions=index["positions"])
+        return cls(path, meta["num_instances"], columns, tables)
+
+    def __len__(self) -> int:
+        return self.num_instances
+
+    @property
+    def column_names(self) -> list[str]:
+        """The names of the instance columns."""
+        return list(self._columns.keys())
+
+    @property
+    def table_names(self) -> list[str]:
+        """The names of the tables in the order in which the rows of an instance are shown."""
+        return list(self._tables.keys())
+
+    def table_key(self, table: str) -> str:
+        """The instance column that contains the row IDs of the table."""
+        return self._tables[table]["key"]
+
+    def names(self) -> list[str]:
+        """The instance names in numerical order.
+
+        The later stages process the instances in this order, which determines their sampling of examples.
+        """
+        return [str(ix) for ix in range(self.num_instances)]
+
+    def _decode(self, column: dict, values: np.ndarray) -> list:
+        if column["kind"] == "category":
+            return [column["categories"][code] for code in values.tolist()]
+        return values.tolist()
+
+    def value(self, name: str, ix: int) -> Any:
+        """Get the value of the instance column for the instance, None if missing."""
+        column = self._columns[name]
+        if column["missing"][ix]:
+            return None
+        position = column["positions"][ix]
+        if column["list"]:
+            return self._decode(column, column["values"][column["offsets"][position]:column["offsets"][position + 1]])
+        return self._decode(column, column["values"][position:position + 1])[0]
+
+    def column(self, name: str) -> np.ndarray:
+        """Get the values of a column without lists for all instances, e.g., for vectorized filters.
+
+        Returns:
+            A bool or int64 array, or an object array of strings for categories, with None for missing values.
+        """
+        column = self._columns[name]
+        if column["list"]:
+            raise AssertionError(f"Instance store column `{name}` contains lists!")
+        if not column["missing"].any():
+            values = np.asarray(column["values"])
+            return np.asarray(column["categories"], dtype=object)[values] if column["kind"] == "category" else values
+        result = np.full(self.num_instances, None, dtype=object)
+        result[~column["missing"]] = self._decode(column, np.asarray(column["values"]))
+        return result
+
+    def instance(self, ix: int) -> dict:
+        """Get the instance with the given number without its missing values (random access)."""
+        return {name: value for name in self._columns.keys() if (value := self.value(name, ix)) is not None}
+
+    def __iter__(self) -> Iterator[dict]:
+        """Stream the instances in the order of their numbers."""
+        for ix in range(self.num_instances):
+            yield self.instance(ix)
+
+    def is_shared(self, table: str) -> bool:
+        """Whether every ID references all rows of the table, unless only the joined rows are requested."""
+        return self._tables[table]["shared"]
+
+    def row_positions(self, table: str, row_id: int, joined_only: bool = False) -> np.ndarray:
+        """Get the positions of the table's rows with the given ID.
+
+        Args:
+            table: The name of the table.
+            row_id: The ID of the rows, e.g., an invoice ID.
+            joined_only: Whether to get only the rows of a shared table that are joined to the ID.
+
+        Returns:
+            The row positions, all rows if the table is not indexed or is shared and not only joined rows are requested.
+        """
+        table = self._tables[table]
+        if not table["indexed"] or (table["shared"] and not joined_only):
+            return np.arange(len(table["offsets"]) - 1)
+        ix = np.searchsorted(table["ids"], row_id)
+        if ix == len(table["ids"]) or table["ids"][ix] != row_id:
+            return np.empty(0, dtype=np.int64)
+        return table["positions"][table["index_offsets"][ix]:table["index_offsets"][ix + 1]]
+
+    def rows(self, table: str, row_id: int, joined_only: bool = False, **read_csv_kwargs) -> pd.DataFrame:
+        """Load the table's rows with the given ID exactly as if they were saved in their own CSV file.
+
+        Args:
+            table: The name of the table.
+            row_id: The ID of the rows, e.g., an invoice ID.
+            joined_only: Whether to load only the rows of a shared table that are joined to the ID.
+            **read_csv_kwargs: Keyword arguments for pd.read_csv, e.g., dtype=str.
+
+        Returns:
+            The rows as a table.
+        """
+        positions = self.row_positions(table, row_id, joined_only)
+        table = self._tables[table]
+        data, offsets = table["data"], table["offsets"]
+        chunks = [data[:offsets[0]].tobytes()] + [data[offsets[ix]:offsets[ix + 1]].tobytes() for ix in positions]
+        return pd.read_csv(io.BytesIO(b"".join(chunks)), **read_csv_kwargs)
+
+    def first_rows_as_strings(self, table: str, row_ids: list[int], joined_only: bool = False) -> pd.DataFrame:
+        """Load the first of the table's rows of many IDs at once, with all values as strings.
+
+        The rows are the same as rows(table, row_id, joined_only, dtype=str, nrows=1) for each ID, but the table is
+        read only once.
+
+        Args:
+            table: The name of the table.
+            row_ids: The IDs of the rows, e.g., the invoice IDs of the instances.
+            joined_only: Whether to load only the rows of a shared table that are joined to the IDs.
+
+        Returns:
+            The rows with their IDs as index, without the IDs that reference no rows.
+        """
+        row_ids = sorted(set(row_ids))
+        positions = [self.row_positions(table, row_id, joined_only)[:1] for row_id in row_ids]
+        data, offsets = self._tables[table]["data"], self._tables[table]["offsets"]
+        chunks = [data[:offsets[0]].tobytes()] + [data[offsets[ix]:offsets[ix + 1]].tobytes()
+                                                  for row_positions in positions for ix in row_positions]
+        rows = pd.read_csv(io.BytesIO(b"".join(chunks)), dtype=str)
+        rows.index = [row_id for row_id, row_positions in zip(row_ids, positions) if len(row_positions) == 1]
+        return rows
+
+    def single_rows(self, table: str, row_ids: list[int], joined_only: bool = False) -> pd.DataFrame:
+        """Load the rows of many IDs at once, for the IDs that reference a single row of the table.
+
+        pd.read_csv infers the types of a column from all rows that it reads, so that, e.g., "1972953315" stays a
+        string next to "INV10000" but becomes a number on its own. Such values are converted to the type that rows()
+        would load, and rows with values whose type on their own is unclear are left out.
+
+        Args:
+            table: The name of the table.
+            row_ids: The IDs of the rows, e.g., the invoice IDs of the instances.
+            joined_only: Whether to load only the rows of a shared table that are joined to the IDs.
+
+        Returns:
+            The rows with their IDs as index.
+        """
+        row_ids = sorted(set(row_ids))
+        positions = [self.row_positions(table, row_id, joined_only) for row_id in row_ids]
+        row_ids = [row_id for row_id, row_positions in zip(row_ids, positions) if len(row_positions) == 1]
+        data, offsets = self._tables[table]["data"], self._tables[table]["offsets"]
+        chunks = [data[:offsets[0]].tobytes()] + [data[offsets[ix]:offsets[ix + 1]].tobytes()
+                                                  for row_positions in positions if len(row_positions) == 1
+                                                  for ix in row_positions]
+        rows = pd.read_csv(io.BytesIO(b"".join(chunks)))
+        rows.index = row_ids
+
+        is_clear = np.ones(len(rows.index), dtype=bool)
+        for column in rows.columns:
+            if rows[column].dtype != object:
+                continue
+            values = rows[column]
+            is_other_type = values.notna() & (pd.to_numeric(values, errors="coerce").notna()
+                                              | values.str.lower().isin(["true", "false"]))
+            if is_other_type.any():
+                converted = values[is_other_type].map(_value_on_its_own).astype(object)
+                is_clear &= ~values.index.isin(converted.index[converted.isna()])
+                rows[column] = values.astype(object).where(~is_other_type, converted)
+        return rows[is_clear]
+
+
+_INT_PATTERN = re.compile(r"-?[0-9]+")
+_FLOAT_PATTERN = re.compile(r"-?[0-9]+\.[0-9]+([eE][+-]?[0-9]+)?")
+
+
+def _value_on_its_own(value: str) -> int | float | bool | None:
+    # the value that pd.read_csv infers for the string if it is the only one in its column, None if that is unclear
+    if _INT_PATTERN.fullmatch(value) and abs(int(value)) < 2 ** 63:
+        return int(value)
+    if _FLOAT_PATTERN.fullmatch(value):
+        return float(value)
+    if value in ("True", "TRUE", "true", "False", "FALSE", "false"):
+        return value.lower() == "true"
+    return None
+
+
+SEGMENT_INDEX_FILE = "segments.npz"
+
+
+def _segment_name(segment: int) -> str:
+    return f"segment_{segment:05d}.jsonl"
+
+
+def _dump_bytes_atomically(data: bytes, path: pathlib.Path) -> None:
+    # readers see either the former file or the complete new one, never a partially written file
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def dump_records(records: dict[str, Any], path: pathlib.Path, records_per_segment: int | None = None) -> None:
+    """Save the named JSON records, e.g., the responses by request name, in the given directory.
+
+    Without records_per_segment, each record is saved as a JSON file with its name as the file name. Otherwise, the
+    records are saved in the order of sort_names as JSON lines in segments of records_per_segment records, and
+    an offset index maps each name to the position of its line. Each segment and the index are written atomically, the
+    index last, so that an interrupted run never leaves an index that references incomplete segments.
+
+    Args:
+        records: The JSON records by name, e.g., "12.json".
+        path: The pathlib.Path to the directory.
+        records_per_segment: The number of records per segment, None to save one JSON file per record.
+    """
+    if records_per_segment is None:
+        for name, record in records.items():
+            dump_json(record, path / name)
+        return
+
+    names = sort_names(records.keys())
+    segments = np.arange(len(names), dtype=np.int64) // records_per_segment
+    offsets, lengths = np.zeros(len(names), dtype=np.int64), np.zeros(len(names), dtype=np.int64)
+    for segment, start in enumerate(range(0, len(names), records_per_segment)):
+        lines = [(json.dumps(records[name]) + "\n").encode("utf-8")
+                 for name in names[start:start + records_per_segment]]
+        line_lengths = np.asarray([len(line) for line in lines], dtype=np.int64)
+        lengths[start:start + len(lines)] = line_lengths
+        offsets[start:start + len(lines)] = np.cumsum(line_lengths) - line_lengths  # within the segment
+        _dump_bytes_atomically(b"".join(lines), path / _segment_name(segment))
+
+    buffer = io.BytesIO()
+    np.savez(buffer, names=np.asarray(names, dtype=str), segments=segments, offsets=offsets, lengths=lengths)
+    _dump_bytes_atomically(buffer.getvalue(), path / SEGMENT_INDEX_FILE)
+
+
+@attrs.define
+class RecordStore:
+    """Named JSON records saved by dump_records, either as JSON files or as segments of JSON lines.
+
+    The segments are memory-mapped, so that a record is read without reading the other records of its segment.
+    """
+    path: pathlib.Path
+    _index: dict[str, np.ndarray] | None  # the sorted names, segments, offsets, and lengths of the records in segments
+    _segments: dict[int, np.memmap] = attrs.field(factory=dict)
+    _positions: dict[str, int] | None = None  # the position of each name in the index
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "RecordStore":
+        """Load the records from the given directory.
+
+        Args:
+            path: The pathlib.Path to the directory.
+
+        Returns:
+            The record store, which reads the segments if the directory has an offset index and else the JSON files.
+        """
+        if not (path / SEGMENT_INDEX_FILE).is_file():
+            return cls(path, None)
+        with np.load(path / SEGMENT_INDEX_FILE) as index:
+            return cls(path, {name: index[name] for name in ("names", "segments", "offsets", "lengths")})
+
+    def names(self) -> list[str]:
+        """The names of the records in the order of sort_names."""
+        if self._index is None:
+            return sort_names(p.name for p in self.path.glob("*.json"))
+        return self._index["names"].tolist()
+
+    def __len__(self) -> int:
+        return len(self.names())
+
+    def _position(self, name: str) -> int | None:
+        if self._positions is None:
+            self._positions = {name: ix for ix, name in enumerate(self._index["names"].tolist())}
+        return self._positions.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        if self._index is None:
+            return (self.path / name).is_file()
+        return self._position(name) is not None
+
+    def get(self, name: str) -> Any:
+        """Get the record with the given name (random access)."""
+        if self._index is None:
+            return load_json(self.path / name)
+        ix = self._position(name)
+        if ix is None:
+            raise AssertionError(f"Missing record {name} in {self.path}!")
+        segment = int(self._index["segments"][ix])
+        if segment not in self._segments:
+            self._segments[segment] = np.memmap(self.path / _segment_name(segment), dtype=np.uint8, mode="r")
+        offset, length = int(self._index["offsets"][ix]), int(self._index["lengths"][ix])
+        return json.loads(self._segments[segment][offset:offset + length].tobytes().decode("utf-8"))
+
+    def __iter__(self) -> Iterator[tuple[str, Any]]:
+        """Stream the names and records in the order of sort_names."""
+        for name in self.names():
+            yield name, self.get(name)
@@ -148,3 +148,36 @@ class ConfusionMatrixBy:
             res[value] += confusion
 
         return res
+
+
+def precision_recall_curve(scores: list[float], ground_truths: list[bool]) -> list[dict[str, float]]:
+    """Compute precision, recall, and F1 score for every threshold at which the predictions change.
+
+    An instance is predicted to be positive if its score is at least the threshold.
+
+    Args:
+        scores: The score of each instance, e.g., the probability of "Yes".
+        ground_truths: The ground truth value of each instance.
+
+    Returns:
+        The threshold, precision, recall, and F1 score for each distinct score, in order of decreasing threshold.
+    """
+    num_positives = sum(ground_truths)
+    confusion = ConfusionMatrix(0, 0, len(ground_truths) - num_positives, num_positives)
+    ranked = sorted(zip(scores, ground_truths), key=lambda x: x[0], reverse=True)
+    curve = []
+    for ix, (score, ground_truth) in enumerate(ranked):
+        if ground_truth:
+            confusion.TP += 1
+            confusion.FN -= 1
+        else:
+            confusion.FP += 1
+            confusion.TN -= 1
+        if ix + 1 == len(ranked) or ranked[ix + 1][0] != score:
+            curve.append({
+                "threshold": score,
+                "precision": confusion.precision,
+                "recall": confusion.recall,
+                "f1_score": confusion.f1_score
+            })
+    return curve
@@ -2,13 +2,19 @@
 # OpenAI API helpers version: 2024-10-16
 #
 # use the following methods:
-# openai_model(...)        ==> get model info
-# openai_execute(...)      ==> execute API requests
-# openai_cost_for_cache()  ==> compute total cost of all cached responses
+# openai_model(...)            ==> get model info
+# openai_num_input_tokens(...) ==> count the input tokens of an API request
+# openai_max_cost(...)         ==> compute the maximum cost of an API request
+# openai_execute(...)          ==> execute API requests
+# openai_cost(...)             ==> compute the cost of an API response
+# openai_cost_for_cache()      ==> compute total cost of all cached responses
 #
 # You must store your OpenAI API key in an environment variable, for example using:
 # export OPENAI_API_KEY="<your-key>"
 #
+# To send the requests to another OpenAI-compatible server (e.g., lib/model/openai_mock.py), set its base URL:
+# export OPENAI_BASE_URL="http://127.0.0.1:8000/v1"
+#
 # To call openai_execute(...) from multiple processes, you must use a global context:
 # with multiprocessing.Manager() as manager:
 #     context = manager.dict()
@@ -17,6 +23,7 @@
 #     responses = openai_execute(requests, global_context=context, global_semaphore=semaphore)
 ########################################################################################################################
 
+import collections.abc
 import dataclasses
 import functools
 import hashlib
@@ -25,7 +32,7 @@ import logging
 import os
 import threading
 import time
-from typing import Literal, Any
+from typing import Literal, Any, Callable
 
 import requests
 import tiktoken
@@ -36,6 +43,7 @@ from lib.data import get_data_path
 logger = logging.getLogger(__name__)
 
 CACHE_PATH = get_data_path() / "openai_cache"
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
 
 MODEL_PARAMETERS = {  # see https://platform.openai.com/docs/models and https://openai.com/pricing
     # GPT-3.5 Turbo
@@ -84,6 +92,34 @@ def openai_model(
     return _get_model_params(model)
 
 
+def openai_num_input_tokens(
+        request: dict
+) -> int:
+    """Count the input tokens of the request as they are counted for the rate limits.
+
+    Args:
+        request: The API request.
+
+    Returns:
+        The number of input tokens.
+    """
+    return _Request(request).num_input_tokens()
+
+
+def openai_max_cost(
+        request: dict
+) -> float:
+    """Compute the dollar cost of the request if it uses all of its output tokens.
+
+    Args:
+        request: The API request.
+
+    Returns:
+        The maximum dollar cost of the request.
+    """
+    return _Request(request).max_cost()
+
+
 def openai_execute(
         requests: list[dict],
         *,
@@ -91,12 +127,14 @@ def openai_execute(
         silent: bool = False,
         global_context: dict | None = None,
         global_semaphore: "multiprocessing.Semaphore | None" = None
-) -> list[dict]:
+) -> collections.abc.Sequence[dict]:
     """Execute a list of requests against the OpenAI API.
 
     This method also computes the maximum cost incurred by the requests, caches requests and responses, and waits
     between requests to abide the API limits.
 
+    Successful responses are not kept in memory, but loaded from the cache when accessing the returned sequence.
+
     Args:
         requests: A list of API requests.
         force: An optional float specifying the cost below or equal to which no confirmation should be required.
@@ -105,7 +143,7 @@ def openai_execute(
         global_semaphore: Optional global semaphore for use with multiprocessing.
 
     Returns:
-        A list of API responses.
+        A sequence of API responses.
     """
     global _local_context, _local_semaphore
 
@@ -142,11 +180,11 @@ def openai_execute(
         progress_bar.set_description("load responses")
         progress_bar.reset(total=len(pairs))
         for pair in pairs:
-            pair.response = pair.request.load_cached_response()
-            if pair.response is None:
-                pairs_to_execute.append(pair)
-            else:
+            if pair.request.is_cached():
+                pair.status = "done"
                 progress_bar.cached += 1
+            else:
+                pairs_to_execute.append(pair)
             progress_bar.update()
 
         # in case some pairs were not cached, execute them
@@ -169,6 +207,7 @@ def openai_execute(
             pairs_to_execute = pairs_to_execute[-1:] + pairs_to_execute[:-1]
 
             # execute requests
+            threads = []
             progress_bar.set_description("execute requests")
             progress_bar.reset(total=len(pairs))
             progress_bar.update(progress_bar.cached)
@@ -203,30 +242,38 @@ def openai_execute(
                                         )
 
                                         http_response = pair.request.execute()
-                                        pair.response = _Response(http_response.json())
-
-                                        context[pair.request.model] = context[pair.request.model].set_from_headers(
-                                            http_response.headers
-                                        )
-
-                                        context["num_running"] = context["num_running"] - 1
-                                        progress_bar.running = context["num_running"]
-                                        progress_bar.cost += pair.response.total_cost()
-
-                                        match http_response.status_code:
-                                            case 200:
-                                                context[pair.request.model] = context[pair.request.model].to_parallel()
-                                                pair.status = "done"
-                                                progress_bar.update()
-                                                break
-                                            case 429:
-                                                pair.status = "open"
-                                                progress_bar.update_postfix()  # not done -> update only postfix
-                                            case _:
-                                                pair.status = "done"
-                                                progress_bar.failed += 1
-                                                progress_bar.update()
-                                                break
+                                        if http_response is None:  # connection error -> retry like rate limit error
+                                            context["num_running"] = context["num_running"] - 1
+                                            progress_bar.running = context["num_running"]
+                                            pair.status = "open"
+                                            progress_bar.update_postfix()  # not done -> update only postfix
+                                        else:
+                                            pair.response = _Response(http_response.json())
+
+                                            context[pair.request.model] = context[pair.request.model].set_from_headers(
+                                                http_response.headers
+                                            )
+
+                                            context["num_running"] = context["num_running"] - 1
+                                            progress_bar.running = context["num_running"]
+                                            progress_bar.cost += pair.response.total_cost()
+
+                                            match http_response.status_code:
+                                                case 200:
+                                                    context[pair.request.model] = \
+                                                        context[pair.request.model].to_parallel()
+                                                    pair.response = None  # load from cache when accessed
+                                                    pair.status = "done"
+                                                    progress_bar.update()
+                                                    break
+                                                case 429:
+                                                    pair.status = "open"
+                                                    progress_bar.update_postfix()  # not done -> update only postfix
+                                                case _:
+                                                    pair.status = "done"
+                                                    progress_bar.failed += 1
+                                                    progress_bar.update()
+                                                    break
                                     case "parallel" if context["num_running"] < 200:  # max. num. of parallel requests
                                         logger.debug(f"parallel execution for `{pair.request.model}`: execute")
                                         progress_bar.bottleneck = "P"
@@ -243,6 +290,15 @@ def openai_execute(
                                         def execute(p: _Pair, pb: _ProgressBar, c: dict,
                                                     s: threading.Semaphore) -> None:
                                             http_response = p.request.execute()
+                                            if http_response is None:  # connection error -> retry like rate limit error
+                                                with s:
+                                                    c["num_running"] = c["num_running"] - 1
+                                                    pb.running = c["num_running"]
+                                                    p.status = "open"
+                                                    c[p.request.model] = c[p.request.model].to_sequential()
+                                                    pb.update_postfix()  # not done -> update only postfix
+                                                return
+
                                             p.response = _Response(http_response.json())
 
                                             with s:
@@ -260,6 +316,7 @@ def openai_execute(
                                                             p.request,
                                                             p.response
                                                         )
+                                                        p.response = None  # load from cache when accessed
                                                         p.status = "done"
                                                         pb.update()
                                                     case 429:
@@ -275,11 +332,14 @@ def openai_execute(
                                                         pb.failed += 1
                                                         pb.update()
 
-                                        pair.thread = threading.Thread(
+                                        thread = threading.Thread(
                                             target=execute,
                                             args=(pair, progress_bar, context, semaphore)
                                         )
-                                        pair.thread.start()
+                                        thread.start()
+                                        threads.append(thread)
+                                        if len(threads) > 1_000:  # do not keep finished threads around
+                                            threads = [t for t in threads if t.is_alive()]
                                         break
                                     case _:
                                         progress_bar.bottleneck = "T"
@@ -296,11 +356,24 @@ def openai_execute(
                 progress_bar.update_postfix()
                 time.sleep(1)  # sleep to wait for stragglers and failures
 
-            for pair in pairs_to_execute:
-                if pair.thread is not None:
-                    pair.thread.join()
+            for thread in threads:
+                thread.join()
+
+    return _ResponseSequence(pairs)
+
+
+def openai_cost(
+        response: dict
+) -> float:
+    """Compute the dollar cost incurred by the response.
+
+    Args:
+        response: The API response.
 
-    return [pair.response.response for pair in pairs]
+    Returns:
+        The dollar cost of the response, which is zero for failed requests.
+    """
+    return _Response(response).total_cost()
 
 
 def openai_cost_for_cache() -> float:
@@ -342,45 +415,63 @@ def _get_encoding_cached(model: str) -> tiktoken.Encoding:
     return tiktoken.encoding_for_model(model)
 
 
+def _cached_method(method: Callable) -> Callable:
+    # like functools.cache, but stores the results in the instance so that they are freed together with it
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = method(self)
+            return value
+
+    return wrapper
+
+
 class _Request:
+    __slots__ = ("request", "_cache")
     request: dict
 
     def __init__(self, request: dict) -> None:
         self.request = request
+        self._cache = {}
 
-    @functools.cached_property
+    @property
     def model(self) -> str:
         if "model" not in self.request.keys():
             raise AttributeError("Missing field `model` in request!")
         return self.request["model"]
 
-    @functools.cached_property
+    @property
     def messages(self) -> list[dict]:
         if "messages" not in self.request.keys():
             raise AttributeError("Missing field `messages` in request, which is required for this model!")
         return self.request["messages"]
 
-    @functools.cached_property
+    @property
     def prompt(self) -> str:
         if "prompt" not in self.request.keys():
             raise AttributeError("Missing field `prompt` in request, which is required for this model!")
         return self.request["prompt"]
 
-    @functools.cache
+    @_cached_method
     def is_chat_or_completion(self) -> str:  # use `model` to determine if request is for chat or completion
         return _get_model_params(self.model)["chat_or_completion"]
 
-    @functools.cache
+    @_cached_method
     def url(self) -> str:
+        base_url = os.environ.get("OPENAI_BASE_URL", DEFAULT_BASE_URL).rstrip("/")
         match self.is_chat_or_completion():
             case "chat":
-                return "https://api.openai.com/v1/chat/completions"
+                return f"{base_url}/chat/completions"
             case "completion":
-                return "https://api.openai.com/v1/completions"
+                return f"{base_url}/completions"
             case _:
                 raise AssertionError(f"Invalid parameter `chat_or_completion` for model `{self.model}`!")
 
-    @functools.cache
+    @_cached_method
     def num_input_tokens(self) -> int:
         encoding = _get_encoding_cached(self.model)
 
@@ -393,7 +484,7 @@ class _Request:
             case _:
                 raise AssertionError(f"Invalid parameter `chat_or_completion` for model `{self.model}`!")
 
-    @functools.cache
+    @_cached_method
     def max_num_output_tokens(self) -> int:
         if "max_completion_tokens" in self.request.keys() and self.request["max_completion_tokens"] is not None:
             return self.request["max_completion_tokens"]
@@ -407,11 +498,11 @@ class _Request:
             else:
                 return left_for_output
 
-    @functools.cache
+    @_cached_method
     def max_total_tokens(self) -> int:
         return self.num_input_tokens() + self.max_num_output_tokens()
 
-    @functools.cache
+    @_cached_method
     def max_input_usage(self) -> int:
         if "best_of" in self.request.keys():
             n = self.request["best_of"]
@@ -421,7 +512,7 @@ class _Request:
             n = 1
         return n * self.num_input_tokens()
 
-    @functools.cache
+    @_cached_method
     def max_output_usage(self) -> int:
         if "best_of" in self.request.keys():
             n = self.request["best_of"]
@@ -431,18 +522,18 @@ class _Request:
             n = 1
         return n * self.max_num_output_tokens()
 
-    @functools.cache
+    @_cached_method
     def max_total_usage(self) -> int:
         return self.max_input_usage() + self.max_output_usage()
 
-    @functools.cache
+    @_cached_method
     def max_cost(self) -> float:
         model_params = _get_model_params(self.model)
         input_cost = self.max_input_usage() * (model_params["cost_per_1k_input_tokens"] / 1000)
         output_cost = self.max_output_usage() * (model_params["cost_per_1k_output_tokens"] / 1000)
         return input_cost + output_cost
 
-    @functools.cache
+    @_cached_method
     def hash(self) -> str:
         return hashlib.sha256(bytes(json.dumps(self.request), "utf-8")).hexdigest()
 
@@ -476,23 +567,34 @@ class _Request:
         if "temperature" not in self.request.keys() or self.request["temperature"] != 0:
             logger.warning("request's `temperature` not set to 0, which is required for reproducibility")
 
-    def load_cached_response(self):  # -> "_Response" | None
+    def _load_cache_entry(self) -> dict | None:
+        # the cached pair, if the cached request equals the request
         path = CACHE_PATH / f"{self.hash()}.json"
         if path.is_file():
             with open(path, "r", encoding="utf-8") as file:
                 cached_pair = json.load(file)
-            cached_request = _Request(cached_pair["request"])
-            cached_response = _Response(cached_pair["response"])
-            if self.request == cached_request.request:
-                return cached_response
+            if self.request == cached_pair["request"]:
+                return cached_pair
         return None
 
-    def execute(self) -> requests.Response:
-        http_response = requests.post(
-            url=self.url(),
-            json=self.request,
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"}
-        )
+    def is_cached(self) -> bool:
+        # a cache entry for a different request with the same hash does not count, the request is executed again
+        return self._load_cache_entry() is not None
+
+    def load_cached_response(self):  # -> "_Response" | None
+        cached_pair = self._load_cache_entry()
+        return None if cached_pair is None else _Response(cached_pair["response"])
+
+    def execute(self) -> requests.Response | None:
+        try:
+            http_response = requests.post(
+                url=self.url(),
+                json=self.request,
+                headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"}
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logger.info(f"retry request due to connection error: {e}")
+            return None
 
         if http_response.status_code == 200:
             path = CACHE_PATH / f"{self.hash()}.json"
@@ -507,35 +609,37 @@ class _Request:
 
 
 class _Response:
+    __slots__ = ("response", "_cache")
     response: dict
 
     def __init__(self, response: dict) -> None:
         self.response = response
+        self._cache = {}
 
-    @functools.cache
+    @_cached_method
     def was_successful(self) -> bool:  # use entry `choices` to determine if request was successful
         return "choices" in self.response.keys()
 
-    @functools.cached_property
+    @property
     def model(self) -> str:
         if "model" not in self.response.keys():
             raise AttributeError("Missing field `model` in response, which is required for successful requests!")
         return self.response["model"]
 
-    @functools.cached_property
+    @property
     def usage(self) -> dict:
         if "usage" not in self.response.keys():
             raise AttributeError("Missing field `usage` in response, which is required for successful requests!")
         return self.response["usage"]
 
-    @functools.cache
+    @_cached_method
     def total_usage(self) -> int:
         if self.was_successful():
             return self.usage["total_tokens"]
         else:
             return 0
 
-    @functools.cache
+    @_cached_method
     def total_cost(self) -> float:
         if self.was_successful():
             model_params = _get_model_params(self.model)
@@ -549,12 +653,31 @@ class _Response:
             return 0
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class _Pair:
     request: _Request
-    response: _Response | None = None
+    response: _Response | None = None  # only failed responses are kept, successful ones are loaded from the cache
     status: Literal["open"] | Literal["waiting"] | Literal["running"] | Literal["done"] = "open"
-    thread: threading.Thread | None = None
+
+
+class _ResponseSequence(collections.abc.Sequence):
+
+    def __init__(self, pairs: list[_Pair]) -> None:
+        self._pairs = pairs
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        pair = self._pairs[index]
+        if pair.response is not None:  # failed response
+            return pair.response.response
+        response = pair.request.load_cached_response()  # not kept, so that memory does not grow with the accesses
+        if response is None:
+            raise AssertionError("Missing cached response for executed request!")
+        return response.response
 
 
 @dataclasses.dataclass
@@ -562,8 +685,8 @@ class _ModelBudgetState:
     mode: Literal["sequential"] | Literal["parallel"]
     rpm: int | None
     tpm: int | None
-    r: int | None
-    t: int | None
+    r: float | None
+    t: float | None
     last_update: float
 
     @classmethod
@@ -576,10 +699,11 @@ class _ModelBudgetState:
     def consider_time(self) -> "_ModelBudgetState":
         now = time.time()
         delta = now - self.last_update
+        # keep fractions, since truncating them on every call could prevent the budget from ever growing
         if self.rpm is not None and self.r is not None:
-            self.r = min(self.rpm, int(self.r + self.rpm * delta / 60))
+            self.r = min(self.rpm, self.r + self.rpm * delta / 60)
         if self.tpm is not None and self.t is not None:
-            self.t = min(self.tpm, int(self.t + self.tpm * delta / 60))
+            self.t = min(self.tpm, self.t + self.tpm * delta / 60)
         self.last_update = now
         return self
 
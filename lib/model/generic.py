@@ -1,12 +1,14 @@
 import logging
+from collections.abc import Sequence
 
 import tiktoken
 
-from lib.model._openai import openai_execute
+from lib.model._openai import openai_execute, openai_num_input_tokens, openai_max_cost, openai_cost
 
 logger = logging.getLogger(__name__)
 
 FORCE: float = 0.05
+REQUEST_SEED: int = 321164097  # seed of all executed requests, for reproducible responses
 
 
 def num_tokens(
@@ -31,10 +33,67 @@ def num_tokens(
         raise AssertionError(f"Unknown API name '{api_name}'!")
 
 
+def num_input_tokens(
+        request: dict,
+        api_name: str
+) -> int:
+    """Compute the number of input tokens of the API request.
+
+    Args:
+        request: The API request.
+        api_name: The name of the API to use.
+
+    Returns:
+        The number of input tokens.
+    """
+    if api_name == "openai":
+        return openai_num_input_tokens(request)
+    else:
+        raise AssertionError(f"Unknown API name '{api_name}'!")
+
+
+def max_request_cost(
+        request: dict,
+        api_name: str
+) -> float:
+    """Compute the dollar cost of the API request if it uses all of its output tokens.
+
+    Args:
+        request: The API request.
+        api_name: The name of the API to use.
+
+    Returns:
+        The maximum dollar cost.
+    """
+    if api_name == "openai":
+        return openai_max_cost(request)
+    else:
+        raise AssertionError(f"Unknown API name '{api_name}'!")
+
+
+def response_cost(
+        response: dict,
+        api_name: str
+) -> float:
+    """Compute the dollar cost incurred by the API response.
+
+    Args:
+        response: The API response.
+        api_name: The name of the API.
+
+    Returns:
+        The dollar cost, which is zero for failed requests.
+    """
+    if api_name == "openai":
+        return openai_cost(response)
+    else:
+        raise AssertionError(f"Unknown API name '{api_name}'!")
+
+
 def execute_requests(
         requests: list[dict],
         api_name: str
-) -> list[dict]:
+) -> Sequence[dict]:
     """Execute the list of requests against the specified API.
 
     Args:
@@ -42,7 +101,7 @@ def execute_requests(
         api_name: The name of the API.
 
     Returns:
-        The list of API responses.
+        The sequence of API responses, which may be loaded from disk on access.
     """
     if api_name == "openai":
         return openai_execute(requests, force=FORCE)
@@ -65,6 +124,50 @@ def extract_text_from_response(response: dict) -> str | None:
     return response["choices"][0]["message"]["content"]
 
 
+def extract_top_logprobs_from_response(response: dict) -> dict[str, float] | None:
+    """Extract the log probabilities of the most likely candidates for the first generated token.
+
+    Args:
+        response: The API response to a request with `logprobs` and `top_logprobs`.
+
+    Returns:
+        Mapping from candidate token to log probability or None if the API request failed or has no log probabilities.
+    """
+    if "choices" not in response.keys():
+        return None
+
+    logprobs = response["choices"][0].get("logprobs")
+    if logprobs is None or not logprobs.get("content"):
+        return None
+
+    return {candidate["token"]: candidate["logprob"] for candidate in logprobs["content"][0]["top_logprobs"]}
+
+
+def single_token_logit_bias(texts: list[str], model: str, api_name: str, bias: int = 100) -> dict[str, int]:
+    """Compute the logit_bias that restricts the generated tokens to the given texts, each of which must be one token.
+
+    Args:
+        texts: The allowed texts, e.g., ["Yes", "No"].
+        model: The model name.
+        api_name: The name of the API.
+        bias: The bias added to the logits of the allowed tokens.
+
+    Returns:
+        Mapping from token ID (as a string, like in the JSON request) to bias.
+    """
+    if api_name == "openai":
+        encoding = tiktoken.encoding_for_model(model)
+        logit_bias = {}
+        for text in texts:
+            tokens = encoding.encode(text)
+            if len(tokens) != 1:
+                raise AssertionError(f"'{text}' is not a single token for model '{model}'!")
+            logit_bias[str(tokens[0])] = bias
+        return logit_bias
+    else:
+        raise AssertionError(f"Unknown API name '{api_name}'!")
+
+
 def max_tokens_for_ground_truth(ground_truth: str, api_name: str, model: str,
                                 max_tokens_over_ground_truth: int | None) -> int | None:
     """Compute max_tokens based on the length of the ground truth and max_tokens_over_ground_truth.
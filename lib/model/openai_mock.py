@@ -0,0 +1,447 @@
+########################################################################################################################
+# Mock OpenAI-compatible API server
+#
+# use the following methods:
+# openai_mock_server(...)  ==> context manager that runs a local chat completions server
+# mock_requests(...)       ==> create synthetic entity matching requests
+#
+# The server emits `x-ratelimit-*` headers and 429 errors like the OpenAI API, waits according to a configurable
+# latency distribution, and answers deterministically. Point `openai_execute(...)` to it via the environment variable
+# `OPENAI_BASE_URL`, for example:
+# with openai_mock_server(rpm=500, tpm=200_000) as server:
+#     os.environ["OPENAI_BASE_URL"] = server.base_url
+#     responses = openai_execute(requests, force=float("inf"))
+########################################################################################################################
+
+import contextlib
+import hashlib
+import http.server
+import json
+import logging
+import math
+import random
+import re
+import string
+import threading
+import time
+from typing import Callable, Iterator, Literal
+
+import attrs
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z0-9]*\d[A-Za-z0-9]*")
+_PAIR_PATTERN = re.compile(r"(?:^|\n)Pair \d+: ")
+_CANDIDATE_PATTERN = re.compile(r"\nCandidate \d+: ")
+
+
+########################################################################################################################
+# API
+########################################################################################################################
+
+
+@attrs.define
+class MockLatency:
+    """Latency distribution of the mock server in seconds."""
+    distribution: Literal["constant"] | Literal["uniform"] | Literal["exponential"] | Literal["lognormal"] = "constant"
+    mean: float = 0.2
+    spread: float = 0.1  # half-width for uniform, sigma of the underlying normal for lognormal
+    per_output_token: float = 0.0
+
+    def sample(self, rng: random.Random, num_output_tokens: int) -> float:
+        """Sample the latency for a response.
+
+        Args:
+            rng: The random number generator.
+            num_output_tokens: The number of generated tokens.
+
+        Returns:
+            The latency in seconds.
+        """
+        match self.distribution:
+            case "constant":
+                latency = self.mean
+            case "uniform":
+                latency = rng.uniform(self.mean - self.spread, self.mean + self.spread)
+            case "exponential":
+                latency = rng.expovariate(1 / self.mean) if self.mean > 0 else 0
+            case "lognormal":  # parameterized such that the expected value is `mean`
+                latency = rng.lognormvariate(math.log(self.mean) - self.spread ** 2 / 2, self.spread)
+            case _:
+                raise AssertionError(f"Unknown latency distribution `{self.distribution}`!")
+        return max(0.0, latency) + self.per_output_token * num_output_tokens
+
+
+@attrs.define
+class MockServerStats:
+    """Statistics collected by the mock server."""
+    num_requests: int = 0
+    num_successful: int = 0
+    num_rate_limited: int = 0
+    num_failed: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    reserved_tokens: int = 0
+    first_request: float | None = None
+    last_response: float | None = None
+
+
+@attrs.define
+class MockServer:
+    """Handle of a running mock server."""
+    base_url: str
+    stats: MockServerStats
+    rpm: int
+    tpm: int
+
+
+def answer_yes_no(messages: list[dict]) -> str:
+    """Deterministically answer the yes/no entity matching question.
+
+    The answer is "Yes" if the first and second entry of the last message share an identifier of at least six
+    characters that contains a digit, and "No" otherwise. If the last message contains numbered pairs ("Pair 1: ...")
+    as in packed prompts, the answers for all pairs are returned as a JSON object. If it contains numbered candidates
+    ("Candidate 1: ...") as in listwise prompts, the numbers of the candidates that share such an identifier with the
+    entry are returned.
+
+    Args:
+        messages: The chat messages of the request.
+
+    Returns:
+        The answer "Yes" or "No", the JSON object with the answers for packed prompts, or the candidate numbers for
+        listwise prompts.
+    """
+    content = messages[-1]["content"] if len(messages) > 0 else ""
+    candidates = _CANDIDATE_PATTERN.split(content)
+    if len(candidates) > 1:
+        numbers = [str(number) for number, candidate in enumerate(candidates[1:], start=1)
+                   if _answer_pair(f"{candidates[0]} Second entry: {candidate}") == "Yes"]
+        return ", ".join(numbers) if len(numbers) > 0 else "None"
+    pairs = _PAIR_PATTERN.split(content)
+    if len(pairs) > 1:
+        return json.dumps({"answers": [_answer_pair(pair) for pair in pairs[1:]]})
+    return _answer_pair(content)
+
+
+def mock_requests(
+        num_requests: int,
+        model: str,
+        *,
+        max_tokens: int = 101,
+        num_examples: int = 2,
+        seed: int = 581043227
+) -> list[dict]:
+    """Create synthetic entity matching requests that resemble those of prepare_requests.py.
+
+    Args:
+        num_requests: The number of requests.
+        model: The name of the model.
+        max_tokens: The value for max_tokens.
+        num_examples: The number of few-shot examples per request.
+        seed: The seed for the random number generator.
+
+    Returns:
+        The list of API requests.
+    """
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_requests):
+        messages = [{
+            "role": "user",
+            "content": "Do the two table entries refer to the same real-world entity?\n"
+                       "Answer with \"Yes\" if they do and with \"No\" if they do not."
+        }]
+        for _ in range(num_examples):
+            first, second, ground_truth = _random_pair(rng)
+            messages.append({"role": "user", "content": f"First entry: {first} Second entry: {second}"})
+            messages.append({"role": "assistant", "content": ground_truth})
+        first, second, _ = _random_pair(rng)
+        messages.append({"role": "user", "content": f"First entry: {first} Second entry: {second}"})
+        requests.append({
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": 0,
+            "seed": seed,
+            "messages": messages
+        })
+    return requests
+
+
+@contextlib.contextmanager
+def openai_mock_server(
+        *,
+        rpm: int = 500,
+        tpm: int = 200_000,
+        latency: MockLatency | None = None,
+        answer: Callable[[list[dict]], str] = answer_yes_no,
+        failure_probability: float = 0.0,
+        seed: int = 417360215,
+        host: str = "127.0.0.1",
+        port: int = 0
+) -> Iterator[MockServer]:
+    """Run a local OpenAI-compatible chat completions server in a background thread.
+
+    The rate limits are enforced with token buckets that refill continuously, and each request reserves its input
+    tokens plus `max_tokens` (or `max_completion_tokens`) like the OpenAI API does.
+
+    Args:
+        rpm: The requests per minute limit.
+        tpm: The tokens per minute limit.
+        latency: The latency distribution, defaults to a constant latency of 0.2 seconds.
+        answer: Function that computes the generated text from the request's messages.
+        failure_probability: Probability with which a request fails with status code 500.
+        seed: The seed for the latency and failure random number generator.
+        host: The host to bind to.
+        port: The port to bind to, 0 means a free port is chosen.
+
+    Returns:
+        A context manager that yields the MockServer handle.
+    """
+    state = _ServerState(
+        rpm=rpm,
+        tpm=tpm,
+        latency=latency if latency is not None else MockLatency(),
+        answer=answer,
+        failure_probability=failure_probability,
+        rng=random.Random(seed)
+    )
+
+    server = _Server((host, port), _Handler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}/v1"
+    logger.debug(f"mock server running at {base_url}")
+    try:
+        yield MockServer(base_url=base_url, stats=state.stats, rpm=rpm, tpm=tpm)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+########################################################################################################################
+# implementation
+########################################################################################################################
+
+
+def _answer_pair(content: str) -> str:
+    if "Second entry:" not in content:
+        return "No"
+    first, second = content.split("Second entry:", 1)
+    first_ids = {t for t in _IDENTIFIER_PATTERN.findall(first) if len(t) >= 6}
+    second_ids = {t for t in _IDENTIFIER_PATTERN.findall(second) if len(t) >= 6}
+    return "Yes" if len(first_ids & second_ids) > 0 else "No"
+
+
+@attrs.define
+class _ServerState:
+    rpm: int
+    tpm: int
+    latency: MockLatency
+    answer: Callable[[list[dict]], str]
+    failure_probability: float
+    rng: random.Random
+    stats: MockServerStats = attrs.field(factory=MockServerStats)
+    r: float = attrs.field(default=None)
+    t: float = attrs.field(default=None)
+    last_update: float = attrs.field(factory=time.time)
+    lock: threading.Lock = attrs.field(factory=threading.Lock)
+
+    def __attrs_post_init__(self) -> None:
+        self.r = self.rpm
+        self.t = self.tpm
+
+    def consider_time(self) -> None:
+        now = time.time()
+        delta = now - self.last_update
+        self.r = min(self.rpm, self.r + self.rpm * delta / 60)
+        self.t = min(self.tpm, self.t + self.tpm * delta / 60)
+        self.last_update = now
+
+    def headers(self) -> dict[str, str]:
+        reset_requests = (self.rpm - self.r) / self.rpm * 60
+        reset_tokens = (self.tpm - self.t) / self.tpm * 60
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-limit-tokens": str(self.tpm),
+            "x-ratelimit-remaining-requests": str(max(0, int(self.r))),
+            "x-ratelimit-remaining-tokens": str(max(0, int(self.t))),
+            "x-ratelimit-reset-requests": _format_duration(reset_requests),
+            "x-ratelimit-reset-tokens": _format_duration(reset_tokens)
+        }
+
+
+def _random_table_row(rng: random.Random, identifier: str) -> str:
+    name = " ".join(rng.choice(string.ascii_uppercase) + "".join(rng.choices(string.ascii_lowercase, k=6))
+                    for _ in range(2))
+    document_number = rng.randint(10 ** 9, 10 ** 10 - 1)
+    amount = f"{rng.uniform(10, 1_000_000):.2f}"
+    return f"MANDT,BELNR,ZUONR,NAME1,WAERS,WRBTR\n1,{document_number},{identifier},{name},USD,{amount}\n"
+
+
+def _random_pair(rng: random.Random) -> tuple[str, str, str]:
+    identifier = f"INV{rng.randint(10 ** 14, 10 ** 15 - 1)}"
+    first = _random_table_row(rng, identifier)
+    if rng.random() < 0.5:
+        return first, _random_table_row(rng, identifier), "Yes"
+    return first, _random_table_row(rng, f"INV{rng.randint(10 ** 14, 10 ** 15 - 1)}"), "No"
+
+
+def _mock_logprobs(request: dict, tokens: list[int], encoding: tiktoken.Encoding, rng: random.Random) -> dict:
+    # the generated token gets a random probability above 0.5, the rest goes to the other tokens of the logit_bias
+    content = []
+    for token in tokens:
+        p = 0.5 + 0.5 * rng.random()
+        others = [int(t) for t in request.get("logit_bias", {}).keys() if int(t) != token]
+        top_logprobs = [(token, math.log(p))] + [(t, math.log((1 - p) / len(others))) for t in others]
+        content.append({
+            "token": encoding.decode([token]),
+            "logprob": math.log(p),
+            "top_logprobs": [{"token": encoding.decode([t]), "logprob": logprob}
+                             for t, logprob in top_logprobs[:request.get("top_logprobs", 0)]]
+        })
+    return {"content": content}
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.3f}s" if minutes > 0 else f"{seconds:.3f}s"
+
+
+def _num_input_tokens(request: dict, encoding: tiktoken.Encoding) -> int:
+    extra_tokens = 5  # number of additional tokens in each message, same as in `_Request.num_input_tokens`
+    return sum(len(encoding.encode(message["content"])) + extra_tokens for message in request["messages"])
+
+
+def _max_output_tokens(request: dict) -> int | None:
+    if request.get("max_completion_tokens") is not None:
+        return request["max_completion_tokens"]
+    return request.get("max_tokens")
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the executor opens up to 200 connections at once
+    state: _ServerState
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format % args)
+
+    def _send_json(self, status_code: int, body: dict, headers: dict[str, str]) -> None:
+        data = bytes(json.dumps(body), "utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        state: _ServerState = self.server.state
+
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path `{self.path}`!", "type": "invalid_request"}}, {})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        encoding = tiktoken.encoding_for_model(request["model"])
+        prompt_tokens = _num_input_tokens(request, encoding)
+        max_output_tokens = _max_output_tokens(request)
+        n = request.get("n", 1)
+        reserved_tokens = n * (prompt_tokens + (max_output_tokens if max_output_tokens is not None else 0))
+
+        with state.lock:
+            now = time.time()
+            state.stats.num_requests += 1
+            if state.stats.first_request is None:
+                state.stats.first_request = now
+            state.consider_time()
+            if state.r < 1 or state.t < reserved_tokens:
+                state.stats.num_rate_limited += 1
+                kind = "requests" if state.r < 1 else "tokens"
+                headers = state.headers()
+                self._send_json(
+                    429,
+                    {
+                        "error": {
+                            "message": f"Rate limit reached for {request['model']} on {kind} per min.",
+                            "type": kind,
+                            "param": None,
+                            "code": "rate_limit_exceeded"
+                        }
+                    },
+                    headers
+                )
+                return
+            state.r -= 1
+            state.t -= reserved_tokens
+            headers = state.headers()
+            failed = state.rng.random() < state.failure_probability
+
+            text = state.answer(request["messages"])
+            completion_tokens = encoding.encode(text)
+            finish_reason = "stop"
+            if max_output_tokens is not None and len(completion_tokens) > max_output_tokens:
+                completion_tokens = completion_tokens[:max_output_tokens]
+                text = encoding.decode(completion_tokens)
+                finish_reason = "length"
+            latency = state.latency.sample(state.rng, len(completion_tokens))
+            logprobs = None
+            if request.get("logprobs"):
+                logprobs = _mock_logprobs(request, completion_tokens, encoding, state.rng)
+
+        time.sleep(latency)
+
+        with state.lock:
+            state.stats.last_response = time.time()
+            if failed:
+                state.stats.num_failed += 1
+            else:
+                state.stats.num_successful += 1
+                state.stats.prompt_tokens += n * prompt_tokens
+                state.stats.completion_tokens += n * len(completion_tokens)
+                state.stats.reserved_tokens += reserved_tokens
+                # return the reserved but unused output tokens to the budget
+                used_tokens = n * (prompt_tokens + len(completion_tokens))
+                state.consider_time()
+                state.t = min(state.tpm, state.t + reserved_tokens - used_tokens)
+
+        if failed:
+            self._send_json(500, {"error": {"message": "The server had an error.", "type": "server_error"}}, headers)
+            return
+
+        request_hash = hashlib.sha256(bytes(json.dumps(request), "utf-8")).hexdigest()
+        self._send_json(
+            200,
+            {
+                "id": f"chatcmpl-mock-{request_hash[:24]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": i,
+                        "message": {"role": "assistant", "content": text},
+                        "logprobs": logprobs,
+                        "finish_reason": finish_reason
+                    } for i in range(n)
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": n * len(completion_tokens),
+                    "total_tokens": prompt_tokens + n * len(completion_tokens)
+                },
+                "system_fingerprint": "fp_mock"
+            },
+            headers
+        )
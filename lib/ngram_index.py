@@ -0,0 +1,172 @@
+import logging
+import re
+from typing import Sequence
+
+import attrs
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_NON_IDENTIFIER_PATTERN = re.compile(r"[^0-9A-Za-z]")
+
+
+def normalize_identifier_text(texts: pd.Series) -> pd.Series:
+    """Remove everything but letters and digits and convert to upper case.
+
+    Removing the spaces joins identifiers that contain inserted spaces, e.g., in memo lines.
+
+    Args:
+        texts: The identifiers or texts that contain identifiers.
+
+    Returns:
+        The normalized texts, with empty strings for missing values.
+    """
+    return texts.fillna("").astype(str).str.replace(_NON_IDENTIFIER_PATTERN, "", regex=True).str.upper()
+
+
+def character_ngrams(texts: pd.Series, n: int) -> pd.Series:
+    """Compute the distinct character n-grams of each text.
+
+    Texts shorter than n are their own single n-gram.
+
+    Args:
+        texts: The normalized texts.
+        n: The length of the n-grams.
+
+    Returns:
+        The n-grams with the index of the text that they come from.
+    """
+    lengths = texts.str.len()
+    grams = [texts[(lengths > 0) & (lengths < n)]]
+    for start in range(max(lengths.max() if len(texts.index) > 0 else 0, n) - n + 1):
+        grams.append(texts[lengths >= start + n].str[start:start + n])
+    grams = pd.concat(grams)
+    return grams[~pd.MultiIndex.from_arrays([grams.index, grams.values]).duplicated()]
+
+
+@attrs.define
+class NGramIndex:
+    """Inverted index from character n-grams of identifiers to the documents that they belong to.
+
+    A query scores each indexed identifier by the IDF-weighted share of its n-grams that occur in the query text, so
+    that identifiers with inserted spaces, dropped or inserted digits, swapped digits, or cut-off digits still score
+    high.
+    A document's score is the score of its best identifier.
+    """
+    n: int
+    gram_codes: dict[str, int]  # n-gram ==> position in offsets and gram_weights
+    offsets: np.ndarray  # postings of n-gram i are postings[offsets[i]:offsets[i + 1]]
+    postings: np.ndarray  # identifier positions
+    gram_weights: np.ndarray  # IDF weight of each n-gram
+    identifier_weights: np.ndarray  # total weight of each identifier's n-grams
+    doc_ids: np.ndarray  # document id of each identifier
+
+    @classmethod
+    def build(
+            cls,
+            identifiers: Sequence[str],
+            doc_ids: Sequence[int],
+            n: int = 3,
+            max_document_frequency: float = 0.05
+    ) -> "NGramIndex":
+        """Build the index over the given identifiers.
+
+        N-grams that occur in more than max_document_frequency of the identifiers (e.g., a common prefix like "INV100")
+        have no postings. They still count towards the identifiers' total weight, but queries skip them, which keeps
+        the number of postings per query small.
+
+        Args:
+            identifiers: The identifiers, e.g., billing numbers. Missing and empty identifiers are not indexed.
+            doc_ids: The document id of each identifier, e.g., the invoice id. Documents can have several identifiers.
+            n: The length of the n-grams.
+            max_document_frequency: The maximum share of identifiers that an n-gram with postings may occur in.
+
+        Returns:
+            The n-gram index.
+        """
+        identifiers = normalize_identifier_text(pd.Series(identifiers, dtype=object)).reset_index(drop=True)
+        doc_ids = np.asarray(doc_ids)
+        keep = identifiers.str.len() > 0
+        identifiers, doc_ids = identifiers[keep].reset_index(drop=True), doc_ids[keep.to_numpy()]
+
+        grams = character_ngrams(identifiers, n)
+        codes, uniques = pd.factorize(grams, sort=True)
+        document_frequencies = np.bincount(codes, minlength=len(uniques))
+        gram_weights = np.log(max(len(identifiers.index), 1) / document_frequencies) + 1
+        identifier_weights = np.bincount(grams.index.to_numpy(), weights=gram_weights[codes],
+                                         minlength=len(identifiers.index))
+
+        num_postings = np.where(document_frequencies > max_document_frequency * len(identifiers.index), 0,
+                                document_frequencies)
+        indexed = num_postings[codes] > 0
+        order = np.argsort(codes[indexed], kind="stable")
+        postings = grams.index.to_numpy()[indexed][order].astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(num_postings)])
+        return cls(
+            n=n,
+            gram_codes={gram: code for code, gram in enumerate(uniques)},
+            offsets=offsets,
+            postings=postings,
+            gram_weights=gram_weights,
+            identifier_weights=identifier_weights,
+            doc_ids=doc_ids
+        )
+
+    @property
+    def num_identifiers(self) -> int:
+        """Number of indexed identifiers."""
+        return len(self.doc_ids)
+
+    def query(self, text: str, k: int, min_score: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+        """Find the documents whose identifiers best match the given text.
+
+        Args:
+            text: The query text, e.g., a memo line that contains several identifiers.
+            k: The maximum number of documents to return.
+            min_score: The minimum score of the returned documents, between 0 and 1.
+
+        Returns:
+            The document ids and their scores, in order of decreasing score.
+        """
+        text = _NON_IDENTIFIER_PATTERN.sub("", text or "").upper()
+        grams = {text[start:start + self.n] for start in range(len(text) - self.n + 1)} or {text}
+        codes = [self.gram_codes[gram] for gram in grams if gram in self.gram_codes]
+        codes = np.asarray(codes, dtype=np.int64)
+        starts, ends = self.offsets[codes], self.offsets[codes + 1]
+        counts = ends - starts
+        if counts.sum() == 0:
+            return self.doc_ids[:0], np.empty(0)
+
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        identifiers, inverse = np.unique(self.postings[positions], return_inverse=True)
+        scores = np.bincount(inverse, weights=np.repeat(self.gram_weights[codes], counts))
+        scores /= self.identifier_weights[identifiers]
+
+        # keep the best identifier of each document
+        order = np.argsort(-scores, kind="stable")
+        docs, first = np.unique(self.doc_ids[identifiers[order]], return_index=True)
+        doc_scores = scores[order][first]
+        keep = doc_scores >= min_score
+        docs, doc_scores = docs[keep], doc_scores[keep]
+
+        top = np.argsort(-doc_scores, kind="stable")[:k]
+        return docs[top], doc_scores[top]
+
+    def query_many(
+            self,
+            texts: Sequence[str],
+            k: int,
+            min_score: float = 0.0
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Query the index for each of the given texts.
+
+        Args:
+            texts: The query texts.
+            k: The maximum number of documents to return per query.
+            min_score: The minimum score of the returned documents, between 0 and 1.
+
+        Returns:
+            The document ids and their scores for each query.
+        """
+        return [self.query(text, k, min_score) for text in texts]
@@ -0,0 +1,203 @@
+import collections.abc
+import json
+import logging
+import pathlib
+
+import attrs
+
+from lib.data import dump_json, load_json, sort_names
+from lib.prompting.template import CompiledChatTemplate, compile_chat_template
+
+logger = logging.getLogger(__name__)
+
+COMPACT_REQUESTS_FILE = "compact.json"
+
+
+def _template_variables(compiled: CompiledChatTemplate) -> tuple[str, ...]:
+    # the distinct variables, whose values a fill records in this order
+    return tuple(dict.fromkeys(compiled.variables))
+
+
+@attrs.define
+class CompactChatTemplate:
+    """Chat template of compact requests, whose fill records the values instead of filling out the messages."""
+    name: str
+    compiled: CompiledChatTemplate
+    compact_requests: "CompactRequests"
+
+    def fill(self, **args) -> list[dict]:
+        """Record the values of the {{variables}} like CompiledChatTemplate.fill, but without filling out the messages.
+
+        The value of a message slot must be the result of another template's fill. String values are stored once by
+        the compact requests and referenced by their ID.
+
+        Args:
+            **args: The given string or filled messages as values for the variables.
+
+        Returns:
+            A list with the single fill of this template, which can be a message slot's value or a request's messages.
+        """
+        slots = {item for item in self.compiled.items if isinstance(item, str)}
+        values = []
+        for variable in _template_variables(self.compiled):
+            value = args.get(variable)
+            if variable in slots:
+                if not isinstance(value, list) or not all("template" in fill for fill in value):
+                    raise AssertionError(f"Missing filled messages for template message variable {{{{{variable}}}}}!")
+                values.append(value)
+            else:
+                if value is None:
+                    raise AssertionError(f"Missing value for template string variable {variable}!")
+                values.append(self.compact_requests.intern(value))
+        return [{"template": self.name, "values": values}]
+
+
+@attrs.define
+class CompactRequests:
+    """Chat requests stored as chat templates, distinct strings, and the template values of each request.
+
+    The instructions of the templates, the request fields (e.g., the model), and the strings that many requests share
+    (e.g., linearized rows) are stored only once. Each request references its fields and the fills of its messages.
+    Expanding a request fills out the templates, which gives exactly the request that was added, so that its hash and
+    its cached response stay the same.
+    """
+    templates: dict[str, list] = attrs.field(factory=dict)
+    fields: list[str] = attrs.field(factory=list)  # JSON of the distinct request fields, with None as messages
+    strings: list[str] = attrs.field(factory=list)
+    requests: list[dict] = attrs.field(factory=list)  # the name, the fields ID, and the message fills of each request
+    _field_ids: dict[str, int] = attrs.field(factory=dict)
+    _string_ids: dict[str, int] = attrs.field(factory=dict)
+    _compiled: dict[str, CompiledChatTemplate] = attrs.field(factory=dict)
+    _variables: dict[str, tuple[str, ...]] = attrs.field(factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.requests)
+
+    @property
+    def names(self) -> list[str]:
+        """The names of the requests in the order in which they were added."""
+        return [request["name"] for request in self.requests]
+
+    def template(self, name: str, template: list[dict[str, str] | str]) -> CompactChatTemplate:
+        """Add the chat template, whose fills can become the messages of requests.
+
+        Args:
+            name: The name of the template.
+            template: List of template messages containing {{variables}}.
+
+        Returns:
+            The chat template, which can replace a compiled chat template when preparing requests.
+        """
+        self.templates[name] = template
+        self._compiled[name] = compile_chat_template(template)
+        self._variables[name] = _template_variables(self._compiled[name])
+        return CompactChatTemplate(name, self._compiled[name], self)
+
+    def intern(self, string: str) -> int:
+        """Get the ID of the string, which is stored only once."""
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self._string_ids[string] = string_id
+        return string_id
+
+    def add(self, name: str, request: dict) -> None:
+        """Add the request, whose messages are the fills of compact chat templates.
+
+        Args:
+            name: The name of the request, e.g., its former file name.
+            request: The request with the filled messages of a compact chat template.
+        """
+        fields = json.dumps({**request, "messages": None})
+        fields_id = self._field_ids.get(fields)
+        if fields_id is None:
+            fields_id = len(self.fields)
+            self.fields.append(fields)
+            self._field_ids[fields] = fields_id
+        self.requests.append({"name": name, "fields": fields_id, "messages": request["messages"]})
+
+    def _expand_fills(self, fills: list[dict]) -> list[dict]:
+        messages = []
+        for fill in fills:
+            args = {variable: self._expand_fills(value) if isinstance(value, list) else self.strings[value]
+                    for variable, value in zip(self._variables[fill["template"]], fill["values"])}
+            messages += self._compiled[fill["template"]].fill(**args)
+        return messages
+
+    def expand(self, ix: int) -> dict:
+        """Expand the request into the full API request.
+
+        Args:
+            ix: The index of the request.
+
+        Returns:
+            The full API request.
+        """
+        request = json.loads(self.fields[self.requests[ix]["fields"]])
+        request["messages"] = self._expand_fills(self.requests[ix]["messages"])
+        return request
+
+    def dump(self, path: pathlib.Path) -> None:
+        """Save the compact requests as a JSON file.
+
+        Args:
+            path: The pathlib.Path to the JSON file.
+        """
+        dump_json({"templates": self.templates, "fields": self.fields, "strings": self.strings,
+                   "requests": self.requests}, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "CompactRequests":
+        """Load the compact requests from a JSON file.
+
+        Args:
+            path: The pathlib.Path to the JSON file.
+
+        Returns:
+            The compact requests.
+        """
+        data = load_json(path)
+        compact_requests = cls(fields=data["fields"], strings=data["strings"], requests=data["requests"])
+        for name, template in data["templates"].items():
+            compact_requests.template(name, template)
+        return compact_requests
+
+
+class _RequestSequence(collections.abc.Sequence):
+    # the requests of a requests directory, each expanded or loaded from its JSON file on access
+
+    def __init__(self, requests_dir: pathlib.Path, compact_requests: CompactRequests | None, order: list) -> None:
+        self._requests_dir = requests_dir
+        self._compact_requests = compact_requests
+        self._order = order  # the request indices of the compact requests or the request file names
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self._compact_requests is not None:
+            return self._compact_requests.expand(self._order[index])
+        return load_json(self._requests_dir / self._order[index])
+
+
+def load_requests(requests_dir: pathlib.Path) -> tuple[list[str], collections.abc.Sequence[dict]]:
+    """Load the requests of a requests directory, which are either JSON files or compact requests.
+
+    Args:
+        requests_dir: The pathlib.Path to the requests directory.
+
+    Returns:
+        The names of the requests, i.e., their file names, in the order of sort_names and a sequence of the requests,
+        which expands or loads each request when it is accessed.
+    """
+    if (requests_dir / COMPACT_REQUESTS_FILE).is_file():
+        compact_requests = CompactRequests.load(requests_dir / COMPACT_REQUESTS_FILE)
+        positions = {name: ix for ix, name in enumerate(compact_requests.names)}
+        order = [positions[name] for name in sort_names(compact_requests.names)]
+        names = [compact_requests.names[ix] for ix in order]
+        return names, _RequestSequence(requests_dir, compact_requests, order)
+    names = sort_names(request_path.name for request_path in requests_dir.glob("*.json"))
+    return names, _RequestSequence(requests_dir, None, names)
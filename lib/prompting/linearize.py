@@ -1,9 +1,16 @@
+import hashlib
+import json
 import logging
-from typing import Literal
+import pathlib
+from typing import Callable, Literal
 
+import attrs
+import numpy as np
 import pandas as pd
+import tabulate
 
-from lib.prompting.template import fill_template
+from lib.data import dump_json, load_json
+from lib.prompting.template import compile_template, fill_template
 
 logger = logging.getLogger(__name__)
 
@@ -13,9 +20,13 @@ def linearize_table(
         table_name: str | None,
         *,
         template: str,
-        mode: Literal["csv"] | Literal["markdown"],
+        mode: Literal["csv"] | Literal["markdown"] | Literal["key_value"],
         csv_params: dict | None = None,
-        markdown_params: dict | None = None
+        markdown_params: dict | None = None,
+        key_value_params: dict | None = None,
+        prune_columns: list[str] | None = None,
+        elide_null: bool = False,
+        elide_constant: bool = False
 ) -> str:
     """Linearize the given table.
 
@@ -26,15 +37,214 @@ def linearize_table(
         mode: The linearization mode.
         csv_params: The parameters for the pandas to_csv method.
         markdown_params: The parameters for the pandas to_markdown method.
+        key_value_params: The separator between and the assignment within the key=value pairs of a row.
+        prune_columns: Columns to leave out if the table has them.
+        elide_null: Whether to leave out columns without any values.
+        elide_constant: Whether to leave out columns that have the same value in all rows of a multi-row table.
 
     Returns:
         The linearized table string.
     """
+    table = _elide_columns(table, prune_columns, elide_null, elide_constant)
+    lin_table = _linearize(table, mode, csv_params, markdown_params, key_value_params)
+    return fill_template(template, newline="\n", table_name=table_name, table=lin_table)
+
+
+def linearize_rows(
+        table: pd.DataFrame,
+        table_name: str | None,
+        *,
+        template: str,
+        mode: Literal["csv"] | Literal["markdown"] | Literal["key_value"],
+        csv_params: dict | None = None,
+        markdown_params: dict | None = None,
+        key_value_params: dict | None = None,
+        prune_columns: list[str] | None = None,
+        elide_null: bool = False,
+        elide_constant: bool = False
+) -> np.ndarray:
+    """Linearize each row of the given table as if it were a single-row table.
+
+    Element i of the result is equal to linearize_table(table.iloc[[i]], ...), but the table is linearized in one
+    pass instead of paying the setup cost of to_csv/to_markdown for every row.
+
+    Args:
+        table: The table whose rows to linearize.
+        table_name: The name of the table.
+        template: The linearization template, which can contain {{table_name}}, {{table}}, and {{newline}}.
+        mode: The linearization mode.
+        csv_params: The parameters for the pandas to_csv method.
+        markdown_params: The parameters for the pandas to_markdown method.
+        key_value_params: The separator between and the assignment within the key=value pairs of a row.
+        prune_columns: Columns to leave out if the table has them.
+        elide_null: Whether to leave out columns without any values.
+        elide_constant: Whether to leave out columns that have the same value in all rows of a multi-row table.
+
+    Returns:
+        Object array of linearized row strings in the positional order of the table's rows.
+    """
+    table = _elide_columns(table, prune_columns, False, False)  # constant columns do not exist in single rows
+    if elide_null:  # the remaining columns differ between the rows
+        lin_rows = [_linearize(table.iloc[[ix]].dropna(axis=1, how="all"), mode, csv_params, markdown_params,
+                               key_value_params) for ix in range(len(table))]
+    elif mode == "csv":
+        lin_rows = _csv_rows(table, csv_params)
+    elif mode == "markdown":
+        lin_rows = _markdown_rows(table, markdown_params)
+    elif mode == "key_value":
+        lin_rows = _key_value_rows(table, key_value_params)
+    else:
+        raise AssertionError(f"Unsupported table linearization mode '{mode}'!")
+
+    compiled_template = compile_template(template)
+    result = np.empty(len(lin_rows), dtype=object)
+    for ix, lin_row in enumerate(lin_rows):
+        result[ix] = compiled_template.fill(newline="\n", table_name=table_name, table=lin_row)
+    return result
+
+
+def _elide_columns(
+        table: pd.DataFrame,
+        prune_columns: list[str] | None,
+        elide_null: bool,
+        elide_constant: bool
+) -> pd.DataFrame:
+    if prune_columns:
+        table = table.drop(columns=[column for column in prune_columns if column in table.columns])
+    if elide_null:
+        table = table.dropna(axis=1, how="all")
+    if elide_constant and len(table.index) > 1:
+        table = table.loc[:, table.nunique(dropna=False) > 1]
+    return table
+
+
+def _linearize(
+        table: pd.DataFrame,
+        mode: str,
+        csv_params: dict | None,
+        markdown_params: dict | None,
+        key_value_params: dict | None
+) -> str:
     if mode == "csv":
-        lin_table = table.to_csv(**csv_params)
+        return table.to_csv(**csv_params)
     elif mode == "markdown":
-        lin_table = table.to_markdown(**markdown_params)
+        return table.to_markdown(**markdown_params)
+    elif mode == "key_value":
+        return "\n".join(_key_value_rows(table, key_value_params))
     else:
         raise AssertionError(f"Unsupported table linearization mode '{mode}'!")
 
-    return fill_template(template, newline="\n", table_name=table_name, table=lin_table)
+
+def _csv_rows(table: pd.DataFrame, csv_params: dict) -> list[str]:
+    header = table.iloc[:0].to_csv(**csv_params)  # only the header line (or nothing if header=False)
+    lines = table.to_csv(**{**csv_params, "header": False}).splitlines(keepends=True)
+    if len(lines) != len(table):  # quoted values with line breaks span multiple lines
+        logger.debug("fall back to row-wise CSV linearization")
+        return [table.iloc[[ix]].to_csv(**csv_params) for ix in range(len(table))]
+    return [header + line for line in lines]
+
+
+def _markdown_rows(table: pd.DataFrame, markdown_params: dict) -> list[str]:
+    params = dict(markdown_params)
+    if params.pop("index", True):  # the index column header depends on pandas' handling of the index name
+        return [table.iloc[[ix]].to_markdown(**markdown_params) for ix in range(len(table))]
+    params.setdefault("headers", [str(column) for column in table.columns])
+    params.setdefault("tablefmt", "pipe")
+    values = table.astype(object).values
+    return [tabulate.tabulate([row], showindex=False, **params) for row in values]
+
+
+def _key_value_rows(table: pd.DataFrame, key_value_params: dict | None) -> list[str]:
+    key_value_params = key_value_params or {}
+    separator = key_value_params.get("separator", ", ")
+    assignment = key_value_params.get("assignment", "=")
+    keys = [f"{column}{assignment}" for column in table.columns]
+    lin_rows = []
+    for row in table.astype(object).values:
+        lin_rows.append(separator.join(key + ("" if pd.isna(value) else str(value)) for key, value in zip(keys, row)))
+    return lin_rows
+
+
+@attrs.define
+class LinearizationCache:
+    """Cache of linearized rows keyed by the table, the row ID, and the linearization configuration.
+
+    Rows without an ID are linearized without caching. If a path is given, the cache is loaded from and saved to a
+    JSON file whose name includes the hash of the linearization configuration.
+    """
+    params: dict
+    path: pathlib.Path | None = None
+    num_hits: int = 0
+    num_misses: int = 0
+    num_uncached: int = 0
+    num_prefilled: int = 0
+    _rows: dict[str, str] = attrs.field(factory=dict)
+
+    def __attrs_post_init__(self) -> None:
+        if self.path is not None:
+            config_hash = hashlib.sha256(json.dumps(self.params, sort_keys=True).encode("utf-8")).hexdigest()
+            self.path = self.path.with_name(f"{self.path.stem}_{config_hash[:16]}{self.path.suffix}")
+            if self.path.is_file():
+                self._rows = load_json(self.path)
+                logger.info(f"loaded {len(self._rows)} linearized rows from {self.path}")
+
+    def linearize(self, table: str, row_id: int | str | None, load_row: Callable[[], pd.DataFrame]) -> str:
+        """Linearize the row, or look it up if the same row has already been linearized.
+
+        Args:
+            table: The name of the table that contains the row.
+            row_id: The ID of the row in the table, or None if the row has no ID.
+            load_row: Function that loads the row as a single-row table if it must be linearized.
+
+        Returns:
+            The linearized row string.
+        """
+        if row_id is None:
+            self.num_uncached += 1
+            return linearize_table(load_row(), table_name=None, **self.params)
+        key = f"{table}/{row_id}"
+        lin_row = self._rows.get(key)
+        if lin_row is None:
+            self.num_misses += 1
+            lin_row = linearize_table(load_row(), table_name=None, **self.params)
+            self._rows[key] = lin_row
+        else:
+            self.num_hits += 1
+        return lin_row
+
+    def prefill(self, table: str, rows: pd.DataFrame) -> None:
+        """Linearize the rows that are not cached yet in one pass, so that linearizing them later is a lookup.
+
+        Args:
+            table: The name of the table that contains the rows.
+            rows: The rows with their IDs as index, each of which is linearized as a single-row table.
+        """
+        rows = rows[[f"{table}/{row_id}" not in self._rows for row_id in rows.index]]
+        # with the index of a row that is loaded on its own
+        lin_rows = linearize_rows(rows.set_axis([0] * len(rows.index)), table_name=None, **self.params)
+        for row_id, lin_row in zip(rows.index, lin_rows):
+            self._rows[f"{table}/{row_id}"] = lin_row
+        self.num_prefilled += len(lin_rows)
+
+    def merge(self, other: "LinearizationCache") -> None:
+        """Add the rows and the hit statistics of another cache with the same configuration, e.g., of a worker."""
+        if other.params != self.params:
+            raise AssertionError("Cannot merge linearization caches with different configurations!")
+        self._rows.update(other._rows)
+        self.num_hits += other.num_hits
+        self.num_misses += other.num_misses
+        self.num_uncached += other.num_uncached
+        self.num_prefilled += other.num_prefilled
+
+    def save(self) -> None:
+        """Save the cache if it has a path."""
+        if self.path is not None:
+            dump_json(self._rows, self.path)
+
+    def stats(self) -> str:
+        """Describe the hit statistics of the cache."""
+        num_lookups = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_lookups if num_lookups > 0 else 0
+        return f"{self.num_hits} hits, {self.num_misses} misses ({hit_rate:.1%} hit rate), " \
+               f"{self.num_uncached} rows without ID, {self.num_prefilled} prefilled rows, " \
+               f"{len(self._rows)} cached rows"
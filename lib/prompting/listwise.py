@@ -0,0 +1,42 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+NO_CANDIDATE = "None"
+
+_NUMBER_PATTERN = re.compile(r"\d+")
+_NO_CANDIDATE_PATTERN = re.compile(rf"\b{NO_CANDIDATE}\b", flags=re.IGNORECASE)
+
+
+def format_candidate_answer(candidates_match: list[bool]) -> str:
+    """Create the answer for a listwise prompt, as the model should generate it.
+
+    Args:
+        candidates_match: Whether each candidate matches, in the order in which the candidates appear in the prompt.
+
+    Returns:
+        The comma-separated numbers of the matching candidates, starting at 1, or "None" if no candidate matches.
+    """
+    numbers = [str(number) for number, match in enumerate(candidates_match, start=1) if match]
+    return ", ".join(numbers) if len(numbers) > 0 else NO_CANDIDATE
+
+
+def parse_candidate_answer(text: str | None, num_candidates: int) -> list[bool] | None:
+    """Parse which candidates of a listwise prompt match from the generated text.
+
+    Args:
+        text: The generated text or None if the API request failed.
+        num_candidates: The number of candidates in the listwise prompt.
+
+    Returns:
+        Whether each candidate matches or None if the text names no valid candidate numbers and is not "None".
+    """
+    if text is None:
+        return None
+    numbers = {int(number) for number in _NUMBER_PATTERN.findall(text)}
+    if len(numbers) == 0:
+        return [False] * num_candidates if _NO_CANDIDATE_PATTERN.search(text) is not None else None
+    if not all(1 <= number <= num_candidates for number in numbers):
+        return None
+    return [number in numbers for number in range(1, num_candidates + 1)]
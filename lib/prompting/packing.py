@@ -0,0 +1,68 @@
+import copy
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+ANSWERS_KEY = "answers"
+
+
+def pack_answers(answers: list[str]) -> str:
+    """Create the JSON string with the answers for a packed prompt, as the model should generate it.
+
+    Args:
+        answers: The answers for the pairs in the order in which they appear in the prompt.
+
+    Returns:
+        The JSON string.
+    """
+    return json.dumps({ANSWERS_KEY: answers})
+
+
+def unpack_answers(text: str | None, num_pairs: int) -> list[str] | None:
+    """Parse the answers for the pairs of a packed prompt from the generated text.
+
+    The text must be a JSON object with a list of answers or a JSON list of answers. Boolean answers are converted to
+    "Yes" and "No".
+
+    Args:
+        text: The generated text or None if the API request failed.
+        num_pairs: The number of pairs in the packed prompt.
+
+    Returns:
+        The answers in the order of the pairs or None if they do not line up with the pairs.
+    """
+    if text is None:
+        return None
+    try:
+        answers = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(answers, dict):
+        answers = answers.get(ANSWERS_KEY)
+    if not isinstance(answers, list) or len(answers) != num_pairs:
+        return None
+    if not all(isinstance(answer, (str, bool)) for answer in answers):
+        return None
+    return [("Yes" if answer else "No") if isinstance(answer, bool) else answer for answer in answers]
+
+
+def unpacked_response(response: dict, answer: str, index: int, num_pairs: int) -> dict:
+    """Create the response for a single pair from the response for a packed prompt.
+
+    The usage of the packed response is moved into the `packed` entry so that it is not counted once per pair.
+
+    Args:
+        response: The API response for the packed prompt.
+        answer: The answer for the pair.
+        index: The position of the pair in the packed prompt.
+        num_pairs: The number of pairs in the packed prompt.
+
+    Returns:
+        The API response for the pair.
+    """
+    response = copy.deepcopy(response)
+    response["choices"] = [response["choices"][0]]
+    response["choices"][0]["message"]["content"] = answer
+    response["packed"] = {"index": index, "num_pairs": num_pairs, "usage": response.pop("usage", None)}
+    return response
@@ -0,0 +1,68 @@
+import collections
+import logging
+from typing import Callable
+
+from lib.prompting.template import CompiledChatTemplate
+
+logger = logging.getLogger(__name__)
+
+INSTRUCTION = "instruction"
+OTHER = "other"
+
+
+def profile_prompt_tokens(
+        messages: list[dict[str, str]],
+        chat_template: CompiledChatTemplate,
+        count_tokens: Callable[[str], int],
+        num_input_tokens: int,
+        *,
+        sub_table_variable: str | None = None,
+        sub_table_separator: str | None = None
+) -> tuple[dict[str, int], dict[str, int]] | None:
+    """Attribute the input tokens of a prompt to the components of the chat template that created it.
+
+    Messages without {{variables}} count as the instruction, message slots (e.g., {{examples}}) count under their
+    name, and string variables (e.g., {{first_table_row}}) count under their name. The remaining tokens, which stem from
+    the template text, the message overhead, and tokens spanning component boundaries, count as other.
+
+    Args:
+        messages: The messages of the prompt.
+        chat_template: The compiled chat template that created the prompt.
+        count_tokens: Function that counts the tokens of a string.
+        num_input_tokens: The number of input tokens of the prompt, including the message overhead.
+        sub_table_variable: The variable whose value consists of multiple sub-tables (e.g., first_table_row).
+        sub_table_separator: The separator between the sub-tables.
+
+    Returns:
+        The number of tokens by component and by sub-table, or None if the messages do not match the template.
+    """
+    num_slots = sum(isinstance(item, str) for item in chat_template.items)
+    num_slot_messages = len(messages) - (len(chat_template.items) - num_slots)
+    if num_slots > 1 or num_slot_messages < 0 or (num_slots == 0 and num_slot_messages > 0):
+        return None  # the messages cannot be attributed to the slots
+
+    components = collections.Counter()
+    sub_tables = collections.Counter()
+    messages = iter(messages)
+    for item in chat_template.items:
+        if isinstance(item, str):
+            for _ in range(num_slot_messages):
+                components[item] += count_tokens(next(messages)["content"])
+            continue
+
+        content = next(messages)["content"]
+        if len(item[1].variables) == 0:
+            components[INSTRUCTION] += count_tokens(content)
+            continue
+
+        values = item[1].match(content)
+        if values is None:
+            return None
+        for variable, value in values.items():
+            components[variable] += count_tokens(value)
+            if variable == sub_table_variable and sub_table_separator is not None:
+                for ix, sub_table in enumerate(value.split(sub_table_separator), start=1):
+                    sub_tables[f"{variable}[{ix}]"] += count_tokens(sub_table)
+
+    components[OTHER] = num_input_tokens - sum(components.values())
+    return dict(components), dict(sub_tables)
@@ -1,15 +1,158 @@
+import functools
 import logging
 import re
-from copy import deepcopy
+
+import attrs
 
 logger = logging.getLogger(__name__)
 
+_VARIABLE_PATTERN = re.compile(r"\{\{([^{}]+)\}\}")
 
-def fill_template(template: str, **args) -> str:
-    """Replace {{variables}} in the template with the given values.
+
+@attrs.define
+class CompiledTemplate:
+    """Template string compiled into a list of segments.
+
+    The segments alternate between literal strings (even positions) and variable names (odd positions).
+    """
+    segments: tuple[str, ...]
+
+    @property
+    def variables(self) -> tuple[str, ...]:
+        """Names of the {{variables}} in the order in which they appear."""
+        return self.segments[1::2]
+
+    def fill(self, **args) -> str:
+        """Replace {{variables}} with the given values.
+
+        Args:
+            **args: The values for the variables.
+
+        Raises in case of missing values, but not in case of unneeded values.
+
+        Returns:
+            The template string with {{variables}} replaced by values.
+        """
+        if len(self.segments) == 1:
+            return self.segments[0]
+        parts = list(self.segments)
+        for ix in range(1, len(parts), 2):
+            variable = parts[ix]
+            if variable not in args.keys():
+                raise AssertionError(f"Missing value for template string variable {variable}!")
+            parts[ix] = args[variable]
+        return "".join(parts)
+
+    def match(self, string: str) -> dict[str, str] | None:
+        """Recover the values of the {{variables}} from a string created by filling out the template.
+
+        Args:
+            string: The filled-out template string.
+
+        Returns:
+            The values of the variables or None if the string does not match the template.
+        """
+        pattern = _match_pattern(self.segments)
+        match = pattern.fullmatch(string)
+        if match is None:
+            return None
+        values = {}
+        for group, variable in enumerate(self.variables, start=1):
+            values.setdefault(variable, match.group(group))
+        return values
+
+
+@functools.lru_cache(maxsize=1024)
+def _match_pattern(segments: tuple[str, ...]) -> re.Pattern:
+    parts = [re.escape(segment) if ix % 2 == 0 else "(.*?)" for ix, segment in enumerate(segments)]
+    return re.compile("".join(parts), flags=re.DOTALL)
+
+
+@attrs.define
+class CompiledChatTemplate:
+    """Chat template compiled into a list of message slots and messages with compiled contents."""
+    items: tuple[str | tuple[dict[str, str], CompiledTemplate], ...]
+
+    @property
+    def variables(self) -> tuple[str, ...]:
+        """Names of all message and string {{variables}} in the order in which they appear."""
+        variables = []
+        for item in self.items:
+            if isinstance(item, str):
+                variables.append(item)
+            else:
+                variables += item[1].variables
+        return tuple(variables)
+
+    def fill(self, **args) -> list[dict[str, str]]:
+        """Replace {{variables}} in the chat template with the given values in a single pass.
+
+        A message slot's value can be a list of messages or a message, which are inserted as they are. All other
+        variables are replaced by string values.
+
+        Raises in case of missing values, but not in case of unneeded values.
+
+        Args:
+            **args: The given string, message, or list of messages as values for the variables.
+
+        Returns:
+            The filled-out template.
+        """
+        messages = []
+        for item in self.items:
+            if isinstance(item, str):
+                value = args.get(item)
+                if isinstance(value, list):
+                    messages += value
+                elif isinstance(value, dict):
+                    messages.append(value)
+                else:
+                    raise AssertionError(f"Missing values for template message variable {{{{{item}}}}}!")
+            else:
+                message, content = item
+                messages.append({**message, "content": content.fill(**args)})
+        return messages
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str) -> CompiledTemplate:
+    """Compile the template string into segments.
 
     Args:
         template: The given template string, which may contain {{variables}}.
+
+    Returns:
+        The compiled template.
+    """
+    return CompiledTemplate(tuple(_VARIABLE_PATTERN.split(template)))
+
+
+def compile_chat_template(template: list[dict[str, str] | str]) -> CompiledChatTemplate:
+    """Compile the chat template into message slots and messages with compiled contents.
+
+    Args:
+        template: List of template messages containing {{variables}}.
+
+    Returns:
+        The compiled chat template.
+    """
+    items = []
+    for message in template:
+        if isinstance(message, str):
+            match = _VARIABLE_PATTERN.fullmatch(message)
+            if match is None:
+                raise AssertionError(f"Invalid template message variable {message}!")
+            items.append(match.group(1))
+        else:
+            items.append(({k: v for k, v in message.items() if k != "content"}, compile_template(message["content"])))
+    return CompiledChatTemplate(tuple(items))
+
+
+def fill_template(template: str | CompiledTemplate, **args) -> str:
+    """Replace {{variables}} in the template with the given values.
+
+    Args:
+        template: The given template string, which may contain {{variables}}, or a compiled template.
         **args: The values for the variables.
 
     Raises in case of missing values, but not in case of unneeded values.
@@ -17,67 +160,29 @@ def fill_template(template: str, **args) -> str:
     Returns:
         The template string with {{variables}} replaced by values.
     """
-
-    def replace_variable(match) -> str:
-        variable = match.group(1)
-        if variable not in args.keys():
-            raise AssertionError(f"Missing value for template string variable {variable}!")
-        return args[variable]
-
-    return re.sub(r"\{\{([^{}]+)\}\}", replace_variable, template)
+    if isinstance(template, str):
+        template = compile_template(template)
+    return template.fill(**args)
 
 
 def fill_chat_template(
-        template: list[dict[str, str] | str],
+        template: list[dict[str, str] | str] | CompiledChatTemplate,
         **args
 ) -> list[dict[str, str]]:
     """Replace {{variables}} in the chat template with the given values.
 
-    A value can be a list of messages, a message, or a string, and replacement happens in that order.
+    A value can be a list of messages, a message, or a string. Lists of messages and messages are inserted as they
+    are, without replacing {{variables}} in them.
 
     Raises in case of missing values, but not in case of unneeded values.
 
     Args:
-        template: List of template messages containing {{variables}}.
+        template: List of template messages containing {{variables}}, or a compiled chat template.
         **args: The given string, message, or list of messages as values for the variables.
 
     Returns:
         The filled-out template.
     """
-    template = deepcopy(template)
-
-    # replace message variables with lists of messages
-    for key, value in args.items():
-        template_key = "{{" + key + "}}"
-        if isinstance(value, list):
-            new_template = []
-            for message in template:
-                if message == template_key:
-                    new_template += value
-                else:
-                    new_template.append(message)
-            template = new_template
-
-    # replace message variables with messages
-    for key, value in args.items():
-        template_key = "{{" + key + "}}"
-        if isinstance(value, dict):
-            new_template = []
-            for message in template:
-                if message == template_key:
-                    new_template.append(value)
-                else:
-                    new_template.append(message)
-            template = new_template
-
-    # check for missing message values
-    for message in template:
-        if isinstance(message, str):
-            raise AssertionError(f"Missing values for template message variable {message}!")
-
-    # replace string variables with strings, which already checks for missing string values
-    str_args = {k: v for k, v in args.items() if isinstance(v, str)}
-    for message in template:
-        message["content"] = fill_template(message["content"], **str_args)
-
-    return template
+    if not isinstance(template, CompiledChatTemplate):
+        template = compile_chat_template(template)
+    return template.fill(**args)
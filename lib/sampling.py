@@ -0,0 +1,57 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def sample_excluding(
+        num_values: int,
+        owners: np.ndarray,
+        excluded_owners: np.ndarray,
+        excluded_values: np.ndarray,
+        rng: np.random.Generator,
+        *,
+        max_rounds: int = 100
+) -> np.ndarray:
+    """Draw values from range(num_values) uniformly at random, excluding some values per owner.
+
+    All draws are made at once and rejection sampling repeats only the draws whose value is excluded for their owner
+    or already drawn by an earlier draw of the same owner, so that the draws of an owner are distinct. Since the
+    excluded values are few compared to num_values, the expected number of rounds is small.
+
+    Args:
+        num_values: The number of values, e.g., the number of distinct ids.
+        owners: The non-negative integer owner of each draw, e.g., the match whose invoice needs a non-matching payment.
+        excluded_owners: The owner of each excluded value.
+        excluded_values: The excluded values, e.g., the positions of the ids of the owner's match.
+        rng: The random number generator, which makes the draws deterministic.
+        max_rounds: The maximum number of rounds of rejection sampling.
+
+    Returns:
+        The drawn value of each draw.
+    """
+    owners = np.asarray(owners, dtype=np.int64)
+    if len(owners) == 0:
+        return np.empty(0, dtype=np.int64)
+    if (int(owners.max()) + 1) * num_values >= 2 ** 62:
+        raise AssertionError(f"Cannot combine {int(owners.max()) + 1} owners with {num_values} values!")
+    excluded = np.unique(np.asarray(excluded_owners, dtype=np.int64) * num_values
+                         + np.asarray(excluded_values, dtype=np.int64))
+    num_draws = np.bincount(owners)
+    num_excluded = np.bincount(excluded // num_values, minlength=len(num_draws))[:len(num_draws)]
+    if (num_draws + num_excluded > num_values).any():
+        raise AssertionError(f"Cannot draw distinct values for every owner from {num_values} values!")
+
+    values = rng.integers(num_values, size=len(owners))
+    for _ in range(max_rounds):
+        keys = owners * num_values + values
+        rejected = np.isin(keys, excluded)
+        _, first = np.unique(keys, return_index=True)
+        duplicate = np.ones(len(keys), dtype=bool)
+        duplicate[first] = False
+        rejected |= duplicate
+        if not rejected.any():
+            return values
+        values[rejected] = rng.integers(num_values, size=int(rejected.sum()))
+    raise AssertionError(f"Rejection sampling did not finish within {max_rounds} rounds!")
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+
+import attrs
+
+from lib.data import dump_json, get_data_path, load_json
+
+logger = logging.getLogger(__name__)
+
+
+def _marker_path(output: pathlib.Path) -> pathlib.Path:
+    # next to the output, so that clearing an output directory does not remove it
+    return output.parent / f".{output.name}.stage"
+
+
+def _output_files(output: pathlib.Path) -> dict[str, pathlib.Path]:
+    # the files of an output directory by their relative path, or the output file by its name
+    if output.is_file():
+        return {output.name: output}
+    if not output.is_dir():
+        return {}
+    return {path.relative_to(output).as_posix(): path for path in sorted(output.rglob("*"))
+            if path.is_file() and not path.name.endswith(".stage")}
+
+
+def _fingerprint(path: pathlib.Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _valid_marker(output: pathlib.Path) -> dict | None:
+    # the marker of a cached stage's output if the output's files are unchanged, later stages may add other files
+    marker_path = _marker_path(output)
+    if not marker_path.is_file():
+        return None
+    marker = load_json(marker_path)
+    for name, fingerprint in marker["files"].items():
+        path = output / name if output.is_dir() else output
+        if not path.is_file() or _fingerprint(path) != fingerprint:
+            return None
+    return marker
+
+
+def content_digest(path: pathlib.Path) -> str:
+    """Compute the SHA-256 digest of the relative paths and contents of the files of a directory, or of a file.
+
+    Args:
+        path: The pathlib.Path to the directory or file.
+
+    Returns:
+        The hex digest, the same for the same files regardless of their timestamps.
+    """
+    digest = hashlib.sha256()
+    for name, file_path in _output_files(path).items():
+        file_digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            while chunk := file.read(1 << 20):
+                file_digest.update(chunk)
+        digest.update(f"{name}\0{file_digest.hexdigest()}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def artifact_digest(path: pathlib.Path) -> str:
+    """Get the content digest of a stage's output or of another input, e.g., the downloaded dataset.
+
+    The digest that a cached stage recorded for its output is used as long as the output's files are unchanged, so that
+    large outputs are hashed only once. Otherwise, all files are hashed.
+
+    Args:
+        path: The pathlib.Path to the directory or file.
+
+    Returns:
+        The hex digest.
+    """
+    marker = _valid_marker(path)
+    return content_digest(path) if marker is None else marker["digest"]
+
+
+def _link_or_copy(source: pathlib.Path, target: pathlib.Path) -> None:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:  # e.g., on another file system
+        shutil.copy2(source, target)
+
+
+def _remove(path: pathlib.Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.is_file():
+        path.unlink()
+
+
+@attrs.define
+class Stage:
+    """Pipeline stage whose output is keyed by a hash of its inputs and the config subtrees it depends on.
+
+    The outputs are saved in a content-addressed stage cache, whose files every experiment with the same key shares
+    through hard links. The stages must replace the files of their output instead of writing into them, which
+    dump_json and clearing the output directory do.
+    """
+    name: str
+    output: pathlib.Path  # the output directory or file of the stage in the experiment
+    key: str
+    cache_path: pathlib.Path  # the directory of the stage's outputs in the stage cache
+
+    @property
+    def _entry_path(self) -> pathlib.Path:
+        return self.cache_path / self.key
+
+    @property
+    def _meta_path(self) -> pathlib.Path:
+        return self.cache_path / f"{self.key}.json"
+
+    def _dump_marker(self, digest: str) -> None:
+        files = {name: _fingerprint(path) for name, path in _output_files(self.output).items()}
+        dump_json({"stage": self.name, "key": self.key, "digest": digest, "files": files}, _marker_path(self.output))
+
+    def restore(self) -> bool:
+        """Keep the output if its key is unchanged, or else link the stage cache's output with the key into place.
+
+        Returns:
+            Whether the output is up to date, so that the stage can be skipped.
+        """
+        marker = _valid_marker(self.output)
+        if marker is not None and marker["key"] == self.key:
+            logger.info(f"stage {self.name} is unchanged (key {self.key[:16]}) ==> skip")
+            return True
+        if not self._meta_path.is_file():
+            return False
+
+        meta = load_json(self._meta_path)
+        _remove(self.output)
+        if meta["is_dir"]:
+            self.output.mkdir(parents=True)
+            for name in meta["files"]:
+                _link_or_copy(self._entry_path / name, self.output / name)
+        else:
+            _link_or_copy(self._entry_path / self.output.name, self.output)
+        self._dump_marker(meta["digest"])
+        logger.info(f"stage {self.name} restored from the stage cache (key {self.key[:16]}) ==> skip")
+        return True
+
+    def save(self) -> None:
+        """Save the stage's output in the stage cache under its key, after the stage has run."""
+        files = _output_files(self.output)
+        digest = content_digest(self.output)
+        if not self._meta_path.is_file():
+            tmp_path = self.cache_path / f".{self.key}.{os.getpid()}.tmp"
+            _remove(tmp_path)
+            for name, path in files.items():
+                _link_or_copy(path, tmp_path / name)
+            _remove(self._entry_path)  # of an interrupted run, which wrote no meta file
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, self._entry_path)
+            # written last, so that only complete outputs are restored
+            dump_json({"stage": self.name, "is_dir": self.output.is_dir(), "digest": digest, "files": list(files)},
+                      self._meta_path)
+        self._dump_marker(digest)
+        logger.info(f"stage {self.name} saved in the stage cache (key {self.key[:16]})")
+
+
+def _select(config: dict, key: str):
+    value = config
+    for part in key.split("."):
+        value = value[part]
+    return value
+
+
+def open_stage(name: str, output: pathlib.Path, inputs: dict[str, pathlib.Path | None], config: dict) -> Stage | None:
+    """Open the stage of an experiment if the stage cache is enabled.
+
+    The stage's key is the hash of the content digests of its inputs and of the config subtrees that
+    stage_cache.config_keys lists for the stage. Other config values, e.g., the experiment name or the model for the
+    preprocessing, do not change the key, so that experiments that differ only in them share the stage's output.
+
+    Args:
+        name: The name of the stage, e.g., "preprocess".
+        output: The pathlib.Path to the output directory or file of the stage.
+        inputs: The input directories or files by name, None for inputs that the stage does not use.
+        config: The resolved Hydra config as a container.
+
+    Returns:
+        The stage, or None if the stage cache is disabled or the task config has none.
+    """
+    if not config.get("stage_cache", {}).get("enabled", False):  # not every task config has a stage cache
+        return None
+    key = hashlib.sha256(json.dumps({
+        "stage": name,
+        "inputs": {input_name: None if path is None else artifact_digest(path) for input_name, path in inputs.items()},
+        "config": {key: _select(config, key) for key in config["stage_cache"]["config_keys"][name]}
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    cache_path = get_data_path() / config["task_name"] / config["dataset"]["dataset_name"] / "stage_cache" / name
+    cache_path.mkdir(parents=True, exist_ok=True)
+    return Stage(name, output, key, cache_path)
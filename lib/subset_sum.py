@@ -0,0 +1,79 @@
+import logging
+
+import attrs
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class SubsetSumResult:
+    """Subsets whose sums are within the target range."""
+    subsets: list[tuple[int, ...]]  # positions in the given amounts, each subset in ascending order
+    num_nodes: int  # number of search nodes visited
+    exhausted: bool  # whether the search stopped at the node budget, so that subsets may be missing
+    complete: bool  # whether the search did not stop early, at the node budget or at max_subsets
+
+
+def find_subsets(
+        amounts: np.ndarray,
+        low: int,
+        high: int,
+        *,
+        min_size: int = 1,
+        max_size: int = 10,
+        max_nodes: int = 100_000,
+        max_subsets: int = 10
+) -> SubsetSumResult:
+    """Find subsets of positive amounts whose sum is within [low, high].
+
+    The depth-first search adds the amounts in decreasing order and prunes a branch as soon as its sum exceeds high or
+    even the largest remaining amounts cannot reach low. The node budget bounds the time per search.
+
+    Args:
+        amounts: The integer amounts, e.g., cents. Non-positive amounts are ignored.
+        low: The lower bound of the sum.
+        high: The upper bound of the sum.
+        min_size: The minimum number of amounts in a subset.
+        max_size: The maximum number of amounts in a subset.
+        max_nodes: The maximum number of search nodes to visit.
+        max_subsets: The maximum number of subsets to return.
+
+    Returns:
+        The subsets and statistics of the search.
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    positions = np.flatnonzero((amounts > 0) & (amounts <= high))
+    order = positions[np.argsort(-amounts[positions], kind="stable")]
+    values = [int(v) for v in amounts[order]]
+    # prefix[i] is the sum of the i largest amounts, which bounds the sum of any i amounts
+    prefix = [0]
+    for value in values:
+        prefix.append(prefix[-1] + value)
+
+    subsets = []
+    num_nodes = 0
+    stack = [(0, 0, ())]  # next position, sum, chosen positions
+    while stack:
+        if num_nodes >= max_nodes:
+            return SubsetSumResult(subsets, num_nodes, exhausted=True, complete=False)
+        start, total, chosen = stack.pop()
+        num_nodes += 1
+        if low <= total <= high and len(chosen) >= min_size:
+            subsets.append(tuple(sorted(int(order[ix]) for ix in chosen)))
+            if len(subsets) >= max_subsets:  # other subsets may be missing
+                return SubsetSumResult(subsets, num_nodes, exhausted=False, complete=False)
+        slots = max_size - len(chosen)
+        if slots == 0:
+            continue
+        children = []
+        for ix in range(start, len(values)):
+            if total + values[ix] > high:
+                continue
+            # the ix-th amount and the largest amounts after it must be able to reach low
+            end = min(ix + slots, len(values))
+            if total + prefix[end] - prefix[ix] < low:
+                break
+            children.append((ix + 1, total + values[ix], chosen + (ix,)))
+        stack.extend(reversed(children))
+    return SubsetSumResult(subsets, num_nodes, exhausted=False, complete=True)
@@ -0,0 +1,76 @@
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig
+
+import lib.model._openai
+from lib.data import get_task_dir
+from lib.model._openai import openai_execute
+from lib.model.openai_mock import openai_mock_server, mock_requests, MockLatency
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../config/benchmarks", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+    results = []
+    for num_requests in cfg.execute_requests.num_requests:
+        requests = mock_requests(
+            num_requests,
+            cfg.execute_requests.model,
+            max_tokens=cfg.execute_requests.max_tokens,
+            num_examples=cfg.execute_requests.num_examples,
+            seed=cfg.execute_requests.seed
+        )
+        with tempfile.TemporaryDirectory() as cache_dir, openai_mock_server(
+                rpm=cfg.mock_server.rpm,
+                tpm=cfg.mock_server.tpm,
+                latency=MockLatency(**cfg.mock_server.latency),
+                failure_probability=cfg.mock_server.failure_probability,
+                seed=cfg.mock_server.seed
+        ) as server:
+            os.environ["OPENAI_BASE_URL"] = server.base_url
+            lib.model._openai.CACHE_PATH = pathlib.Path(cache_dir)
+
+            logger.info(f"execute {num_requests} requests against the mock server")
+            start = time.time()
+            responses = openai_execute(
+                requests,
+                force=float("inf"),
+                silent=True,
+                global_context={},  # fresh budget state for every run
+                global_semaphore=threading.Semaphore()
+            )
+            time_to_completion = time.time() - start
+            num_successful = sum("choices" in response.keys() for response in responses)  # loads from the cache
+
+        minutes = time_to_completion / 60
+        available = 1 + minutes  # the budget starts full and refills continuously
+        used_tokens = server.stats.prompt_tokens + server.stats.completion_tokens
+        results.append({
+            "num_requests": num_requests,
+            "time_to_completion_s": time_to_completion,
+            "throughput_rps": num_successful / time_to_completion,
+            "throughput_tpm": used_tokens / minutes,
+            "request_budget_utilisation": num_successful / (server.rpm * available),
+            "token_budget_utilisation": used_tokens / (server.tpm * available),
+            "num_rate_limited": server.stats.num_rate_limited,
+            "num_failed": len(responses) - num_successful
+        })
+        logger.info(f"result: {results[-1]}")
+
+    results = pd.DataFrame(results)
+    path = get_task_dir(cfg.task_name) / "execute_requests.csv"
+    results.to_csv(path, index=False)
+    logger.info(f"results saved to {path}:\n{results.to_markdown(index=False, floatfmt='.3f')}")
+
+
+if __name__ == "__main__":
+    main()
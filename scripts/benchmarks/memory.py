@@ -0,0 +1,118 @@
+import importlib.util
+import logging
+import multiprocessing
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from types import ModuleType
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+import lib.model._openai
+from lib.data import get_task_dir
+from lib.model.openai_mock import openai_mock_server, mock_requests, MockLatency
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm", "r", encoding="utf-8") as file:
+        return int(file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # ru_maxrss is in KiB on Linux
+
+
+def load_executor(revision: str | None, module_dir: str) -> ModuleType:
+    """Load lib/model/_openai.py of the given git revision, or the current one if the revision is None."""
+    if revision is None:
+        return lib.model._openai
+    repo_dir = pathlib.Path(__file__).parent.parent.parent
+    source = subprocess.run(["git", "show", f"{revision}:lib/model/_openai.py"], cwd=repo_dir, capture_output=True,
+                            text=True, check=True).stdout
+    path = pathlib.Path(module_dir) / "baseline_openai.py"
+    path.write_text(source, encoding="utf-8")
+    spec = importlib.util.spec_from_file_location("baseline_openai", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # for the dataclasses of the module
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(num_requests: int, cache_dir: str, revision: str | None, cfg: dict, queue: multiprocessing.Queue) -> None:
+    """Execute the requests with the executor of the revision in a fresh process and report its memory usage."""
+    os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+    executor = load_executor(revision, cache_dir)
+    executor.CACHE_PATH = pathlib.Path(cache_dir) / "cache"
+
+    requests = mock_requests(num_requests, cfg["memory"]["model"])
+    rss_requests = current_rss_mb()
+
+    with openai_mock_server(
+            rpm=cfg["mock_server"]["rpm"],
+            tpm=cfg["mock_server"]["tpm"],
+            latency=MockLatency(distribution="constant", mean=0.0)  # latency does not matter for memory usage
+    ) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        responses = executor.openai_execute(
+            requests,
+            force=float("inf"),
+            silent=True,
+            global_context={},
+            global_semaphore=threading.Semaphore()
+        )
+        num_successful = sum("choices" in response.keys() for response in responses)
+
+    queue.put({
+        "rss_requests_mb": rss_requests,
+        "peak_rss_mb": peak_rss_mb(),
+        "num_successful": num_successful
+    })
+
+
+@hydra.main(version_base=None, config_path="../../config/benchmarks", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    mp_context = multiprocessing.get_context("spawn")  # fresh process for every measurement to reset the peak RSS
+    executors = {"current": None}
+    if cfg.memory.baseline_revision is not None:
+        executors = {"baseline": cfg.memory.baseline_revision, **executors}
+    results = []
+    for num_requests in cfg.memory.num_requests:
+        for executor, revision in executors.items():
+            with tempfile.TemporaryDirectory() as cache_dir:
+                for phase in ("execute", "cached"):  # the second run loads all responses from the cache
+                    logger.info(f"{executor}: {phase} {num_requests} requests")
+                    queue = mp_context.Queue()
+                    process = mp_context.Process(
+                        target=measure,
+                        args=(num_requests, cache_dir, revision, OmegaConf.to_container(cfg), queue)
+                    )
+                    process.start()
+                    result = queue.get()
+                    process.join()
+                    results.append({"executor": executor, "num_requests": num_requests, "phase": phase, **result})
+                    logger.info(f"result: {results[-1]}")
+
+    results = pd.DataFrame(results)
+    results["executor_mb"] = results["peak_rss_mb"] - results["rss_requests_mb"]
+    path = get_task_dir(cfg.task_name) / "memory.csv"
+    results.to_csv(path, index=False)
+    logger.info(f"results saved to {path}:\n{results.to_markdown(index=False, floatfmt='.1f')}")
+
+    # peak RSS before and after, with the executor's share above the requests themselves in parentheses
+    comparison = results.pivot(index=["num_requests", "phase"], columns="executor",
+                               values=["peak_rss_mb", "executor_mb"])
+    comparison = comparison.reindex(pd.MultiIndex.from_frame(results[["num_requests", "phase"]].drop_duplicates()))
+    comparison.columns = [f"{value} ({executor})" for value, executor in comparison.columns]
+    logger.info(f"peak RSS in MB by executor (baseline: {cfg.memory.baseline_revision}):\n"
+                f"{comparison.to_markdown(floatfmt='.1f')}")
+
+if __name__ == "__main__":
+    main()
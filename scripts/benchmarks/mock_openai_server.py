@@ -0,0 +1,33 @@
+import logging
+import time
+
+import hydra
+from omegaconf import DictConfig
+
+from lib.model.openai_mock import openai_mock_server, MockLatency
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../config/benchmarks", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    with openai_mock_server(
+            rpm=cfg.mock_server.rpm,
+            tpm=cfg.mock_server.tpm,
+            latency=MockLatency(**cfg.mock_server.latency),
+            failure_probability=cfg.mock_server.failure_probability,
+            seed=cfg.mock_server.seed,
+            host=cfg.mock_server.host,
+            port=cfg.mock_server.port
+    ) as server:
+        logger.info(f"mock server running, use: export OPENAI_BASE_URL=\"{server.base_url}\"")
+        try:
+            while True:
+                time.sleep(10)
+                logger.info(f"stats: {server.stats}")
+        except KeyboardInterrupt:
+            logger.info("shutting down mock server")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import logging
+import random
+import statistics
+import time
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import InstanceStore, get_instances_dir, get_task_dir
+from lib.model.generic import num_input_tokens
+from lib.model._openai import openai_model
+from lib.prompting.template import compile_chat_template
+from scripts.entity_matching.prepare_requests import create_linearization_caches, prefill_linearization_caches, \
+    prepare_request
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    bench_cfg = cfg.benchmarks.linearization_modes
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    store = InstanceStore.load(instances_dir)
+    instances = [int(name) for name in store.names()][:bench_cfg.num_instances]
+    rows_match = store.column("rows_match")
+    pos_neg_indices = {"positive": np.flatnonzero(rows_match).tolist(),
+                       "negative": np.flatnonzero(~rows_match).tolist()}
+
+    # all linearization modes use the same examples
+    sample_examples_random = random.Random(bench_cfg.seed)
+    k = cfg.sample_examples.num_examples
+    example_instances_by_instance = []
+    for _ in instances:
+        example_instances = sample_examples_random.sample(pos_neg_indices["positive"], k=k) + \
+                            sample_examples_random.sample(pos_neg_indices["negative"], k=k)
+        sample_examples_random.shuffle(example_instances)
+        example_instances_by_instance.append(example_instances)
+
+    results = []
+    for variant_name, variant in bench_cfg.variants.items():
+        variant_cfg = OmegaConf.merge(cfg, variant)
+        prompt_chat_template = compile_chat_template(OmegaConf.to_container(variant_cfg.prompt_chat_template))
+        example_chat_template = compile_chat_template(OmegaConf.to_container(variant_cfg.example_chat_template))
+
+        start = time.perf_counter()
+        linearization_caches = create_linearization_caches(variant_cfg, instances_dir)
+        prefill_linearization_caches(store, linearization_caches, variant_cfg)
+        requests = [
+            prepare_request(store, instance_idx, example_instances, prompt_chat_template, example_chat_template,
+                            linearization_caches, variant_cfg)
+            for instance_idx, example_instances in zip(instances, example_instances_by_instance)
+        ]
+        preparation_time = time.perf_counter() - start
+
+        num_tokens = [num_input_tokens(request, cfg.api_name) for request in requests]
+        results.append({
+            "schema_mode": cfg.dataset.schema_mode,
+            "variant": variant_name,
+            "mean_tokens_per_prompt": statistics.mean(num_tokens),
+            "max_tokens_per_prompt": max(num_tokens),
+            "prompts_per_s": len(requests) / preparation_time,
+            "usd_per_1k_prompts": statistics.mean(num_tokens) * openai_model(cfg.model)["cost_per_1k_input_tokens"]
+        })
+        logger.info(f"result: {results[-1]}")
+
+    results = pd.DataFrame(results)
+    results["relative_tokens"] = results["mean_tokens_per_prompt"] / results["mean_tokens_per_prompt"].iloc[0]
+    path = get_task_dir(cfg.task_name) / "benchmarks"
+    path.mkdir(exist_ok=True)
+    results.to_csv(path / f"linearization_modes_{cfg.dataset.schema_mode}.csv", index=False)
+    logger.info(f"input tokens per prompt ({cfg.model}, {cfg.dataset.schema_mode}):\n"
+                f"{results.to_markdown(index=False, floatfmt='.3f')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+#!/bin/bash
+
+set -e
+
+limit_instances=1000
+model="gpt-4o-mini-2024-07-18"
+schema_modes=("descriptive" "opaque" "multi-table")
+
+for schema_mode in "${schema_modes[@]}"; do
+  args=(
+    exp_name="benchmark-linearization-modes_${schema_mode}"
+    dataset="pay_to_inv"
+    api_name="openai"
+    model="$model"
+    limit_instances="$limit_instances"
+    dataset.schema_mode="$schema_mode"
+    dataset.perturbation_mode="multi"
+  )
+  python scripts/entity_matching/pay_to_inv/preprocess.py "${args[@]}"
+  python scripts/entity_matching/benchmarks/linearization_modes.py "${args[@]}"
+  if [ "$schema_mode" == "multi-table" ]; then
+    python scripts/entity_matching/benchmarks/shared_tables.py "${args[@]}"
+  fi
+done
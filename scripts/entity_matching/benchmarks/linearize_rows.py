@@ -0,0 +1,53 @@
+import logging
+import time
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig
+
+from lib.data import get_download_dir, get_task_dir
+from lib.prompting.linearize import linearize_rows, linearize_table
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    assert cfg.dataset.schema_mode in ["descriptive", "opaque"], "This benchmark requires a single-table schema mode."
+    download_dir = get_download_dir(cfg.task_name, cfg.dataset.dataset_name)
+    data_dir = download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode
+
+    results = []
+    for table_name, id_column in (("invoices", "invoice_id"), ("payments", "payment_id")):
+        table = pd.read_csv(data_dir / f"{table_name}.csv").drop(columns=[id_column])
+        table = table.head(cfg.benchmarks.num_instances)
+
+        start = time.perf_counter()
+        reference = [linearize_table(table.iloc[[ix]], table_name=None, **cfg.linearize_table)
+                     for ix in range(len(table))]
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectorized = linearize_rows(table, table_name=None, **cfg.linearize_table)
+        vectorized_time = time.perf_counter() - start
+
+        assert reference == list(vectorized), "The vectorized linearization must produce the same strings!"
+
+        for implementation, total_time in (("row-wise", reference_time), ("vectorized", vectorized_time)):
+            results.append({
+                "table": table_name,
+                "implementation": implementation,
+                "us_per_row": total_time / len(table) * 1e6,
+                "speedup": reference_time / total_time
+            })
+
+    results = pd.DataFrame(results)
+    path = get_task_dir(cfg.task_name) / "benchmarks"
+    path.mkdir(exist_ok=True)
+    results.to_csv(path / "linearize_rows.csv", index=False)
+    logger.info(f"per-row cost of linearization ({cfg.linearize_table.mode}):\n"
+                f"{results.to_markdown(index=False, floatfmt='.2f')}")
+
+
+if __name__ == "__main__":
+    main()
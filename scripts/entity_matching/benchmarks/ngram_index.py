@@ -0,0 +1,78 @@
+import logging
+import re
+import time
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from lib.data import get_task_dir
+from lib.ngram_index import NGramIndex
+from scripts.entity_matching.pay_to_inv.block import load_frames
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """Measure queries per second and recall@k of the n-gram index when querying with the memo lines.
+
+    The recall@k is the share of true invoice-payment pairs whose invoice is among the top k invoices of the payment's
+    memo line. The `exact_token` row is the share of true pairs whose billing or assignment number occurs unchanged
+    as a token in the memo line.
+    """
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This benchmark is dataset-specific."
+    bench_cfg = cfg.benchmarks.ngram_index
+    invoices, payments, matches = load_frames(cfg)
+    identifiers = pd.concat([invoices["billing_number"], invoices["assignment_number"]]).tolist()
+    invoice_ids = np.concatenate([invoices["invoice_id"].to_numpy(), invoices["invoice_id"].to_numpy()])
+
+    true_pairs = matches.explode("invoice_ids").explode("payment_ids")
+    true_invoice_ids = true_pairs.groupby("payment_ids")["invoice_ids"].apply(set).to_dict()
+    memo_lines = payments["memo_line"].fillna("").tolist()
+    queries = [(memo_line, true_invoice_ids.get(payment_id, set()))
+               for memo_line, payment_id in zip(memo_lines, payments["payment_id"])]
+    num_true_pairs = sum(len(truth) for _, truth in queries)
+
+    results = []
+    for n in bench_cfg.ns:
+        start = time.perf_counter()
+        index = NGramIndex.build(identifiers, invoice_ids, n=n,
+                                 max_document_frequency=cfg.ngram_index.max_document_frequency)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        retrieved = index.query_many(memo_lines, max(bench_cfg.ks))
+        query_time = time.perf_counter() - start
+
+        for k in bench_cfg.ks:
+            num_found = sum(len(truth & set(docs[:k].tolist())) for (_, truth), (docs, _) in zip(queries, retrieved))
+            results.append({
+                "method": f"{n}-grams",
+                "k": k,
+                "recall": num_found / num_true_pairs,
+                "queries_per_s": len(queries) / query_time,
+                "build_s": build_time
+            })
+
+    invoice_identifiers = {invoice_id: {billing_number, assignment_number}
+                           for invoice_id, billing_number, assignment_number
+                           in zip(invoices["invoice_id"], invoices["billing_number"], invoices["assignment_number"])}
+    num_found = 0
+    for memo_line, truth in queries:
+        tokens = set(re.findall(r"[A-Za-z0-9]+", memo_line))
+        num_found += sum(len(invoice_identifiers[invoice_id] & tokens) > 0 for invoice_id in truth)
+    results.append({"method": "exact_token", "k": None, "recall": num_found / num_true_pairs,
+                    "queries_per_s": None, "build_s": None})
+
+    results = pd.DataFrame(results)
+    path = get_task_dir(cfg.task_name) / "benchmarks"
+    path.mkdir(exist_ok=True)
+    results.to_csv(path / "ngram_index.csv", index=False)
+    logger.info(f"n-gram index on {len(identifiers)} identifiers and {len(queries)} memo lines:\n"
+                f"{results.to_markdown(index=False, floatfmt='.4f')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import logging
+import re
+import time
+from copy import deepcopy
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import get_task_dir
+from lib.prompting.template import compile_chat_template
+
+logger = logging.getLogger(__name__)
+
+FIRST_TABLE_ROW = "MANDT,BURKS,GJAHR,BELNR,BZUEI,ZUONR,VBELN,KUNNR,NAME1,WAERS,WRBTR,BLDAT,ZFBDT\n" \
+                  "1,2000,2006,1000005979,1,INV100000000011268,INV10000,ZAL0239607,Aurora Digital Labs,USD," \
+                  "289620.62,20060920,20061003\n"
+SECOND_TABLE_ROW = "PARTN,AVKON,SGTXT,KWBTR,KWAER,BVDAT\n" \
+                   "ADL TECH,US53XGYW08718806659176,9628031232 INV10000000002450,158001.36,USD,20041001\n"
+
+
+########################################################################################################################
+# previous implementation as reference
+########################################################################################################################
+
+
+def reference_fill_template(template: str, **args) -> str:
+    def replace_variable(match) -> str:
+        variable = match.group(1)
+        if variable not in args.keys():
+            raise AssertionError(f"Missing value for template string variable {variable}!")
+        return args[variable]
+
+    return re.sub(r"\{\{([^{}]+)\}\}", replace_variable, template)
+
+
+def reference_fill_chat_template(template: list[dict[str, str] | str], **args) -> list[dict[str, str]]:
+    template = deepcopy(template)
+    for key, value in args.items():
+        template_key = "{{" + key + "}}"
+        if isinstance(value, list):
+            new_template = []
+            for message in template:
+                if message == template_key:
+                    new_template += value
+                else:
+                    new_template.append(message)
+            template = new_template
+    for key, value in args.items():
+        template_key = "{{" + key + "}}"
+        if isinstance(value, dict):
+            new_template = []
+            for message in template:
+                if message == template_key:
+                    new_template.append(value)
+                else:
+                    new_template.append(message)
+            template = new_template
+    for message in template:
+        if isinstance(message, str):
+            raise AssertionError(f"Missing values for template message variable {message}!")
+    str_args = {k: v for k, v in args.items() if isinstance(v, str)}
+    for message in template:
+        message["content"] = reference_fill_template(message["content"], **str_args)
+    return template
+
+
+########################################################################################################################
+# benchmark
+########################################################################################################################
+
+
+def build_prompt_reference(cfg: DictConfig) -> list[dict[str, str]]:
+    example_messages = []
+    for ground_truth in ("Yes", "No"):
+        example_messages += reference_fill_chat_template(
+            OmegaConf.to_container(cfg.example_chat_template),
+            first_table_row=FIRST_TABLE_ROW,
+            second_table_row=SECOND_TABLE_ROW,
+            ground_truth=ground_truth
+        )
+    return reference_fill_chat_template(
+        OmegaConf.to_container(cfg.prompt_chat_template),
+        examples=example_messages,
+        first_table_row=FIRST_TABLE_ROW,
+        second_table_row=SECOND_TABLE_ROW,
+        ground_truth="Yes"
+    )
+
+
+def build_prompt_compiled(prompt_chat_template, example_chat_template) -> list[dict[str, str]]:
+    example_messages = []
+    for ground_truth in ("Yes", "No"):
+        example_messages += example_chat_template.fill(
+            first_table_row=FIRST_TABLE_ROW,
+            second_table_row=SECOND_TABLE_ROW,
+            ground_truth=ground_truth
+        )
+    return prompt_chat_template.fill(
+        examples=example_messages,
+        first_table_row=FIRST_TABLE_ROW,
+        second_table_row=SECOND_TABLE_ROW,
+        ground_truth="Yes"
+    )
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    num_instances = cfg.benchmarks.num_instances
+
+    start = time.perf_counter()
+    reference = [build_prompt_reference(cfg) for _ in range(num_instances)]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prompt_chat_template = compile_chat_template(OmegaConf.to_container(cfg.prompt_chat_template))
+    example_chat_template = compile_chat_template(OmegaConf.to_container(cfg.example_chat_template))
+    compiled = [build_prompt_compiled(prompt_chat_template, example_chat_template) for _ in range(num_instances)]
+    compiled_time = time.perf_counter() - start
+
+    assert reference == compiled, "The compiled templates must produce the same prompts!"
+
+    results = pd.DataFrame([
+        {"implementation": "reference", "us_per_instance": reference_time / num_instances * 1e6},
+        {"implementation": "compiled", "us_per_instance": compiled_time / num_instances * 1e6}
+    ])
+    results["speedup"] = results["us_per_instance"].iloc[0] / results["us_per_instance"]
+    path = get_task_dir(cfg.task_name) / "benchmarks"
+    path.mkdir(exist_ok=True)
+    results.to_csv(path / "prompt_templates.csv", index=False)
+    logger.info(f"per-instance cost of building prompts:\n{results.to_markdown(index=False, floatfmt='.2f')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import logging
+import statistics
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import InstanceStore, get_instances_dir, get_task_dir
+from lib.model.generic import num_tokens
+from lib.model._openai import openai_model
+from lib.prompting.linearize import linearize_table
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """
+    Reports the disk and input-token savings of the shared tables of the instance store, e.g., KNA-1 in multi-table mode
+
+    The disk sizes compare one copy of the table per instance, as in the former per-instance directories, with the
+    single copy in the instance store. The input tokens compare the linearized whole table with the joined rows only
+    (shared_tables.joined_rows_only), for every table entry of a prompt that shows the invoice's source rows.
+    """
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    store = InstanceStore.load(instances_dir)
+    instances = [int(name) for name in store.names()][:cfg.benchmarks.linearization_modes.num_instances]
+    params = OmegaConf.to_container(cfg.linearize_table)
+    # the instance and each of its examples show their source rows
+    entries_per_prompt = 1 + 2 * cfg.sample_examples.num_examples
+
+    results = []
+    for table in store.table_names:
+        if not store.is_shared(table):
+            continue
+        key = store.table_key(table)
+        whole = store.rows(table, store.value(key, instances[0]))
+        whole_tokens = num_tokens(linearize_table(whole, table_name=None, **params), cfg.model, cfg.api_name)
+        table_bytes = (instances_dir / "tables" / f"{table}.csv").stat().st_size
+
+        joined_rows, joined_tokens, joined_bytes = [], [], []
+        for instance_idx in instances:
+            joined = store.rows(table, store.value(key, instance_idx), joined_only=True)
+            joined_rows.append(len(joined.index))
+            joined_tokens.append(num_tokens(linearize_table(joined, table_name=None, **params), cfg.model,
+                                            cfg.api_name))
+            joined_bytes.append(len(joined.to_csv(index=False).encode("utf-8")))
+
+        cost_per_1k_tokens = openai_model(cfg.model)["cost_per_1k_input_tokens"]
+        saved_tokens_per_prompt = entries_per_prompt * (whole_tokens - statistics.mean(joined_tokens))
+        results.append({
+            "schema_mode": cfg.dataset.schema_mode,
+            "table": table,
+            "num_instances": len(instances),
+            "num_rows": len(whole.index),
+            "mean_joined_rows": statistics.mean(joined_rows),
+            "per_instance_copies_bytes": table_bytes * len(store),
+            "store_bytes": table_bytes,
+            "joined_per_instance_bytes": statistics.mean(joined_bytes) * len(store),
+            "tokens_per_entry": whole_tokens,
+            "mean_joined_tokens_per_entry": statistics.mean(joined_tokens),
+            "saved_tokens_per_prompt": saved_tokens_per_prompt,
+            "saved_usd_per_1k_prompts": saved_tokens_per_prompt * cost_per_1k_tokens
+        })
+        logger.info(f"result: {results[-1]}")
+
+    if len(results) == 0:
+        logger.info(f"no shared tables in schema mode {cfg.dataset.schema_mode}")
+        return
+    results = pd.DataFrame(results)
+    path = get_task_dir(cfg.task_name) / "benchmarks"
+    path.mkdir(exist_ok=True)
+    results.to_csv(path / f"shared_tables_{cfg.dataset.schema_mode}.csv", index=False)
+    logger.info(f"shared tables ({cfg.model}, {cfg.dataset.schema_mode}):\n"
+                f"{results.to_markdown(index=False, floatfmt='.3f')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
 import collections
 import logging
+import math
+import pathlib
 
 import cattrs
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
-from lib.data import get_instances_dir, get_results_dir, get_responses_dir, load_json, dump_json
-from lib.evaluation.metrics import ConfusionMatrix, ConfusionMatrixBy
-from lib.model.generic import extract_text_from_response
+from lib.data import InstanceStore, RecordStore, get_instances_dir, get_results_dir, get_responses_dir, load_json, \
+    dump_json
+from lib.evaluation.metrics import ConfusionMatrix, ConfusionMatrixBy, precision_recall_curve
+from lib.model.generic import extract_text_from_response, extract_top_logprobs_from_response
+from lib.stage_cache import open_stage
 
 logger = logging.getLogger(__name__)
 
@@ -26,66 +30,85 @@ def get_ground_truth_boolean(response: str) -> bool | None:
         return None
 
 
-@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
-def main(cfg: DictConfig) -> None:
-    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
-    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
-    results_dir = get_results_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
-
-    errors = collections.Counter()
-    confusion = ConfusionMatrix.empty()
-    confusion_by_match = ConfusionMatrixBy.empty(("match_category", "clean_or_dirty"))
-    confusion_by_perturbation = ConfusionMatrixBy.empty(("perturbation_category",))
-    for instance_dir in list(sorted(instances_dir.glob("*/"))):
-        ground_truth = load_json(instance_dir / "ground_truth.json")
-        response = load_json(responses_dir / f"{instance_dir.name}.json")
-
-        text_completion = extract_text_from_response(response)
-
-        if text_completion is None:
-            logger.warning(f"evaluation on failed API request ==> skip")
-            errors["api_request_failed"] += 1
-            continue
-
-        prediction = get_ground_truth_boolean(text_completion)
+def get_yes_probability(top_logprobs: dict[str, float]) -> float | None:
+    """Compute the probability of "Yes" relative to "No" from the log probabilities of the first generated token.
 
-        if prediction is None:
-            logger.warning(f"Parsing yes/no response '{prediction}' failed! ==> Interpret as incorrect.")
-            errors["parse_yes_no_failed"] += 1
-            prediction = not ground_truth["rows_match"]  # set prediction to opposite of ground truth
+    Args:
+        top_logprobs: Mapping from candidate token to log probability.
 
-        confusion.push(prediction=prediction, ground_truth=ground_truth["rows_match"])
-
-        if cfg.dataset.dataset_name == "pay_to_inv":
-            clean_or_dirty = "clean" if ground_truth["perturbation_categories"] == [] else "dirty"
-            confusion_by_match.push(
+    Returns:
+        The probability of "Yes" or None if neither "Yes" nor "No" is among the candidate tokens.
+    """
+    p_yes, p_no = 0.0, 0.0
+    for token, logprob in top_logprobs.items():
+        if token.strip().lower() == "yes":
+            p_yes += math.exp(logprob)
+        elif token.strip().lower() == "no":
+            p_no += math.exp(logprob)
+    if p_yes + p_no == 0:
+        return None
+    return p_yes / (p_yes + p_no)
+
+
+def push_prediction(
+        prediction: bool,
+        rows_match: bool,
+        ground_truth: dict,
+        confusion: ConfusionMatrix,
+        confusion_by_match: ConfusionMatrixBy,
+        confusion_by_perturbation: ConfusionMatrixBy,
+        cfg: DictConfig
+) -> None:
+    """Push the prediction for a pair of rows into the confusion matrix and its breakdowns.
+
+    Args:
+        prediction: Whether the rows were predicted to match.
+        rows_match: Whether the rows actually match.
+        ground_truth: The ground truth of the instance, which provides the match and perturbation categories.
+        confusion: The overall confusion matrix.
+        confusion_by_match: The confusion matrices by match category and whether the match is clean or dirty.
+        confusion_by_perturbation: The confusion matrices by perturbation category.
+        cfg: The configuration.
+    """
+    confusion.push(prediction=prediction, ground_truth=rows_match)
+
+    if cfg.dataset.dataset_name == "pay_to_inv":
+        clean_or_dirty = "clean" if ground_truth["perturbation_categories"] == [] else "dirty"
+        confusion_by_match.push(
+            {
+                "match_category": ground_truth["match_category"],
+                "clean_or_dirty": clean_or_dirty
+            },
+            prediction,
+            rows_match
+        )
+        if ground_truth["perturbation_categories"] == []:
+            confusion_by_perturbation.push(
                 {
-                    "match_category": ground_truth["match_category"],
-                    "clean_or_dirty": clean_or_dirty
+                    "perturbation_category": "clean"
                 },
                 prediction,
-                ground_truth["rows_match"]
+                rows_match
             )
-            if ground_truth["perturbation_categories"] == []:
+        else:
+            for perturbation_category in ground_truth["perturbation_categories"]:
                 confusion_by_perturbation.push(
                     {
-                        "perturbation_category": "clean"
+                        "perturbation_category": perturbation_category
                     },
                     prediction,
-                    ground_truth["rows_match"]
+                    rows_match
                 )
-            else:
-                for perturbation_category in ground_truth["perturbation_categories"]:
-                    confusion_by_perturbation.push(
-                        {
-                            "perturbation_category": perturbation_category
-                        },
-                        prediction,
-                        ground_truth["rows_match"]
-                    )
 
-    logger.info(f"errors: {errors}")
 
+def dump_results(
+        confusion: ConfusionMatrix,
+        confusion_by_match: ConfusionMatrixBy,
+        confusion_by_perturbation: ConfusionMatrixBy,
+        errors: collections.Counter,
+        results_dir: pathlib.Path
+) -> None:
+    """Save the confusion matrix, its breakdowns, and the errors to the results directory."""
     dump_json(cattrs.unstructure(confusion), results_dir / "confusion.json")
 
     confusion_by_match_category = {}
@@ -117,5 +140,92 @@ def main(cfg: DictConfig) -> None:
     dump_json(dict(errors), results_dir / "errors.json")
 
 
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    stage = open_stage("evaluate", get_results_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name), {
+        "instances": instances_dir,
+        "rule_decisions": instances_dir / "rule_decisions.json" if cfg.prematch.enabled else None,
+        "responses": responses_dir
+    }, OmegaConf.to_container(cfg, resolve=True))
+    if stage is not None and stage.restore():
+        return
+    results_dir = get_results_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    errors = collections.Counter()
+    confusion = ConfusionMatrix.empty()
+    confusion_by_match = ConfusionMatrixBy.empty(("match_category", "clean_or_dirty"))
+    confusion_by_perturbation = ConfusionMatrixBy.empty(("perturbation_category",))
+    scores = []  # probabilities of "Yes" for single-token yes/no requests
+    rule_decisions = load_json(instances_dir / "rule_decisions.json") if cfg.prematch.enabled else {}
+    confusion_by_rule = collections.defaultdict(ConfusionMatrix.empty)
+    store = InstanceStore.load(instances_dir)
+    responses = RecordStore.load(responses_dir)
+    for name in store.names():
+        ground_truth = store.instance(int(name))
+
+        # instances decided by the pre-matching rules have no response
+        if name in rule_decisions.keys():
+            rule_decision = rule_decisions[name]
+            confusion_by_rule[rule_decision["rule"]].push(rule_decision["prediction"], ground_truth["rows_match"])
+            push_prediction(rule_decision["prediction"], ground_truth["rows_match"], ground_truth, confusion,
+                            confusion_by_match, confusion_by_perturbation, cfg)
+            continue
+
+        response = responses.get(f"{name}.json")
+
+        text_completion = extract_text_from_response(response)
+
+        if text_completion is None:
+            logger.warning(f"evaluation on failed API request ==> skip")
+            errors["api_request_failed"] += 1
+            continue
+
+        prediction = get_ground_truth_boolean(text_completion)
+
+        top_logprobs = extract_top_logprobs_from_response(response)
+        score = None if top_logprobs is None else get_yes_probability(top_logprobs)
+        if score is not None:
+            scores.append({"instance": name, "score": score, "rows_match": ground_truth["rows_match"]})
+
+        if prediction is None:
+            logger.warning(f"Parsing yes/no response '{prediction}' failed! ==> Interpret as incorrect.")
+            errors["parse_yes_no_failed"] += 1
+            prediction = not ground_truth["rows_match"]  # set prediction to opposite of ground truth
+
+        push_prediction(prediction, ground_truth["rows_match"], ground_truth, confusion, confusion_by_match,
+                        confusion_by_perturbation, cfg)
+
+    logger.info(f"errors: {errors}")
+
+    dump_results(confusion, confusion_by_match, confusion_by_perturbation, errors, results_dir)
+
+    if cfg.prematch.enabled:
+        num_decided = sum(c.total for c in confusion_by_rule.values())
+        accuracy_by_rule = {rule: (c.TP + c.TN) / c.total for rule, c in confusion_by_rule.items()}
+        dump_json({
+            "num_instances": len(store),
+            "num_decided": num_decided,
+            "coverage": num_decided / len(store),
+            "api_calls_saved": num_decided,
+            "rules": {rule: {"num_decided": c.total, "accuracy": accuracy_by_rule[rule], **cattrs.unstructure(c)}
+                      for rule, c in confusion_by_rule.items()}
+        }, results_dir / "prematch.json")
+        logger.info(f"pre-matching decided {num_decided} of {len(store)} instances, accuracy by rule: "
+                    f"{accuracy_by_rule}")
+
+    if len(scores) > 0:
+        dump_json(scores, results_dir / "scores.json")
+        curve = precision_recall_curve([s["score"] for s in scores], [s["rows_match"] for s in scores])
+        dump_json(curve, results_dir / "precision_recall_curve.json")
+        best = max(curve, key=lambda x: x["f1_score"])
+        logger.info(f"scores for {len(scores)} instances, best F1 score {best['f1_score']:.3f} at threshold "
+                    f"{best['threshold']:.3f}")
+
+    if stage is not None:
+        stage.save()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+import collections
+import logging
+
+import hydra
+from omegaconf import DictConfig
+
+from lib.data import InstanceStore, RecordStore, get_instances_dir, get_results_dir, get_responses_dir, dump_json
+from lib.evaluation.metrics import ConfusionMatrix, ConfusionMatrixBy
+from lib.model.generic import extract_text_from_response
+from lib.prompting.listwise import parse_candidate_answer
+from scripts.entity_matching.evaluate import push_prediction, dump_results
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """Evaluate the listwise responses with one pairwise decision per candidate.
+
+    The results have the same format as those of evaluate.py. In addition, list_accuracy.json contains the share of
+    payments for which exactly the matching candidates were chosen.
+    """
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    results_dir = get_results_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    errors = collections.Counter()
+    confusion = ConfusionMatrix.empty()
+    confusion_by_match = ConfusionMatrixBy.empty(("match_category", "clean_or_dirty"))
+    confusion_by_perturbation = ConfusionMatrixBy.empty(("perturbation_category",))
+    num_lists, num_correct_lists = 0, 0
+    store = InstanceStore.load(instances_dir)
+    responses = RecordStore.load(responses_dir)
+    for name in store.names():
+        ground_truth = store.instance(int(name))
+        response = responses.get(f"{name}.json")
+        candidates_match = ground_truth["candidates_match"]
+
+        text_completion = extract_text_from_response(response)
+
+        if text_completion is None:
+            logger.warning(f"evaluation on failed API request ==> skip")
+            errors["api_request_failed"] += 1
+            continue
+
+        predictions = parse_candidate_answer(text_completion, len(candidates_match))
+
+        if predictions is None:
+            logger.warning(f"Parsing candidates response '{text_completion}' failed! ==> Interpret as incorrect.")
+            errors["parse_candidates_failed"] += 1
+            predictions = [not match for match in candidates_match]  # set predictions to opposite of ground truth
+
+        for prediction, rows_match in zip(predictions, candidates_match):
+            push_prediction(prediction, rows_match, ground_truth, confusion, confusion_by_match,
+                            confusion_by_perturbation, cfg)
+
+        num_lists += 1
+        num_correct_lists += predictions == candidates_match
+
+    logger.info(f"errors: {errors}")
+    logger.info(f"list accuracy: {num_correct_lists} of {num_lists}")
+
+    dump_results(confusion, confusion_by_match, confusion_by_perturbation, errors, results_dir)
+    dump_json({"num_lists": num_lists, "num_correct_lists": num_correct_lists}, results_dir / "list_accuracy.json")
+
+
+if __name__ == "__main__":
+    main()
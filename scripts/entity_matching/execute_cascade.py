@@ -0,0 +1,121 @@
+import logging
+import time
+
+import hydra
+from omegaconf import DictConfig
+
+from lib.data import get_requests_dir, get_responses_dir, dump_json, dump_records
+from lib.model.generic import REQUEST_SEED, execute_requests, extract_top_logprobs_from_response, max_request_cost, \
+    response_cost, single_token_logit_bias
+from lib.prompting.compact import load_requests
+from scripts.entity_matching.evaluate import get_yes_probability
+from scripts.entity_matching.prepare_requests import get_ground_truth_string
+
+logger = logging.getLogger(__name__)
+
+
+def request_for_model(request: dict, model: str, cfg: DictConfig) -> dict:
+    """Adapt the single-token yes/no request to the given model, whose tokenizer may differ."""
+    if not request.get("logprobs"):
+        raise AssertionError("The cascade requires requests prepared with single_token_yes_no.enabled=true!")
+    request = {**request, "model": model, "seed": REQUEST_SEED}
+    if "logit_bias" in request.keys():
+        request["logit_bias"] = single_token_logit_bias(
+            [get_ground_truth_string(True), get_ground_truth_string(False)], model, cfg.api_name)
+    return request
+
+
+def confidence_of_response(response: dict) -> float:
+    """Probability of the more likely answer, or zero if the request failed or has no log probabilities."""
+    top_logprobs = extract_top_logprobs_from_response(response)
+    p_yes = None if top_logprobs is None else get_yes_probability(top_logprobs)
+    return 0.0 if p_yes is None else max(p_yes, 1 - p_yes)
+
+
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    # we need to remember the names since sorting paths is not numerical
+    request_names, requests = load_requests(requests_dir)
+
+    model_requests = {model: [request_for_model(request, model, cfg) for request in requests]
+                      for model in cfg.cascade.models}
+    # the worst-case cost only orders the models, the report compares actual costs
+    model_costs = {model: sum(max_request_cost(request, cfg.api_name) for request in model_requests[model])
+                   for model in cfg.cascade.models}
+    models = sorted(cfg.cascade.models, key=lambda m: model_costs[m])
+
+    stages = []
+    accepted_responses = {}
+    remaining = list(range(len(requests)))
+    for stage, model in enumerate(models):
+        is_last = stage == len(models) - 1
+        logger.info(f"cascade stage {stage}: execute {len(remaining)} requests with {model}")
+        start = time.time()
+        responses = execute_requests([model_requests[model][ix] for ix in remaining], cfg.api_name)
+        duration = time.time() - start
+
+        escalated = []
+        cost = 0.0
+        for ix, response in zip(remaining, responses):
+            cost += response_cost(response, cfg.api_name)
+            confidence = confidence_of_response(response)
+            if confidence >= cfg.cascade.threshold or is_last:
+                response["cascade"] = {"stage": stage, "model": model, "confidence": confidence}
+                accepted_responses[request_names[ix]] = response
+            else:
+                escalated.append(ix)
+
+        stages.append({
+            "model": model,
+            "num_requests": len(remaining),
+            "num_accepted": len(remaining) - len(escalated),
+            "cost": cost,
+            "time_s": duration
+        })
+        remaining = escalated
+        if len(remaining) == 0:
+            break
+
+    dump_records(accepted_responses, responses_dir,
+                 cfg.segment_storage.records_per_segment if cfg.segment_storage.enabled else None)
+
+    # compare with executing the requests of all instances with the most expensive model
+    reference_model = models[-1]
+    cost = sum(s["cost"] for s in stages)
+    time_s = sum(s["time_s"] for s in stages)
+    reference_stage = stages[-1] if stages[-1]["model"] == reference_model else None
+    reference_cost, reference_time_s = None, None  # estimated per request from the reference model's stage
+    if reference_stage is not None and reference_stage["num_requests"] > 0:
+        reference_cost = reference_stage["cost"] / reference_stage["num_requests"] * len(requests)
+        reference_time_s = reference_stage["time_s"] / reference_stage["num_requests"] * len(requests)
+    report = {
+        "threshold": cfg.cascade.threshold,
+        "num_instances": len(requests),
+        "stages": stages,
+        "cost": cost,
+        "time_s": time_s,
+        "reference_model": reference_model,
+        "reference_cost": reference_cost,
+        "reference_time_s": reference_time_s,
+        "cost_saved": None if reference_cost is None else reference_cost - cost,
+        "reference_requests_saved": len(requests) - (0 if reference_stage is None else reference_stage["num_requests"])
+    }
+    cascade_dir = responses_dir / "cascade"
+    cascade_dir.mkdir()
+    dump_json(report, cascade_dir / "report.json")
+
+    for stage in stages:
+        logger.info(f"{stage['model']}: {stage['num_accepted']} of {stage['num_requests']} accepted, "
+                    f"${stage['cost']:.4f}, {stage['time_s']:.1f}s")
+    logger.info(f"cascade: ${cost:.4f}, {time_s:.1f}s, {report['reference_requests_saved']} of {len(requests)} "
+                f"{reference_model} requests saved")
+    if reference_cost is not None:
+        logger.info(f"cascade: ${cost:.4f} vs. an estimated ${reference_cost:.4f} and {time_s:.1f}s vs. an estimated "
+                    f"{reference_time_s:.1f}s for {reference_model} on all instances")
+
+
+if __name__ == "__main__":
+    main()
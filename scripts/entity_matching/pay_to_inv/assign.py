@@ -0,0 +1,129 @@
+import logging
+import time
+
+import cattrs
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from lib.assignment import solve_assignment
+from lib.data import InstanceStore, RecordStore, get_instances_dir, get_responses_dir, get_results_dir, load_json, \
+    dump_json
+from lib.evaluation.metrics import ConfusionMatrix
+from lib.model.generic import extract_text_from_response, extract_top_logprobs_from_response
+from scripts.entity_matching.evaluate import get_ground_truth_boolean, get_yes_probability
+from scripts.entity_matching.pay_to_inv.block import load_frames, max_deductions
+
+logger = logging.getLogger(__name__)
+
+
+def load_pair_scores(cfg: DictConfig) -> pd.DataFrame:
+    """
+    Loads the invoice id, payment id, ground truth, prediction, and score of each instance
+
+    The prediction is the one that evaluate.py counts: the decision of the pre-matching rules or the parsed response,
+    the opposite of the ground truth for unparsable responses, and None for failed requests, which it skips. The score
+    is the probability of "Yes" for single-token yes/no responses and otherwise 1 for "Yes" and 0 for "No". Instances
+    decided by the pre-matching rules get the score of their decision, failed requests a score of 0.
+    """
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    rule_decisions = load_json(instances_dir / "rule_decisions.json") if cfg.prematch.enabled else {}
+
+    store = InstanceStore.load(instances_dir)
+    responses = RecordStore.load(responses_dir)
+    rows = []
+    for name in store.names():
+        ground_truth = store.instance(int(name))
+        if name in rule_decisions.keys():
+            prediction = rule_decisions[name]["prediction"]
+            score = float(prediction)
+        else:
+            response = responses.get(f"{name}.json")
+            text_completion = extract_text_from_response(response)
+            prediction = None if text_completion is None else get_ground_truth_boolean(text_completion)
+            top_logprobs = extract_top_logprobs_from_response(response)
+            score = None if top_logprobs is None else get_yes_probability(top_logprobs)
+            if score is None:
+                score = float(prediction is True)
+            if text_completion is not None and prediction is None:
+                prediction = not ground_truth["rows_match"]  # as evaluate.py counts it
+        rows.append({
+            "instance": name,
+            "invoice_id": ground_truth["invoice_id"],
+            "payment_id": ground_truth["payment_id"],
+            "rows_match": ground_truth["rows_match"],
+            "prediction": prediction,
+            "score": score
+        })
+    return pd.DataFrame(rows, columns=["instance", "invoice_id", "payment_id", "rows_match", "prediction", "score"])
+
+
+def _confusion(predictions: np.ndarray, ground_truths: np.ndarray) -> ConfusionMatrix:
+    confusion = ConfusionMatrix.empty()
+    for prediction, ground_truth in zip(predictions, ground_truths):
+        confusion.push(bool(prediction), bool(ground_truth))
+    return confusion
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """
+    Resolves contradicting pairwise decisions with a global assignment of payments to invoices
+
+    The results contain the precision, recall, and F1 score of the pairwise decisions and of the assignment, over the
+    instances that evaluate.py counts.
+    """
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    results_dir = get_results_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+
+    instances = load_pair_scores(cfg)
+    invoices, payments, _ = load_frames(cfg)
+    # the same pair can be sampled more than once, its instances share one decision with their mean score
+    pairs = instances.groupby(["invoice_id", "payment_id"], sort=False, as_index=False)["score"].mean()
+    inv_ix = pd.Index(invoices["invoice_id"]).get_indexer(pairs["invoice_id"])
+    pay_ix = pd.Index(payments["payment_id"]).get_indexer(pairs["payment_id"])
+
+    start = time.time()
+    selected = solve_assignment(
+        inv_ix,
+        pay_ix,
+        pairs["score"].to_numpy(),
+        invoices["amount"].to_numpy(),
+        payments["amount"].to_numpy(),
+        max_deductions(payments, cfg),
+        threshold=cfg.assignment.threshold,
+        max_component_size=cfg.assignment.max_component_size,
+        max_nodes=cfg.subset_sum.max_nodes
+    )
+    duration = time.time() - start
+    instances = instances.merge(pairs[["invoice_id", "payment_id"]].assign(selected=selected),
+                                on=["invoice_id", "payment_id"], how="left")
+
+    # the instances that evaluate.py counts, i.e., without failed requests
+    evaluated = instances[instances["prediction"].notna()]
+    ground_truths = evaluated["rows_match"].to_numpy()
+    pairwise = _confusion(evaluated["prediction"].to_numpy(), ground_truths)
+    assigned = _confusion(evaluated["selected"].to_numpy(), ground_truths)
+    dump_json({
+        "num_instances": len(evaluated.index),
+        "num_pairs": len(pairs.index),
+        "num_changed": int((evaluated["prediction"].to_numpy(dtype=bool) != evaluated["selected"].to_numpy()).sum()),
+        "time_s": duration,
+        "pairwise": {"precision": pairwise.precision, "recall": pairwise.recall, "f1_score": pairwise.f1_score,
+                     **cattrs.unstructure(pairwise)},
+        "assignment": {"precision": assigned.precision, "recall": assigned.recall, "f1_score": assigned.f1_score,
+                       **cattrs.unstructure(assigned)}
+    }, results_dir / "assignment.json")
+    dump_json({instance: bool(s) for instance, s in zip(instances["instance"], instances["selected"])},
+              results_dir / "assignment_predictions.json")
+
+    logger.info(f"pairwise: precision {pairwise.precision:.4f}, recall {pairwise.recall:.4f}, "
+                f"F1 score {pairwise.f1_score:.4f}")
+    logger.info(f"assignment: precision {assigned.precision:.4f}, recall {assigned.recall:.4f}, "
+                f"F1 score {assigned.f1_score:.4f} ({duration:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
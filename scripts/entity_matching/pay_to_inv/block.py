@@ -0,0 +1,354 @@
+import collections
+import json
+import logging
+import pathlib
+import time
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from lib.blocking import encode_keys, range_join, union_pairs, pair_completeness, reduction_ratio
+from lib.data import get_download_dir, get_blocking_dir, dump_json
+from lib.ngram_index import NGramIndex
+from scripts.entity_matching.pay_to_inv.preprocess import load_tables
+
+logger = logging.getLogger(__name__)
+
+_IDENTIFIER_PATTERN = r"[A-Za-z0-9]+"
+
+# columns of the invoices and payments frames and the attributes they come from
+_INV_COLUMNS = {
+    "customer_id": "inv_customer_id",
+    "customer_name": "inv_customer_name",
+    "billing_number": "inv_billing_number",
+    "assignment_number": "inv_assignment_number",
+    "currency": "inv_currency_code",
+    "amount": "inv_amount",
+    "date": "inv_document_date"
+}
+_PAY_COLUMNS = {
+    "business_partner": "pay_business_partner",
+    "account_number": "pay_account_number",
+    "memo_line": "pay_memo_line",
+    "currency": "pay_currency",
+    "amount": "pay_amount",
+    "date": "pay_posting_date"
+}
+
+
+def _column_names(columns: dict[str, str], attributes: DictConfig, cfg: DictConfig) -> dict[str, str]:
+    key = "descriptive_name" if cfg.dataset.schema_mode == "descriptive" else "opaque_name"
+    return {column: attributes[attribute][key] for column, attribute in columns.items()}
+
+
+def _parse_ids(ids: pd.Series) -> pd.Series:
+    # the multi-table tables store lists of ids, the other tables single ids
+    ids = ids.apply(lambda x: json.loads(x) if isinstance(x, str) else x)
+    return ids.apply(lambda x: x if isinstance(x, list) else [x])
+
+
+def _to_days(dates: pd.Series) -> np.ndarray:
+    return (pd.to_datetime(dates, format="%Y%m%d", errors="coerce") - pd.Timestamp(0)).dt.days.to_numpy()
+
+
+def _to_cents(amounts: pd.Series) -> np.ndarray:
+    return (pd.to_numeric(amounts, errors="coerce") * 100).round().to_numpy()
+
+
+def _normalize_name(names: pd.Series) -> pd.Series:
+    return names.str.lower().str.replace(r"[^a-z0-9]", "", regex=True).replace("", None)
+
+
+def load_frames(cfg: DictConfig) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Loads one row per invoice and per payment with the columns that the blocking passes need
+
+    The dates are days since the epoch and the amounts are cents, both as floats that are NaN for missing values
+    """
+    download_dir = get_download_dir(cfg.task_name, cfg.dataset.dataset_name)
+    # read everything as strings to keep identifiers like billing numbers exactly as they are
+    invoices_tables, payments, matches = load_tables(cfg, download_dir, dtype=str)
+
+    inv_names = _column_names(_INV_COLUMNS, cfg.dataset.inv_attributes, cfg)
+    invoices = None
+    for table in invoices_tables:
+        table = table.assign(invoice_id=_parse_ids(table["invoice_id"])).explode("invoice_id")
+        taken = [] if invoices is None else list(invoices.columns)
+        table = table[["invoice_id"] + [n for n in inv_names.values() if n in table.columns and n not in taken]]
+        invoices = table if invoices is None else invoices.merge(table, on="invoice_id", how="left")
+    invoices = invoices.drop_duplicates("invoice_id").rename(columns={n: c for c, n in inv_names.items()})
+    invoices = invoices.astype({"invoice_id": int}).sort_values("invoice_id").reset_index(drop=True)
+    invoices["date"] = _to_days(invoices["date"])
+    invoices["amount"] = _to_cents(invoices["amount"])
+
+    pay_names = _column_names(_PAY_COLUMNS, cfg.dataset.pay_attributes, cfg)
+    payments = payments.assign(payment_id=_parse_ids(payments["payment_id"]).str[0])
+    payments = payments[["payment_id"] + list(pay_names.values())].rename(columns={n: c for c, n in pay_names.items()})
+    payments = payments.astype({"payment_id": int}).sort_values("payment_id").reset_index(drop=True)
+    payments["date"] = _to_days(payments["date"])
+    payments["amount"] = _to_cents(payments["amount"])
+
+    matches = matches.assign(invoice_ids=matches["invoice_ids"].apply(json.loads),
+                             payment_ids=matches["payment_ids"].apply(json.loads),
+                             perturbation_categories=matches["perturbation_categories"].apply(json.loads))
+    return invoices, payments, matches
+
+
+def _date_window(payments: pd.DataFrame, rows: np.ndarray, cfg: DictConfig) -> tuple[np.ndarray, np.ndarray]:
+    # invoices whose document date is up to max_days_since_document_date before the posting date
+    dates = np.nan_to_num(payments["date"].to_numpy()[rows], nan=-1).astype(np.int64)
+    return dates - cfg.blocking.max_days_since_document_date, dates
+
+
+def _key_join(
+        invoices: pd.DataFrame,
+        inv_keys: pd.Series,
+        payments: pd.DataFrame,
+        pay_keys: pd.Series,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # join on equal keys within the date window, the indices of the key series are the row indices of the frames
+    inv_codes, pay_codes = encode_keys(inv_keys, pay_keys)
+    inv_rows, pay_rows = inv_keys.index.to_numpy(), pay_keys.index.to_numpy()
+    inv_dates = invoices["date"].to_numpy()[inv_rows]
+    inv_codes[np.isnan(inv_dates)] = -1
+    lows, highs = _date_window(payments, pay_rows, cfg)
+    left, right = range_join(inv_codes, np.nan_to_num(inv_dates).astype(np.int64), pay_codes, lows, highs)
+    return inv_rows[left], pay_rows[right]
+
+
+def _pass_identifier(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # billing and assignment numbers that occur as tokens in the memo line
+    min_length = cfg.blocking.min_identifier_length
+    inv_identifiers = pd.concat([invoices["billing_number"], invoices["assignment_number"]]).dropna()
+    inv_identifiers = inv_identifiers[inv_identifiers.str.len() >= min_length]
+    tokens = payments["memo_line"].str.findall(_IDENTIFIER_PATTERN).explode().dropna()
+    tokens = tokens[tokens.str.len() >= min_length]
+    return _key_join(invoices, inv_identifiers, payments, tokens, cfg)
+
+
+def build_identifier_index(invoices: pd.DataFrame, cfg: DictConfig) -> NGramIndex:
+    """
+    Builds the n-gram index over the billing and assignment numbers, whose documents are the invoice row indices
+    """
+    return NGramIndex.build(
+        pd.concat([invoices["billing_number"], invoices["assignment_number"]]).tolist(),
+        np.concatenate([invoices.index.to_numpy(), invoices.index.to_numpy()]),
+        n=cfg.ngram_index.n,
+        max_document_frequency=cfg.ngram_index.max_document_frequency
+    )
+
+
+def _pass_identifier_ngrams(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # the top-k invoices whose billing or assignment numbers best match the memo line, even if they are perturbed
+    index = build_identifier_index(invoices, cfg)
+    results = index.query_many(payments["memo_line"].tolist(), cfg.ngram_index.k, cfg.ngram_index.min_score)
+    inv_ix = np.concatenate([docs for docs, _ in results]) if len(results) > 0 else np.empty(0, dtype=np.int64)
+    pay_ix = np.repeat(payments.index.to_numpy(), [len(docs) for docs, _ in results])
+    return inv_ix.astype(np.int64), pay_ix
+
+
+def _pass_business_partner(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # business partner equal to the customer name up to case, spaces, and punctuation
+    inv_names = _normalize_name(invoices["customer_name"]).dropna()
+    pay_names = _normalize_name(payments["business_partner"]).dropna()
+    return _key_join(invoices, inv_names, payments, pay_names, cfg)
+
+
+def max_deductions(payments: pd.DataFrame, cfg: DictConfig) -> np.ndarray:
+    """
+    Computes the largest small deduction in cents for each payment's currency, zero for unknown currencies
+    """
+    usd_to_currency = cfg.dataset.inv_attributes.inv_amount.gen.usd_to_currency
+    rates = payments["currency"].map(dict(usd_to_currency)).fillna(0).to_numpy()
+    return np.ceil(cfg.blocking.max_deduction_usd * rates * 100).astype(np.int64)
+
+
+def _pass_amount(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # same currency and an invoice amount that is at most a small deduction above the payment amount
+    inv_codes, pay_codes = encode_keys(invoices["currency"], payments["currency"])
+    inv_amounts, pay_amounts = invoices["amount"].to_numpy(), payments["amount"].to_numpy()
+    inv_codes[np.isnan(inv_amounts)] = -1
+    pay_codes[np.isnan(pay_amounts)] = -1
+    pay_amounts = np.nan_to_num(pay_amounts).astype(np.int64)
+    return range_join(inv_codes, np.nan_to_num(inv_amounts).astype(np.int64),
+                      pay_codes, pay_amounts, pay_amounts + max_deductions(payments, cfg))
+
+
+def _pass_account_history(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    # customers that earlier payments from the same account number belong to
+    history = history.explode("invoice_ids").explode("payment_ids")
+    pay_rows = pd.Index(payments["payment_id"]).get_indexer(history["payment_ids"])
+    inv_rows = pd.Index(invoices["invoice_id"]).get_indexer(history["invoice_ids"])
+    known = pd.DataFrame({
+        "account_number": payments["account_number"].to_numpy()[pay_rows],
+        "customer_id": invoices["customer_id"].to_numpy()[inv_rows]
+    }).dropna().drop_duplicates()
+    pay_customers = payments[["account_number"]].reset_index().merge(known, on="account_number")
+    pay_customers = pay_customers.set_index("index")["customer_id"]
+    return _key_join(invoices, invoices["customer_id"].dropna(), payments, pay_customers, cfg)
+
+
+def split_history(matches: pd.DataFrame, cfg: DictConfig) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Splits the matches into the history, whose account numbers are known, and the matches that evaluate the blocking
+    """
+    is_history = np.random.default_rng(cfg.blocking.account_history.seed).random(len(matches.index))
+    is_history = is_history < cfg.blocking.account_history.fraction
+    return matches[is_history], matches[~is_history]
+
+
+# pass name ==> function that computes the invoice and payment row indices of the pass's candidate pairs
+PASSES = {
+    "identifier": _pass_identifier,
+    "identifier_ngrams": _pass_identifier_ngrams,
+    "business_partner": _pass_business_partner,
+    "amount": _pass_amount,
+    "account_history": _pass_account_history
+}
+
+
+def filter_pairs(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        pairs: tuple[np.ndarray, np.ndarray],
+        cfg: DictConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the pairs with the same currency whose posting date is in the window after the document date
+    """
+    inv_ix, pay_ix = pairs
+    inv_codes, pay_codes = encode_keys(invoices["currency"], payments["currency"])
+    days = payments["date"].to_numpy()[pay_ix] - invoices["date"].to_numpy()[inv_ix]
+    keep = (inv_codes[inv_ix] == pay_codes[pay_ix]) & (inv_codes[inv_ix] >= 0)
+    keep &= (days >= 0) & (days <= cfg.blocking.max_days_since_document_date)
+    return inv_ix[keep], pay_ix[keep]
+
+
+def load_candidates(blocking_dir: pathlib.Path) -> pd.DataFrame:
+    """
+    Loads the invoice and payment ids of the candidate pairs that block.py saved in the blocking directory
+    """
+    if not (blocking_dir / "candidates.npz").is_file():
+        raise AssertionError(f"Missing the candidates of block.py in {blocking_dir}!")
+    with np.load(blocking_dir / "candidates.npz") as file:
+        return pd.DataFrame({"invoice_id": file["invoice_id"], "payment_id": file["payment_id"]})
+
+
+def block(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        history: pd.DataFrame,
+        cfg: DictConfig
+) -> tuple[tuple[np.ndarray, np.ndarray], dict[str, tuple[np.ndarray, np.ndarray]]]:
+    """
+    Computes the union of the candidate pairs of the configured passes
+
+    Returns the invoice and payment row indices of the candidate pairs and of each pass's filtered candidate pairs
+    """
+    pass_pairs = {}
+    for name in cfg.blocking.passes:
+        if name not in PASSES.keys():
+            raise AssertionError(f"Unknown blocking pass `{name}`!")
+        start = time.time()
+        pass_pairs[name] = filter_pairs(invoices, payments, PASSES[name](invoices, payments, history, cfg), cfg)
+        logger.info(f"blocking pass `{name}`: {len(pass_pairs[name][0])} pairs in {time.time() - start:.2f}s")
+    return union_pairs(list(pass_pairs.values()), len(payments.index)), pass_pairs
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """
+    Selects candidate pairs from all invoices and payments with cheap blocking passes and reports their pair
+    completeness (the share of true pairs that are candidates) and reduction ratio (the share of all pairs that are not)
+    """
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    blocking_dir = get_blocking_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    start = time.time()
+    invoices, payments, matches = load_frames(cfg)
+    load_time_s = time.time() - start
+    logger.info(f"loaded {len(invoices.index)} invoices and {len(payments.index)} payments in {load_time_s:.2f}s")
+
+    history, evaluation = split_history(matches, cfg)
+
+    start = time.time()
+    candidates, pass_pairs = block(invoices, payments, history, cfg)
+    block_time_s = time.time() - start
+
+    true_pairs = evaluation.explode("invoice_ids").explode("payment_ids")
+    true_ix = (pd.Index(invoices["invoice_id"]).get_indexer(true_pairs["invoice_ids"]),
+               pd.Index(payments["payment_id"]).get_indexer(true_pairs["payment_ids"]))
+    num_pairs = len(invoices.index) * len(payments.index)
+    found = pair_completeness(candidates, true_ix, len(payments.index))
+
+    def by(categories: pd.Series) -> dict:
+        res = collections.defaultdict(lambda: [0, 0])
+        for category_list, is_found in zip(categories, found):
+            for category in category_list:
+                res[category][0] += int(is_found)
+                res[category][1] += 1
+        return {category: {"num_true_pairs": total, "pair_completeness": num_found / total}
+                for category, (num_found, total) in sorted(res.items())}
+
+    pairs_per_payment = np.bincount(candidates[1], minlength=len(payments.index))
+    report = {
+        "num_invoices": len(invoices.index),
+        "num_payments": len(payments.index),
+        "num_pairs": num_pairs,
+        "num_candidates": len(candidates[0]),
+        "num_true_pairs": len(found),
+        "pair_completeness": float(found.mean()) if len(found) > 0 else None,
+        "reduction_ratio": reduction_ratio(len(candidates[0]), len(invoices.index), len(payments.index)),
+        "mean_candidates_per_payment": float(pairs_per_payment.mean()),
+        "max_candidates_per_payment": int(pairs_per_payment.max()),
+        "passes": {
+            name: {
+                "num_candidates": len(pairs[0]),
+                "pair_completeness": float(pair_completeness(pairs, true_ix, len(payments.index)).mean())
+            } for name, pairs in pass_pairs.items()
+        },
+        "by_match_category": by(true_pairs["match_category"].apply(lambda x: [x])),
+        "by_perturbation_category": by(true_pairs["perturbation_categories"].apply(lambda x: x or ["clean"])),
+        "num_history_matches": len(history.index),
+        "load_time_s": load_time_s,
+        "block_time_s": block_time_s
+    }
+    dump_json(report, blocking_dir / "blocking.json")
+    np.savez_compressed(blocking_dir / "candidates.npz",
+                        invoice_id=invoices["invoice_id"].to_numpy()[candidates[0]],
+                        payment_id=payments["payment_id"].to_numpy()[candidates[1]])
+
+    logger.info(f"{report['num_candidates']} candidates of {num_pairs} pairs: "
+                f"pair completeness {report['pair_completeness']:.4f}, reduction ratio {report['reduction_ratio']:.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import logging
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import InstanceStore, get_instances_dir, get_blocking_dir, dump_json
+from lib.stage_cache import open_stage
+from scripts.entity_matching.pay_to_inv.block import load_candidates
+from scripts.entity_matching.pay_to_inv.subset_sum import load_proposals
+
+logger = logging.getLogger(__name__)
+
+_IDENTIFIER_PATTERN = r"[A-Za-z0-9]+"
+
+# columns of the instance frame and the attributes they come from
+_COLUMNS = {
+    "billing_number": "inv_billing_number",
+    "assignment_number": "inv_assignment_number",
+    "inv_amount": "inv_amount",
+    "inv_currency": "inv_currency_code",
+    "memo_line": "pay_memo_line",
+    "pay_amount": "pay_amount",
+    "pay_currency": "pay_currency"
+}
+
+
+def source_columns(cfg: DictConfig) -> dict[str, tuple[str, str]]:
+    """
+    Maps each column of the instance frame to the instance store table and the column name it is read from
+
+    Invoice attributes come only from the invoice tables and payment attributes only from the payments table, since
+    both have columns with the same name in the descriptive schema (e.g., "Amount"). In multi-table mode, an attribute
+    comes from the first table that contains it.
+    """
+    columns = {}
+    for column, attribute in _COLUMNS.items():
+        is_invoice_attribute = attribute.startswith("inv_")
+        params = (cfg.dataset.inv_attributes if is_invoice_attribute else cfg.dataset.pay_attributes)[attribute]
+        table = "invoices" if is_invoice_attribute else "payments"
+        if cfg.dataset.schema_mode == "multi-table":
+            table = f"{table}_{params.multi_table.table_names[0]}"
+        name = params["descriptive_name" if cfg.dataset.schema_mode == "descriptive" else "opaque_name"]
+        columns[column] = (table, name)
+    return columns
+
+
+def load_instance_frame(store: InstanceStore, cfg: DictConfig) -> pd.DataFrame:
+    """
+    Loads the columns that the rules need from the first source and target row of every instance, reading each table
+    once for all instances
+    """
+    columns = source_columns(cfg)
+    tables = sorted(set(table for table, _ in columns.values()))
+    for table in tables:
+        if table not in store.table_names:
+            raise AssertionError(f"Missing table `{table}` in the instance store for schema mode "
+                                 f"{cfg.dataset.schema_mode}!")
+
+    # read everything as strings to keep identifiers like billing numbers exactly as they are shown to the LLM
+    table_rows = {}
+    for table in tables:
+        row_ids = store.column(store.table_key(table))
+        table_rows[table] = store.first_rows_as_strings(table, row_ids.tolist()).reindex(row_ids)
+    frame = pd.DataFrame(index=[str(ix) for ix in range(len(store))], columns=list(_COLUMNS.keys()), dtype=object)
+    for column, (table, name) in columns.items():
+        if name in table_rows[table].columns:
+            frame[column] = table_rows[table][name].to_numpy()
+    return frame
+
+def candidate_flags(store: InstanceStore, candidates: pd.DataFrame) -> pd.Series:
+    """
+    Computes for every instance whether its pair of invoice and payment is one of the candidate pairs of block.py
+    """
+    candidate_pairs = pd.MultiIndex.from_frame(candidates[["invoice_id", "payment_id"]])
+    pairs = pd.MultiIndex.from_arrays([store.column("invoice_id"), store.column("payment_id")])
+    return pd.Series(pairs.isin(candidate_pairs), index=[str(ix) for ix in range(len(store))])
+
+
+def unique_proposal_flags(store: InstanceStore, proposals: dict[int, dict]) -> pd.Series:
+    """
+    Computes for every instance whether its invoice is in the only invoice set that subset_sum.py proposed for its
+    payment, provided that the search for the payment was complete, i.e., did not stop early
+    """
+    unique = {payment_id: set(row["proposals"][0]) for payment_id, row in proposals.items()
+              if len(row["proposals"]) == 1 and row["complete"]}
+    pairs = zip(store.column("invoice_id").tolist(), store.column("payment_id").tolist())
+    flags = [invoice_id in unique.get(payment_id, ()) for invoice_id, payment_id in pairs]
+    return pd.Series(flags, index=[str(ix) for ix in range(len(store))])
+
+
+def _identifier_in_memo_line(frame: pd.DataFrame, column: str, min_length: int) -> pd.Series:
+    tokens = frame["memo_line"].fillna("").str.findall(_IDENTIFIER_PATTERN).explode()
+    identifiers = frame[column].reindex(tokens.index)
+    found = (tokens == identifiers) & (identifiers.str.len() >= min_length)
+    return found.groupby(level=0).any().reindex(frame.index, fill_value=False)
+
+
+def _same_currency(frame: pd.DataFrame) -> pd.Series:
+    return frame["inv_currency"].notna() & (frame["inv_currency"] == frame["pay_currency"])
+
+
+def _rule_currency_mismatch(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    return frame["inv_currency"].notna() & frame["pay_currency"].notna() & ~_same_currency(frame)
+
+
+def _rule_exact_amount(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    inv_amount = pd.to_numeric(frame["inv_amount"], errors="coerce").round(2)
+    pay_amount = pd.to_numeric(frame["pay_amount"], errors="coerce").round(2)
+    return _same_currency(frame) & (inv_amount == pay_amount)
+
+
+def _rule_billing_number_in_memo_line(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    return _identifier_in_memo_line(frame, "billing_number", cfg.prematch.min_identifier_length)
+
+
+def _rule_assignment_number_in_memo_line(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    return _identifier_in_memo_line(frame, "assignment_number", cfg.prematch.min_identifier_length)
+
+
+def _rule_not_blocked(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    return ~frame["is_candidate"]
+
+
+def _rule_subset_sum(frame: pd.DataFrame, cfg: DictConfig) -> pd.Series:
+    return frame["in_unique_proposal"]
+
+
+# rule name ==> (function that computes for which instances the rule applies, decision)
+RULES = {
+    "currency_mismatch": (_rule_currency_mismatch, False),
+    "exact_amount": (_rule_exact_amount, True),
+    "billing_number_in_memo_line": (_rule_billing_number_in_memo_line, True),
+    "assignment_number_in_memo_line": (_rule_assignment_number_in_memo_line, True),
+    "not_blocked": (_rule_not_blocked, False),
+    "subset_sum": (_rule_subset_sum, True)
+}
+
+
+def apply_rules(frame: pd.DataFrame, cfg: DictConfig) -> pd.DataFrame:
+    """
+    Applies the configured rules in order, the first rule that applies to an instance decides it
+
+    Returns a frame with the columns `rule` and `prediction`, which are None for instances that the LLM must decide
+    """
+    decisions = pd.DataFrame({"rule": None, "prediction": None}, index=frame.index, dtype=object)
+    undecided = pd.Series(True, index=frame.index)
+    for rule in cfg.prematch.rules:
+        if rule not in RULES.keys():
+            raise AssertionError(f"Unknown pre-matching rule `{rule}`!")
+        function, prediction = RULES[rule]
+        applies = function(frame, cfg) & undecided
+        decisions.loc[applies, "rule"] = rule
+        decisions.loc[applies, "prediction"] = prediction
+        undecided &= ~applies
+    return decisions
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    if not cfg.prematch.enabled:
+        logger.info("pre-matching is disabled")
+        return
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    blocking_dir = get_blocking_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    uses_candidates = "not_blocked" in cfg.prematch.rules
+    uses_proposals = "subset_sum" in cfg.prematch.rules
+    stage = open_stage("prematch", instances_dir / "rule_decisions.json",
+                       {"instances": instances_dir,
+                        "candidates": blocking_dir / "candidates.npz" if uses_candidates else None,
+                        "subset_sums": blocking_dir / "subset_sums.json" if uses_proposals else None},
+                       OmegaConf.to_container(cfg, resolve=True))
+    if stage is not None and stage.restore():
+        return
+
+    store = InstanceStore.load(instances_dir)
+    frame = load_instance_frame(store, cfg)
+    if uses_candidates:
+        frame["is_candidate"] = candidate_flags(store, load_candidates(blocking_dir)).reindex(frame.index)
+    if uses_proposals:
+        frame["in_unique_proposal"] = unique_proposal_flags(store, load_proposals(blocking_dir)).reindex(frame.index)
+    decisions = apply_rules(frame, cfg)
+    decided = decisions[decisions["rule"].notna()]
+    dump_json({name: {"rule": row["rule"], "prediction": bool(row["prediction"])} for name, row in decided.iterrows()},
+              instances_dir / "rule_decisions.json")
+
+    logger.info(f"pre-matching decided {len(decided)} of {len(frame.index)} instances: "
+                f"{decided['rule'].value_counts().to_dict()}")
+
+    if stage is not None:
+        stage.save()
+
+
+if __name__ == "__main__":
+    main()
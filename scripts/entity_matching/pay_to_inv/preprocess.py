@@ -1,16 +1,19 @@
 import ast
 import json
 import logging
-import os
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import hydra
+import numpy as np
 import pandas as pd
 import tqdm
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
-from lib.data import get_download_dir, get_instances_dir, dump_json
+from lib.data import StoreTable, get_download_dir, get_instances_dir, dump_instance_store
+from lib.sampling import sample_excluding
+from lib.stage_cache import open_stage
 
 pd.options.mode.chained_assignment = None  # default='warn'
 logger = logging.getLogger(__name__)
@@ -18,145 +21,314 @@ logger = logging.getLogger(__name__)
 _random = random.Random(218411488)
 
 
-def save_source_rows(invoices_tables: list[pd.DataFrame], invoice_id: int, instance_dir: Path):
+def parse_id_lists(ids: pd.Series) -> pd.Series:
     """
-    Saves the invoice id row from every dataframe in invoices to disk
+    Parses the ids of the multi-table tables, which are stored as string representations of lists, e.g., "[1, 2]"
+    """
+    return ids.apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+
+
+def index_rows(ids: pd.Series) -> dict[int, np.ndarray]:
+    """
+    Maps each id to the positions of the rows that contain it, where a row contains either a single id or a list of ids
+
+    The positions of each id are in ascending order, like the rows of a boolean mask
+    """
+    exploded = ids.reset_index(drop=True).explode().dropna()
+    rows = exploded.index.to_numpy()
+    return {key: rows[positions] for key, positions in exploded.groupby(exploded.to_numpy()).indices.items()}
+
+
+def index_invoices_tables(invoices_tables: list[pd.DataFrame]) -> list[dict[int, np.ndarray]]:
+    """
+    Parses the invoice ids of the invoices tables in place and indexes the rows of each invoice id
+
+    The index of the KNA table of the multi-table schema mode maps each invoice id to the customer rows joined to it
     """
     if len(invoices_tables) == 1:
-        source_row = invoices_tables[0][invoices_tables[0]["invoice_id"] == invoice_id]
-        source_row.drop("invoice_id", axis=1, inplace=True)
-        source_row.to_csv(instance_dir / "source_row.csv", index=False)
+        return [index_rows(invoices_tables[0]["invoice_id"])]
     elif len(invoices_tables) == 3:
-        # BKPF
-        invoices_tables[0]["invoice_id"] = invoices_tables[0]["invoice_id"].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-        source_row_BKPF = invoices_tables[0][
-            invoices_tables[0]["invoice_id"].apply(lambda x: isinstance(x, list) and invoice_id in x)]
-        source_row_BKPF.drop("invoice_id", axis=1, inplace=True)
-        source_row_BKPF.to_csv(instance_dir / "source_row_BKPF.csv", index=False)
-        # BSEG
-        invoices_tables[1]["invoice_id"] = invoices_tables[1]["invoice_id"].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-        source_row_BSEG = invoices_tables[1][
-            invoices_tables[1]["invoice_id"].apply(lambda x: isinstance(x, list) and invoice_id in x)]
-        source_row_BSEG.drop("invoice_id", axis=1, inplace=True)
-        source_row_BSEG.to_csv(instance_dir / "source_row_BSEG.csv", index=False)
-        # KNA
-        source_row_KNA = invoices_tables[2].copy()
-        source_row_KNA.drop("invoice_id", axis=1, inplace=True)
-        source_row_KNA.drop("LAND1", axis=1, inplace=True)
-        source_row_KNA.to_csv(instance_dir / "source_row_KNA.csv", index=False)
+        for invoices_table in invoices_tables:
+            invoices_table["invoice_id"] = parse_id_lists(invoices_table["invoice_id"])
+        return [index_rows(invoices_table["invoice_id"]) for invoices_table in invoices_tables]
     else:
         raise NotImplementedError(f"Supporting only 1 or 3 invoice tables ")
 
 
-@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
-def main(cfg: DictConfig) -> None:
-    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
-    download_dir = get_download_dir(cfg.task_name, cfg.dataset.dataset_name)
-    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+def store_tables(
+        invoices_tables: list[pd.DataFrame],
+        invoices_row_indexes: list[dict[int, np.ndarray]],
+        payments: pd.DataFrame,
+        payments_row_index: dict[int, np.ndarray]
+) -> dict[str, StoreTable]:
+    """
+    Creates the tables of the instance store, whose rows the instances reference by their invoice and payment ids
 
-    # load invoices
+    The invoices tables come first in the order in which the prompts show them. In multi-table mode, the KNA table
+    without the LAND1 column is shared: every instance shows it completely, unless only its joined rows are shown.
+    """
+    if len(invoices_tables) == 1:
+        invoices = {"invoices": StoreTable(invoices_tables[0].drop("invoice_id", axis=1), "invoice_id",
+                                           invoices_row_indexes[0])}
+        payments_name = "payments"
+    elif len(invoices_tables) == 3:
+        invoices = {
+            "invoices_KNA-1": StoreTable(invoices_tables[2].drop(["invoice_id", "LAND1"], axis=1), "invoice_id",
+                                         invoices_row_indexes[2], shared=True),
+            "invoices_BKPF": StoreTable(invoices_tables[0].drop("invoice_id", axis=1), "invoice_id",
+                                        invoices_row_indexes[0]),
+            "invoices_BSEG": StoreTable(invoices_tables[1].drop("invoice_id", axis=1), "invoice_id",
+                                        invoices_row_indexes[1])
+        }
+        payments_name = "payments_FEBEP"
+    else:
+        raise NotImplementedError(f"Supporting only 1 or 3 invoice tables ")
+    payments = StoreTable(payments.drop("payment_id", axis=1), "payment_id", payments_row_index)
+    return {**invoices, payments_name: payments}
+
+
+def load_tables(
+        cfg: DictConfig,
+        download_dir: Path,
+        **read_csv_kwargs
+) -> tuple[list[pd.DataFrame], pd.DataFrame, pd.DataFrame]:
+    """
+    Loads the invoices tables, the payments table, and the matches table of the configured schema mode
+
+    The keyword arguments are passed to pd.read_csv for the invoices and payments tables, e.g., dtype=str
+    """
+    tables_dir = download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode
     logger.info(f"experiment: {cfg.exp_name}, schema mode: {cfg.dataset.schema_mode}")
     if cfg.dataset.schema_mode in ["descriptive", "opaque"]:
-        invoices = [
-            pd.read_csv(download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "invoices.csv")]
-        payments = pd.read_csv(download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "payments.csv")
+        invoices = [pd.read_csv(tables_dir / "invoices.csv", **read_csv_kwargs)]
+        payments = pd.read_csv(tables_dir / "payments.csv", **read_csv_kwargs)
     elif cfg.dataset.schema_mode == "multi-table":
         logger.info("Loading multi-table data")
-        invoices_BKPF = pd.read_csv(
-            download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "invoices_BKPF.csv")
-        invoices_BSEG = pd.read_csv(
-            download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "invoices_BSEG.csv")
-        invoices_KNA = pd.read_csv(
-            download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "invoices_KNA-1.csv")
+        invoices_BKPF = pd.read_csv(tables_dir / "invoices_BKPF.csv", **read_csv_kwargs)
+        invoices_BSEG = pd.read_csv(tables_dir / "invoices_BSEG.csv", **read_csv_kwargs)
+        invoices_KNA = pd.read_csv(tables_dir / "invoices_KNA-1.csv", **read_csv_kwargs)
         invoices = [invoices_BKPF, invoices_BSEG, invoices_KNA]
-        payments = pd.read_csv(
-            download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "payments_FEBEP.csv")
-
+        payments = pd.read_csv(tables_dir / "payments_FEBEP.csv", **read_csv_kwargs)
     else:
         raise AssertionError(f"Invalid dataset schema_mode `{cfg.dataset.schema_mode}`!")
-    matches = pd.read_csv(download_dir / cfg.dataset.perturbation_mode / cfg.dataset.schema_mode / "matches.csv")
+    matches = pd.read_csv(tables_dir / "matches.csv")
+    return invoices, payments, matches
+
 
-    ix = 0
-    # save the ground truth
-    positive_instances = []
-    negative_instances = []
+def plan_match_instances(match: pd.Series, num_negatives: int, owner: int = 0) -> list[dict]:
+    """
+    Plans the instances of the match in the order in which they are saved
+
+    Each invoice of the match is paired with `num_negatives` non-matching payments and with the payments of the match,
+    and each payment of the match is paired with `num_negatives` non-matching invoices. The non-matching pairs have
+    the key `sample` ("invoice_id" or "payment_id"), whose id must be sampled from all ids except the ids in
+    `excluded_ids`, and the key `owner`, which numbers the invoices and payments that need non-matching pairs,
+    starting from the given owner.
+    """
+    invoice_ids = json.loads(match["invoice_ids"])
+    payment_ids = json.loads(match["payment_ids"])
+    perturbation_categories = json.loads(match["perturbation_categories"])
 
+    instances = []
+    for invoice_id in invoice_ids:
+        # create non-matching pairs for the invoice
+        for _ in range(num_negatives):
+            instances.append({
+                "ground_truth": {"rows_match": False, "match_category": match["match_category"],
+                                 "perturbation_categories": perturbation_categories, "kind": "invoice_driven",
+                                 "invoice_id": invoice_id, "payment_id": None},
+                "sample": "payment_id", "excluded_ids": payment_ids, "owner": owner
+            })
+        owner += 1
+
+        # loop through all payment ids of the match (is only 1 for 1:1 row matches)
+        for payment_id in payment_ids:
+            instances.append({
+                "ground_truth": {"rows_match": True, "match_category": match["match_category"],
+                                 "perturbation_categories": perturbation_categories, "kind": "match",
+                                 "match_id": match["match_id"], "invoice_id": invoice_id,
+                                 "payment_id": payment_id}
+            })
+
+    # create non-matching pairs for each of the payment in the match
+    for payment_id in payment_ids:
+        for _ in range(num_negatives):
+            instances.append({
+                "ground_truth": {"rows_match": False, "match_category": match["match_category"],
+                                 "perturbation_categories": perturbation_categories, "kind": "payment_driven",
+                                 "invoice_id": None, "payment_id": payment_id},
+                "sample": "invoice_id", "excluded_ids": invoice_ids, "owner": owner
+            })
+        owner += 1
+    return instances
+
+
+def plan_instances(matches: pd.DataFrame, cfg: DictConfig) -> list[dict]:
+    """
+    Plans the instances of the matches in the order in which they are saved, see plan_match_instances
+    """
+    num_negatives = cfg.negative_sampling.num_negatives
+    instances = []
+    owner = 0
     # loop through all true matches
     for _, match in tqdm.tqdm(matches.iterrows(),
                               desc=f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - preprocess",
                               total=len(matches.index)):
-        if ix >= cfg.limit_instances:
+        if len(instances) >= cfg.limit_instances:
             break
+        instances += plan_match_instances(match, num_negatives, owner)
+        owner += len(json.loads(match["invoice_ids"])) + len(json.loads(match["payment_ids"]))
+    return instances
 
-        invoice_ids = json.loads(match["invoice_ids"])
-        payment_ids = json.loads(match["payment_ids"])
-        if cfg.dataset.schema_mode == "multi-table":
-            payments["payment_id"] = payments["payment_id"].apply(
-                lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-            payments["payment_id"] = payments["payment_id"].apply(lambda x: x[0] if isinstance(x, list) else x)
-        perturbation_categories = json.loads(match["perturbation_categories"])
-
-        # save match as instance
-        for invoice_id in invoice_ids:
-            instance_dir = instances_dir / f"{ix}"
-            os.makedirs(instance_dir, exist_ok=True)
-
-            # create a non-matching pair for the invoice
-            save_source_rows(invoices_tables=invoices, invoice_id=invoice_id, instance_dir=instance_dir)
-            payment_id = _random.choice(list(set(payments["payment_id"].to_list()) - set(payment_ids)))
-            target_row = payments[payments["payment_id"] == payment_id]
-            target_row.drop("payment_id", axis=1, inplace=True)
-
-            target_row.to_csv(instance_dir / "target_row.csv", index=False)
-            dump_json({"rows_match": False, "match_category": match["match_category"],
-                       "perturbation_categories": perturbation_categories, "kind": "invoice_driven"},
-                      instance_dir / "ground_truth.json")
-            negative_instances.append(ix)
-            ix += 1
-
-            # loop through all payment ids of the match (is only 1 for 1:1 row matches)
-            for payment_id in payment_ids:
-                instance_dir = instances_dir / f"{ix}"
-                os.makedirs(instance_dir, exist_ok=True)
-
-                save_source_rows(invoices_tables=invoices, invoice_id=invoice_id, instance_dir=instance_dir)
-                target_row = payments[payments["payment_id"] == payment_id]
-                target_row.drop("payment_id", axis=1, inplace=True)
-
-                target_row.to_csv(instance_dir / "target_row.csv", index=False)
-                dump_json({"rows_match": True, "match_category": match["match_category"],
-                           "perturbation_categories": perturbation_categories, "kind": "match",
-                           "match_id": match["match_id"]},
-                          instance_dir / "ground_truth.json")
-                positive_instances.append(ix)
-                ix += 1
-
-        # create a non-matching pair for each of the payment in the match
-        for payment_id in payment_ids:
-            instance_dir = instances_dir / f"{ix}"
-            os.makedirs(instance_dir, exist_ok=True)
-
-            if cfg.dataset.schema_mode == "multi-table":
-                all_invoice_ids = [x[0] for x in invoices[0]["invoice_id"]]
-                invoice_id = _random.choice(list(set(all_invoice_ids) - set(invoice_ids)))
-            else:
-                invoice_id = _random.choice(list(set(invoices[0]["invoice_id"].to_list()) - set(invoice_ids)))
-            save_source_rows(invoices_tables=invoices, invoice_id=invoice_id, instance_dir=instance_dir)
-            target_row = payments[payments["payment_id"] == payment_id]
-            target_row.drop("payment_id", axis=1, inplace=True)
-
-            target_row.to_csv(instance_dir / "target_row.csv", index=False)
-            dump_json({"rows_match": False, "match_category": match["match_category"],
-                       "perturbation_categories": perturbation_categories, "kind": "payment_driven"},
-                      instance_dir / "ground_truth.json")
-            negative_instances.append(ix)
-            ix += 1
-
-    dump_json({"positive": positive_instances, "negative": negative_instances}, instances_dir / "examples_pos_neg.json")
-
-    logger.info(f"Saved {len(positive_instances)} positive and {len(negative_instances)} negative instances!")
+
+def sample_negatives(instances: list[dict], all_invoice_ids: list[int], all_payment_ids: list[int], cfg: DictConfig):
+    """
+    Samples the ids of the non-matching pairs one after the other, each from the set of all ids minus the match's ids
+    """
+    if cfg.negative_sampling.num_negatives != 1:
+        raise AssertionError("Multiple negatives per invoice or payment require `negative_sampling.vectorized`!")
+    for instance in instances:
+        if "sample" not in instance.keys():
+            continue
+        all_ids = all_payment_ids if instance["sample"] == "payment_id" else all_invoice_ids
+        negative_id = _random.choice(list(set(all_ids) - set(instance["excluded_ids"])))
+        instance["ground_truth"][instance["sample"]] = negative_id
+
+
+def sample_negatives_vectorized(
+        instances: list[dict],
+        invoice_ids: np.ndarray,
+        payment_ids: np.ndarray,
+        rng: np.random.Generator
+):
+    """
+    Samples the ids of all non-matching pairs at once, uniformly from the distinct ids except the match's ids
+
+    The invoice and payment ids must be distinct and sorted, e.g., by np.unique. The non-matching ids of the same
+    invoice or payment are distinct.
+    """
+    for side, ids in (("payment_id", payment_ids), ("invoice_id", invoice_ids)):
+        negatives = [instance for instance in instances if instance.get("sample") == side]
+        if len(negatives) == 0:
+            continue
+        owners = np.unique([instance["owner"] for instance in negatives], return_inverse=True)[1]
+
+        # the excluded ids of each owner, as positions in the distinct ids
+        first_negatives = [negatives[ix] for ix in np.unique(owners, return_index=True)[1]]
+        excluded_owners = np.repeat(np.arange(len(first_negatives)),
+                                    [len(instance["excluded_ids"]) for instance in first_negatives])
+        excluded_ids = np.asarray([i for instance in first_negatives for i in instance["excluded_ids"]], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(ids, excluded_ids), len(ids) - 1)
+        known = ids[positions] == excluded_ids
+
+        values = sample_excluding(len(ids), owners, excluded_owners[known], positions[known], rng)
+        for instance, value in zip(negatives, ids[values].tolist()):
+            instance["ground_truth"][side] = value
+
+
+def preprocess_shard(
+        matches: pd.DataFrame,
+        invoice_ids: np.ndarray,
+        payment_ids: np.ndarray,
+        num_negatives: int,
+        seed: int
+) -> list[dict]:
+    """
+    Plans the instances of a shard of consecutive matches and samples their non-matching ids
+
+    The non-matching ids of each match are sampled with an RNG derived from the seed and the match id, so that the
+    instances of a match do not depend on the other matches of its shard. Returns the ground truths of the instances.
+    """
+    ground_truths = []
+    for _, match in matches.iterrows():
+        instances = plan_match_instances(match, num_negatives)
+        sample_negatives_vectorized(instances, invoice_ids, payment_ids,
+                                    np.random.default_rng([seed, int(match["match_id"])]))
+        ground_truths += [instance["ground_truth"] for instance in instances]
+    return ground_truths
+
+
+def preprocess_sharded(
+        matches: pd.DataFrame,
+        all_invoice_ids: list[int],
+        all_payment_ids: list[int],
+        cfg: DictConfig
+) -> list[dict]:
+    """
+    Plans and samples the instances of shards of `sharding.matches_per_shard` matches in a process pool
+
+    The instance-id offset of each shard is computed from the numbers of instances of the matches before it, so that
+    the ground truths of the shards are merged in the order of the matches, whatever the number of workers.
+    """
+    num_negatives = cfg.negative_sampling.num_negatives
+    num_invoices = matches["invoice_ids"].apply(lambda ids: len(json.loads(ids))).to_numpy()
+    num_payments = matches["payment_ids"].apply(lambda ids: len(json.loads(ids))).to_numpy()
+    num_instances = num_invoices * (num_negatives + num_payments) + num_payments * num_negatives
+    offsets = np.cumsum(num_instances) - num_instances
+    if cfg.limit_instances is not None:  # like plan_instances, stop before the first match beyond the limit
+        num_matches = int((offsets < cfg.limit_instances).sum())
+        matches, num_instances, offsets = matches.iloc[:num_matches], num_instances[:num_matches], offsets[:num_matches]
+
+    invoice_ids, payment_ids = np.unique(all_invoice_ids), np.unique(all_payment_ids)
+    ground_truths = [None] * int(num_instances.sum())
+    starts = range(0, len(matches.index), cfg.sharding.matches_per_shard)
+    with ProcessPoolExecutor(max_workers=cfg.sharding.num_workers) as executor:
+        futures = {
+            executor.submit(preprocess_shard, matches.iloc[start:start + cfg.sharding.matches_per_shard],
+                            invoice_ids, payment_ids, num_negatives, cfg.negative_sampling.seed): start
+            for start in starts
+        }
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures),
+                                desc=f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - preprocess"):
+            start = futures[future]
+            end = min(start + cfg.sharding.matches_per_shard, len(matches.index))
+            shard = future.result()
+            if len(shard) != num_instances[start:end].sum():
+                raise AssertionError(f"The shard of matches {start} to {end} has an unexpected number of instances!")
+            ground_truths[offsets[start]:offsets[start] + len(shard)] = shard
+    return ground_truths
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    download_dir = get_download_dir(cfg.task_name, cfg.dataset.dataset_name)
+    stage = open_stage("preprocess", get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name),
+                       {"download": download_dir}, OmegaConf.to_container(cfg, resolve=True))
+    if stage is not None and stage.restore():
+        return
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    invoices, payments, matches = load_tables(cfg, download_dir)
+    invoices_row_indexes = index_invoices_tables(invoices)
+    if cfg.dataset.schema_mode == "multi-table":
+        payments["payment_id"] = parse_id_lists(payments["payment_id"])
+        payments["payment_id"] = payments["payment_id"].apply(lambda x: x[0] if isinstance(x, list) else x)
+    payments_row_index = index_rows(payments["payment_id"])
+
+    if cfg.dataset.schema_mode == "multi-table":
+        all_invoice_ids = [x[0] for x in invoices[0]["invoice_id"]]
+    else:
+        all_invoice_ids = invoices[0]["invoice_id"].to_list()
+    all_payment_ids = payments["payment_id"].to_list()
+    if cfg.sharding.enabled:
+        ground_truths = preprocess_sharded(matches, all_invoice_ids, all_payment_ids, cfg)
+    else:
+        instances = plan_instances(matches, cfg)
+        if cfg.negative_sampling.vectorized:
+            rng = np.random.default_rng(cfg.negative_sampling.seed)
+            sample_negatives_vectorized(instances, np.unique(all_invoice_ids), np.unique(all_payment_ids), rng)
+        else:
+            sample_negatives(instances, all_invoice_ids, all_payment_ids, cfg)
+        ground_truths = [instance["ground_truth"] for instance in instances]
+    dump_instance_store(ground_truths, store_tables(invoices, invoices_row_indexes, payments, payments_row_index),
+                        instances_dir)
+
+    num_positives = sum(ground_truth["rows_match"] for ground_truth in ground_truths)
+    logger.info(f"Saved {num_positives} positive and {len(ground_truths) - num_positives} negative instances!")
+
+    if stage is not None:
+        stage.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import json
+import logging
+import random
+
+import hydra
+import numpy as np
+import pandas as pd
+import tqdm
+from omegaconf import DictConfig
+
+from lib.data import get_download_dir, get_instances_dir, get_blocking_dir, dump_instance_store
+from lib.ngram_index import NGramIndex
+from scripts.entity_matching.pay_to_inv.block import load_frames, build_identifier_index, load_candidates
+from scripts.entity_matching.pay_to_inv.preprocess import load_tables, parse_id_lists, index_rows, \
+    index_invoices_tables, store_tables
+from scripts.entity_matching.pay_to_inv.subset_sum import load_proposals
+
+pd.options.mode.chained_assignment = None  # default='warn'
+logger = logging.getLogger(__name__)
+
+_random = random.Random(591827364)
+
+
+def rank_invoices(index: NGramIndex, invoice_ids: np.ndarray, memo_line: str | None, k: int) -> list[int]:
+    """
+    Ranks the invoices by how well their billing and assignment numbers match the memo line, best first
+
+    Only the (at most k) invoices that share an n-gram with the memo line are ranked
+    """
+    docs, _ = index.query(memo_line, k)
+    return invoice_ids[docs].tolist()
+
+
+def sample_invoices(pool: np.ndarray, excluded: set[int], num: int) -> list[int]:
+    """
+    Randomly chooses num distinct invoice ids from the pool that are not excluded and adds them to the excluded ones,
+    without copying the pool
+    """
+    invoice_ids = []
+    while len(invoice_ids) < num:
+        invoice_id = int(pool[_random.randrange(len(pool))])
+        if invoice_id not in excluded:
+            excluded.add(invoice_id)
+            invoice_ids.append(invoice_id)
+    return invoice_ids
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """
+    Creates one instance per payment, which consists of the payment and its candidate invoices: the invoices of the
+    payment's match and the other invoices that rank highest for the payment's memo line, filled up with randomly
+    chosen other invoices if too few invoices rank
+
+    If block.py has run, only the payment's candidate pairs are ranked and filled up with, and only payments with too
+    few of them are filled up with other invoices. If subset_sum.py has run, the invoices of the payment's proposed
+    invoice sets rank first
+    """
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    download_dir = get_download_dir(cfg.task_name, cfg.dataset.dataset_name)
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    invoices, payments, matches = load_tables(cfg, download_dir)
+    invoices_frame, payments_frame, _ = load_frames(cfg)
+    index = build_identifier_index(invoices_frame, cfg)
+    frame_invoice_ids = invoices_frame["invoice_id"].to_numpy()
+    memo_lines = {payment_id: memo_line if isinstance(memo_line, str) else None
+                  for payment_id, memo_line in zip(payments_frame["payment_id"], payments_frame["memo_line"])}
+
+    blocked = None
+    proposals = {}
+    blocking_dir = get_blocking_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    if (blocking_dir / "candidates.npz").is_file():
+        candidates = load_candidates(blocking_dir)
+        blocked = {payment_id: np.sort(invoice_ids.to_numpy())
+                   for payment_id, invoice_ids in candidates.groupby("payment_id")["invoice_id"]}
+        logger.info(f"choosing the candidates from the {len(candidates.index)} candidate pairs of block.py")
+        if (blocking_dir / "subset_sums.json").is_file():
+            proposals = load_proposals(blocking_dir)
+            logger.info(f"ranking the proposals of subset_sum.py for "
+                        f"{sum(len(row['proposals']) > 0 for row in proposals.values())} payments first")
+
+    invoices_row_indexes = index_invoices_tables(invoices)
+    if cfg.dataset.schema_mode == "multi-table":
+        payments["payment_id"] = parse_id_lists(payments["payment_id"])
+        payments["payment_id"] = payments["payment_id"].apply(lambda x: x[0] if isinstance(x, list) else x)
+    payments_row_index = index_rows(payments["payment_id"])
+
+    ground_truths = []
+    num_candidates = 0
+    num_ranked = 0
+    for _, match in tqdm.tqdm(matches.iterrows(),
+                              desc=f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - preprocess",
+                              total=len(matches.index)):
+        if len(ground_truths) >= cfg.limit_instances:
+            break
+
+        invoice_ids = json.loads(match["invoice_ids"])
+        payment_ids = json.loads(match["payment_ids"])
+        perturbation_categories = json.loads(match["perturbation_categories"])
+
+        for payment_id in payment_ids:
+            # there is always at least one non-matching candidate
+            num_negatives = max(cfg.listwise.num_candidates - len(invoice_ids), 1)
+            if blocked is None:
+                ranked_invoice_ids = rank_invoices(index, frame_invoice_ids, memo_lines.get(payment_id),
+                                                   num_negatives + len(invoice_ids))
+            else:
+                blocked_invoice_ids = set(blocked.get(payment_id, frame_invoice_ids[:0]).tolist())
+                ranked_invoice_ids = [x for x in rank_invoices(index, frame_invoice_ids, memo_lines.get(payment_id),
+                                                               len(frame_invoice_ids)) if x in blocked_invoice_ids]
+                proposed_invoice_ids = [x for invoice_set in proposals.get(payment_id, {}).get("proposals", [])
+                                        for x in invoice_set]
+                ranked_invoice_ids = list(dict.fromkeys(proposed_invoice_ids + ranked_invoice_ids))
+            negative_invoice_ids = [x for x in ranked_invoice_ids if x not in invoice_ids][:num_negatives]
+            num_ranked += len(negative_invoice_ids)
+            excluded = set(invoice_ids) | set(negative_invoice_ids)
+            if blocked is not None:
+                # the candidate pairs without a rank, as far as the payment has enough of them
+                unranked = sorted(blocked_invoice_ids - excluded)
+                unranked = _random.sample(unranked, min(num_negatives - len(negative_invoice_ids), len(unranked)))
+                negative_invoice_ids += unranked
+                excluded.update(unranked)
+            negative_invoice_ids += sample_invoices(frame_invoice_ids, excluded,
+                                                    num_negatives - len(negative_invoice_ids))
+            candidate_invoice_ids = invoice_ids + negative_invoice_ids
+            _random.shuffle(candidate_invoice_ids)  # the rank must not reveal the match
+
+            ground_truths.append({"match_category": match["match_category"],
+                                  "perturbation_categories": perturbation_categories,
+                                  "match_id": match["match_id"], "payment_id": payment_id,
+                                  "candidate_invoice_ids": candidate_invoice_ids,
+                                  "candidates_match": [invoice_id in invoice_ids
+                                                       for invoice_id in candidate_invoice_ids]})
+            num_candidates += len(candidate_invoice_ids)
+
+    dump_instance_store(ground_truths, store_tables(invoices, invoices_row_indexes, payments, payments_row_index),
+                        instances_dir)
+
+    logger.info(f"Saved {len(ground_truths)} listwise instances with {num_candidates} candidates, {num_ranked} of "
+                f"which are ranked non-matching invoices!")
+
+
+if __name__ == "__main__":
+    main()
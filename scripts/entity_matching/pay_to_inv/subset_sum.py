@@ -0,0 +1,144 @@
+import logging
+import pathlib
+import time
+
+import hydra
+import numpy as np
+import pandas as pd
+import tqdm
+from omegaconf import DictConfig
+
+from lib.data import get_blocking_dir, dump_json, load_json
+from lib.subset_sum import find_subsets
+from scripts.entity_matching.pay_to_inv.block import load_frames, split_history, max_deductions
+
+logger = logging.getLogger(__name__)
+
+
+def propose_invoice_sets(
+        invoices: pd.DataFrame,
+        payments: pd.DataFrame,
+        candidates: pd.DataFrame,
+        cfg: DictConfig
+) -> pd.DataFrame:
+    """
+    Proposes sets of candidate invoices of the same customer and currency whose amounts add up to the payment amount,
+    up to a small deduction
+
+    The node budget is shared by all blocks of a payment. Returns a frame with one row per payment with the columns
+    `proposals` (lists of invoice ids), `num_nodes`, `exhausted`, which is True if the search stopped at the
+    payment's node budget, and `complete`, which is False if the search of any block stopped early or was skipped, so
+    that sets may be missing
+    """
+    candidates = candidates.assign(customer_id=invoices["customer_id"].to_numpy()[candidates["inv_ix"].to_numpy()],
+                                   currency=invoices["currency"].to_numpy()[candidates["inv_ix"].to_numpy()])
+    inv_amounts = np.nan_to_num(invoices["amount"].to_numpy(), nan=-1).astype(np.int64)
+    pay_amounts = payments["amount"].to_numpy()
+    deductions = max_deductions(payments, cfg)
+
+    rows = {}
+    blocks = candidates.groupby(["pay_ix", "customer_id", "currency"], sort=True)["inv_ix"]
+    for (pay_ix, _, _), inv_ix in tqdm.tqdm(blocks, desc="subset sums"):
+        row = rows.setdefault(pay_ix, {"payment_id": int(payments["payment_id"].iloc[pay_ix]), "proposals": [],
+                                       "num_nodes": 0, "exhausted": False, "complete": True})
+        remaining_nodes = cfg.subset_sum.max_nodes - row["num_nodes"]
+        if np.isnan(pay_amounts[pay_ix]) or len(row["proposals"]) >= cfg.subset_sum.max_proposals \
+                or remaining_nodes <= 0:  # the payment's other blocks are not searched
+            row["exhausted"] |= remaining_nodes <= 0
+            row["complete"] = False
+            continue
+        inv_ix = inv_ix.to_numpy()
+        result = find_subsets(
+            inv_amounts[inv_ix],
+            int(pay_amounts[pay_ix]),
+            int(pay_amounts[pay_ix]) + int(deductions[pay_ix]),
+            min_size=cfg.subset_sum.min_size,
+            max_size=cfg.subset_sum.max_size,
+            max_nodes=remaining_nodes,
+            max_subsets=cfg.subset_sum.max_proposals - len(row["proposals"])
+        )
+        row["proposals"] += [sorted(int(i) for i in invoices["invoice_id"].to_numpy()[inv_ix[list(subset)]])
+                             for subset in result.subsets]
+        row["num_nodes"] += result.num_nodes
+        row["exhausted"] |= result.exhausted
+        row["complete"] &= result.complete
+    return pd.DataFrame(list(rows.values()),
+                        columns=["payment_id", "proposals", "num_nodes", "exhausted", "complete"])
+
+
+def load_proposals(blocking_dir: pathlib.Path) -> dict[int, dict]:
+    """
+    Loads the proposals and whether the search was exhausted and complete by payment id from the blocking directory
+    """
+    if not (blocking_dir / "subset_sums.json").is_file():
+        raise AssertionError(f"Missing the proposals of subset_sum.py in {blocking_dir}!")
+    proposals = load_json(blocking_dir / "subset_sums.json")
+    return {int(payment_id): row for payment_id, row in proposals.items()}
+
+
+@hydra.main(version_base=None, config_path="../../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    """
+    Proposes invoice sets for the payments of one-payment-to-many-invoices matches from the candidates of block.py
+
+    A payment with exactly one proposal can be decided directly, the invoices of several proposals can become the
+    candidates of a listwise prompt
+    """
+    assert cfg.dataset.dataset_name == "pay_to_inv", "This script is dataset-specific."
+    blocking_dir = get_blocking_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    if not (blocking_dir / "candidates.npz").is_file():
+        raise AssertionError("The subset sums require the candidates of block.py!")
+
+    invoices, payments, matches = load_frames(cfg)
+    _, evaluation = split_history(matches, cfg)
+    with np.load(blocking_dir / "candidates.npz") as file:
+        candidates = pd.DataFrame({
+            "inv_ix": pd.Index(invoices["invoice_id"]).get_indexer(file["invoice_id"]),
+            "pay_ix": pd.Index(payments["payment_id"]).get_indexer(file["payment_id"])
+        })
+
+    start = time.time()
+    proposals = propose_invoice_sets(invoices, payments, candidates, cfg)
+    duration = time.time() - start
+    dump_json({str(row["payment_id"]): {"proposals": row["proposals"], "exhausted": bool(row["exhausted"]),
+                                        "complete": bool(row["complete"])}
+               for _, row in proposals.iterrows()}, blocking_dir / "subset_sums.json")
+
+    # evaluate the proposals for the evaluation matches whose payment pays several invoices
+    multi_inv = evaluation[evaluation["match_category"] == "one_pay_multi_inv"]
+    true_sets = {payment_ids[0]: sorted(invoice_ids)
+                 for invoice_ids, payment_ids in zip(multi_inv["invoice_ids"], multi_inv["payment_ids"])}
+    true_payment_sets = {payment_id: sorted(invoice_ids)
+                         for invoice_ids, payment_ids in zip(evaluation["invoice_ids"], evaluation["payment_ids"])
+                         for payment_id in payment_ids}
+    evaluated = proposals[proposals["payment_id"].isin(true_payment_sets.keys())]
+    found = [true_sets[p] in proposals_ for p, proposals_ in zip(evaluated["payment_id"], evaluated["proposals"])
+             if p in true_sets.keys()]
+    unique = evaluated[evaluated["proposals"].apply(len) == 1]
+    unique_correct = [proposals_[0] == true_payment_sets[p] for p, proposals_ in zip(unique["payment_id"],
+                                                                                       unique["proposals"])]
+    report = {
+        "num_payments": len(proposals.index),
+        "num_payments_with_proposals": int((proposals["proposals"].apply(len) > 0).sum()),
+        "num_exhausted": int(proposals["exhausted"].sum()),
+        "num_incomplete": int((~proposals["complete"]).sum()),
+        "mean_nodes": float(proposals["num_nodes"].mean()) if len(proposals.index) > 0 else None,
+        "max_nodes": int(proposals["num_nodes"].max()) if len(proposals.index) > 0 else None,
+        "time_s": duration,
+        "num_multi_inv_payments": len(true_sets),
+        "num_multi_inv_found": int(sum(found)),
+        "num_unique_proposals": len(unique.index),
+        "num_unique_proposals_correct": int(sum(unique_correct))
+    }
+    dump_json(report, blocking_dir / "subset_sum_report.json")
+
+    logger.info(f"proposals for {report['num_payments_with_proposals']} of {report['num_payments']} payments in "
+                f"{duration:.2f}s, {report['num_exhausted']} searches exhausted the node budget, "
+                f"{report['num_incomplete']} stopped early")
+    logger.info(f"one-payment-to-many-invoices sets found: {report['num_multi_inv_found']} of "
+                f"{report['num_multi_inv_payments']}, unique proposals correct: "
+                f"{report['num_unique_proposals_correct']} of {report['num_unique_proposals']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import logging
+import random
+
+import hydra
+import tqdm
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import InstanceStore, get_instances_dir, get_requests_dir, dump_json
+from lib.model.generic import max_tokens_for_ground_truth
+from lib.prompting.compact import COMPACT_REQUESTS_FILE, CompactChatTemplate, CompactRequests
+from lib.prompting.linearize import LinearizationCache
+from lib.prompting.listwise import format_candidate_answer
+from lib.prompting.template import CompiledChatTemplate, CompiledTemplate, compile_chat_template, compile_template
+from scripts.entity_matching.prepare_requests import create_linearization_caches, linearize_source_rows, \
+    linearize_target_row
+
+logger = logging.getLogger(__name__)
+
+sample_examples_random = random.Random(804716293)
+
+
+def linearize_listwise_instance(
+        store: InstanceStore,
+        instance_idx: int,
+        candidate_template: CompiledTemplate,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        is_first: bool
+) -> dict:
+    """Linearize the target row and the numbered candidate rows of the listwise instance.
+
+    Shared tables (e.g., KNA-1) contribute only the rows that each candidate references, so that a prompt does not
+    repeat the whole table once per candidate. With header_once, only the first target row and the first candidate
+    row in a prompt use the first cache.
+    """
+    first_cache, following_cache = linearization_caches
+    ground_truth = store.instance(instance_idx)
+
+    candidates = []
+    for number, invoice_id in enumerate(ground_truth["candidate_invoice_ids"], start=1):
+        cache = first_cache if is_first and number == 1 else following_cache
+        candidates.append(candidate_template.fill(
+            number=str(number),
+            source_table_row=linearize_source_rows(store, invoice_id, cache, joined_rows_only=True)
+        ))
+
+    return {
+        "target_table_row": linearize_target_row(store, ground_truth["payment_id"],
+                                                 first_cache if is_first else following_cache),
+        "candidates": "\n".join(candidates),
+        "answer": format_candidate_answer(ground_truth["candidates_match"])
+    }
+
+
+def prepare_listwise_request(
+        store: InstanceStore,
+        instance_idx: int,
+        example_instances: list[int],
+        listwise_prompt_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        listwise_example_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        listwise_candidate_template: CompiledTemplate,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        cfg: DictConfig
+) -> dict:
+    """Prepare the request for the listwise instance with the given examples, which come first in the prompt."""
+    example_messages = []
+    for ex_idx in example_instances:
+        example = linearize_listwise_instance(
+            store, ex_idx, listwise_candidate_template, linearization_caches, len(example_messages) == 0)
+        example_messages += listwise_example_chat_template.fill(**example)
+
+    instance = linearize_listwise_instance(
+        store, instance_idx, listwise_candidate_template, linearization_caches, len(example_messages) == 0)
+
+    request = {
+        "model": cfg.model,
+        "max_tokens": max_tokens_for_ground_truth(instance["answer"], cfg.api_name, cfg.model,
+                                                  cfg.max_tokens_over_ground_truth),
+        "temperature": cfg.temperature
+    }
+    request["messages"] = listwise_prompt_chat_template.fill(examples=example_messages, **instance)
+    return request
+
+
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    compact_requests = None
+    if cfg.compact_requests:
+        compact_requests = CompactRequests()
+        listwise_prompt_chat_template = compact_requests.template(
+            "listwise_prompt", OmegaConf.to_container(cfg.listwise_prompt_chat_template))
+        listwise_example_chat_template = compact_requests.template(
+            "listwise_example", OmegaConf.to_container(cfg.listwise_example_chat_template))
+    else:
+        listwise_prompt_chat_template = compile_chat_template(
+            OmegaConf.to_container(cfg.listwise_prompt_chat_template))
+        listwise_example_chat_template = compile_chat_template(
+            OmegaConf.to_container(cfg.listwise_example_chat_template))
+    listwise_candidate_template = compile_template(cfg.listwise_candidate_template)
+    linearization_caches = create_linearization_caches(cfg, instances_dir)
+
+    store = InstanceStore.load(instances_dir)
+    instance_indices = [int(name) for name in store.names()]
+    for instance_idx in tqdm.tqdm(
+            instance_indices,
+            f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - prepare listwise requests"):
+
+        # randomly choose other listwise instances as examples
+        k = cfg.listwise.num_examples
+        example_instances = sample_examples_random.sample(instance_indices, k=k + 1)
+        example_instances = [idx for idx in example_instances if idx != instance_idx][:k]
+
+        request = prepare_listwise_request(
+            store,
+            instance_idx,
+            example_instances,
+            listwise_prompt_chat_template,
+            listwise_example_chat_template,
+            listwise_candidate_template,
+            linearization_caches,
+            cfg
+        )
+        if compact_requests is not None:
+            compact_requests.add(f"{instance_idx}.json", request)
+        else:
+            dump_json(request, requests_dir / f"{instance_idx}.json")
+    if compact_requests is not None:
+        compact_requests.dump(requests_dir / COMPACT_REQUESTS_FILE)
+
+    first_cache, following_cache = linearization_caches
+    for cache in [first_cache] if following_cache is first_cache else [first_cache, following_cache]:
+        cache.save()
+        logger.info(f"linearization cache: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
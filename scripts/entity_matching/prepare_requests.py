@@ -1,19 +1,28 @@
+import bisect
+import functools
 import logging
+import pathlib
 import random
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import hydra
-import pandas as pd
+import numpy as np
 import tqdm
 from omegaconf import DictConfig, OmegaConf
 
-from lib.data import get_instances_dir, get_requests_dir, dump_json, load_json
-from lib.model.generic import max_tokens_for_ground_truth
-from lib.prompting.linearize import linearize_table
-from lib.prompting.template import fill_chat_template
+from lib.data import InstanceStore, get_instances_dir, get_requests_dir, dump_json, load_json
+from lib.model.generic import max_tokens_for_ground_truth, single_token_logit_bias
+from lib.prompting.compact import COMPACT_REQUESTS_FILE, CompactChatTemplate, CompactRequests
+from lib.prompting.linearize import LinearizationCache
+from lib.prompting.packing import pack_answers
+from lib.prompting.template import CompiledChatTemplate, CompiledTemplate, compile_chat_template, compile_template
+from lib.stage_cache import open_stage
 
 logger = logging.getLogger(__name__)
 
 sample_examples_random = random.Random(613907351)
+packing_random = random.Random(270914466)
 
 
 def get_ground_truth_string(ground_truth: bool):
@@ -23,90 +32,123 @@ def get_ground_truth_string(ground_truth: bool):
         return "No"
 
 
-@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
-def main(cfg: DictConfig) -> None:
-    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
-    requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+def linearize_source_rows(
+        store: InstanceStore,
+        invoice_id: int,
+        linearization_cache: LinearizationCache,
+        joined_rows_only: bool = False
+) -> str:
+    """Linearize the source rows of the invoice, the rows of several tables (multi-table) are joined with spaces.
 
-    instance_paths = list(sorted(instances_dir.glob("*/")))
-    for path in tqdm.tqdm(instance_paths,
-                          f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - prepare requests"):
-        if not path.is_dir():
+    With joined_rows_only, shared tables (e.g., KNA-1) contribute only the rows that are joined to the invoice.
+    """
+    linearized_source_rows = []
+    for table in store.table_names:
+        if store.table_key(table) != "invoice_id":
             continue
-        instance_idx = int(path.parts[-1])
-
-        # load instance data 
-        if cfg.dataset.schema_mode == "multi-table":
-            source_rows = []
-            for file in path.glob("*.csv"):
-                if "source" in file.name:
-                    source_rows.append(pd.read_csv(file))
-        else:
-            source_row = pd.read_csv(path / "source_row.csv")
-        target_row = pd.read_csv(path / "target_row.csv")
-        ground_truth = load_json(path / "ground_truth.json")["rows_match"]
-        ground_truth = get_ground_truth_string(ground_truth)
-
-        # linearize each table
-        if cfg.dataset.schema_mode == "multi-table":
-            linearized_source_rows = []
-            for s in source_rows:
-                linearized_source_rows.append(linearize_table(s, table_name=None, **cfg.linearize_table))
-            linearized_source_row = "   ".join(linearized_source_rows)
-        else:
-            linearized_source_row = linearize_table(source_row, table_name=None, **cfg.linearize_table)
-        linearized_target_row = linearize_table(target_row, table_name=None, **cfg.linearize_table)
+        joined_only = joined_rows_only and store.is_shared(table)
+        linearized_source_rows.append(linearization_cache.linearize(
+            f"{table}/joined" if joined_only else table, invoice_id,
+            functools.partial(store.rows, table, invoice_id, joined_only)))
+    return "   ".join(linearized_source_rows)
 
-        examples = []
-        # load examples (create lists of positive/negative ones during preprocessing?)
-        pos_neg_indices = load_json(instances_dir / "examples_pos_neg.json")
 
-        if cfg.sample_examples.num_examples > 0:
-            k = cfg.sample_examples.num_examples
-
-            # randomly choose a positive example and a negative one
-            if instance_idx in pos_neg_indices["positive"]:
-                pos_neg_indices["positive"].remove(instance_idx)
-            elif instance_idx in pos_neg_indices["negative"]:
-                pos_neg_indices["negative"].remove(instance_idx)
-
-            chosen_pos_indices = sample_examples_random.sample(pos_neg_indices["positive"], k=k)
-            chosen_neg_indices = sample_examples_random.sample(pos_neg_indices["negative"], k=k)
-
-            example_instances = chosen_neg_indices + chosen_pos_indices
-            sample_examples_random.shuffle(example_instances)
-
-            for ex_idx in example_instances:
-                ex_path = instances_dir / str(ex_idx)
-                # Load example data
-                if cfg.dataset.schema_mode == "multi-table":
-                    ex_source_rows = []
-                    for file in ex_path.glob("*.csv"):
-                        if "source" in file.name:
-                            ex_source_rows.append(pd.read_csv(file))
-                else:
-                    ex_source_row = pd.read_csv(ex_path / "source_row.csv")
-                ex_target_row = pd.read_csv(ex_path / "target_row.csv")
-                ex_ground_truth = load_json(ex_path / "ground_truth.json")["rows_match"]
-
-                # linearize example dfs
-                if cfg.dataset.schema_mode == "multi-table":
-                    ex_linearized_source_rows = []
-                    for s in source_rows:
-                        ex_linearized_source_rows.append(linearize_table(s, table_name=None, **cfg.linearize_table))
-                    ex_linearized_source_row = "   ".join(ex_linearized_source_rows)
-                else:
-                    ex_linearized_source_row = linearize_table(ex_source_row, table_name=None, **cfg.linearize_table)
-                ex_linearized_target_row = linearize_table(ex_target_row, table_name=None, **cfg.linearize_table)
-
-                examples.append(
-                    {
-                        "first_table_row": ex_linearized_source_row,
-                        "second_table_row": ex_linearized_target_row,
-                        "ground_truth": get_ground_truth_string(ex_ground_truth)
-                    }
-                )
+def linearize_target_row(store: InstanceStore, payment_id: int, linearization_cache: LinearizationCache) -> str:
+    return "   ".join(
+        linearization_cache.linearize(table, payment_id, functools.partial(store.rows, table, payment_id))
+        for table in store.table_names if store.table_key(table) == "payment_id"
+    )
+
+
+def create_linearization_caches(
+        cfg: DictConfig,
+        instances_dir: pathlib.Path
+) -> tuple[LinearizationCache, LinearizationCache]:
+    """Create the caches for the first table entries in a prompt and for all following ones.
+
+    Rows reappear across instances and examples, so each distinct row is linearized only once. With header_once, only
+    the first entries in a prompt have a CSV header, and the following ones use a separate cache.
+    """
+    params = OmegaConf.to_container(cfg.linearize_table)
+    path = instances_dir / "linearization_cache.json" if cfg.linearization_cache.on_disk else None
+    first_cache = LinearizationCache(params, path=path)
+    if not cfg.header_once:
+        return first_cache, first_cache
+    if params["mode"] != "csv":
+        raise AssertionError("header_once is only supported for the table linearization mode 'csv'!")
+    params = {**params, "csv_params": {**params["csv_params"], "header": False}}
+    return first_cache, LinearizationCache(params, path=path)
+
+
+def prefill_linearization_caches(
+        store: InstanceStore,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        cfg: DictConfig
+) -> None:
+    """Linearize the rows of all instances, which are also the examples, in one pass per table.
+
+    Preparing a request then looks the rows up instead of linearizing them one by one. Rows that are not single rows of
+    their ID, e.g., whole shared tables, are linearized when they are first needed.
+    """
+    first_cache, following_cache = linearization_caches
+    for table in store.table_names:
+        joined_only = store.is_shared(table) and cfg.shared_tables.joined_rows_only
+        if store.is_shared(table) and not joined_only:
+            continue
+        row_ids = set(store.column(store.table_key(table)).tolist()) - {None}
+        rows = store.single_rows(table, list(row_ids), joined_only)
+        for cache in [first_cache] if following_cache is first_cache else [first_cache, following_cache]:
+            cache.prefill(f"{table}/joined" if joined_only else table, rows)
+
+
+def linearize_pair(
+        store: InstanceStore,
+        instance_idx: int,
+        linearization_cache: LinearizationCache,
+        cfg: DictConfig
+) -> dict[str, str]:
+    """Linearize the source and target rows of the instance, for the instance itself or as an example."""
+    ground_truth = store.instance(instance_idx)
+    return {
+        "first_table_row": linearize_source_rows(store, ground_truth["invoice_id"], linearization_cache,
+                                                 cfg.shared_tables.joined_rows_only),
+        "second_table_row": linearize_target_row(store, ground_truth["payment_id"], linearization_cache),
+        "ground_truth": get_ground_truth_string(ground_truth["rows_match"])
+    }
+
+
+def prepare_request(
+        store: InstanceStore,
+        instance_idx: int,
+        example_instances: list[int],
+        prompt_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        example_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        cfg: DictConfig
+) -> dict:
+    """Prepare the request for the instance with the given examples, which come first in the prompt."""
+    first_cache, following_cache = linearization_caches
 
+    examples = []
+    for ex_idx in example_instances:
+        cache = first_cache if len(examples) == 0 else following_cache
+        examples.append(linearize_pair(store, ex_idx, cache, cfg))
+
+    cache = first_cache if len(examples) == 0 else following_cache
+    pair = linearize_pair(store, instance_idx, cache, cfg)
+    ground_truth = pair["ground_truth"]
+
+    if cfg.single_token_yes_no.enabled:
+        request = {
+            "model": cfg.model,
+            "max_tokens": 1,
+            "temperature": cfg.temperature,
+            "logit_bias": single_token_logit_bias(
+                [get_ground_truth_string(True), get_ground_truth_string(False)], cfg.model, cfg.api_name),
+            "logprobs": True,
+            "top_logprobs": cfg.single_token_yes_no.top_logprobs
+        }
+    else:
         request = {
             "model": cfg.model,
             "max_tokens": max_tokens_for_ground_truth(ground_truth, cfg.api_name, cfg.model,
@@ -114,18 +156,310 @@ def main(cfg: DictConfig) -> None:
             "temperature": cfg.temperature
         }
 
-        example_messages = []
-        for example in examples:
-            example_messages += fill_chat_template(OmegaConf.to_container(cfg.example_chat_template), **example)
-        request["messages"] = fill_chat_template(
-            OmegaConf.to_container(cfg.prompt_chat_template),
-            examples=example_messages,
-            first_table_row=linearized_source_row,
-            second_table_row=linearized_target_row,
-            ground_truth=ground_truth
+    example_messages = []
+    for example in examples:
+        example_messages += example_chat_template.fill(**example)
+    request["messages"] = prompt_chat_template.fill(
+        examples=example_messages,
+        first_table_row=pair["first_table_row"],
+        second_table_row=pair["second_table_row"],
+        ground_truth=ground_truth
+    )
+    return request
+
+
+def prepare_packed_request(
+        store: InstanceStore,
+        instances: list[int],
+        example_instances: list[int],
+        packed_prompt_chat_template: CompiledChatTemplate,
+        packed_example_chat_template: CompiledChatTemplate,
+        packed_pair_template: CompiledTemplate,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        cfg: DictConfig
+) -> dict:
+    """Prepare the request that classifies the pairs of all given instances at once.
+
+    The examples are packed into a single example with numbered pairs that comes first in the prompt.
+    """
+    first_cache, following_cache = linearization_caches
+
+    def linearize_pairs(pair_instances: list[int], is_first: bool) -> tuple[str, list[str]]:
+        lin_pairs, answers = [], []
+        for number, pair_idx in enumerate(pair_instances, start=1):
+            cache = first_cache if is_first and number == 1 else following_cache
+            pair = linearize_pair(store, pair_idx, cache, cfg)
+            lin_pairs.append(packed_pair_template.fill(
+                number=str(number),
+                first_table_row=pair["first_table_row"],
+                second_table_row=pair["second_table_row"]
+            ))
+            answers.append(pair["ground_truth"])
+        return "\n".join(lin_pairs), answers
+
+    example_messages = []
+    if len(example_instances) > 0:
+        example_pairs, example_answers = linearize_pairs(example_instances, True)
+        example_messages = packed_example_chat_template.fill(pairs=example_pairs, answers=pack_answers(example_answers))
+    pairs, answers = linearize_pairs(instances, len(example_instances) == 0)
+
+    ground_truth = pack_answers(answers)
+    request = {
+        "model": cfg.model,
+        "max_tokens": max_tokens_for_ground_truth(ground_truth, cfg.api_name, cfg.model,
+                                                  cfg.max_tokens_over_ground_truth),
+        "temperature": cfg.temperature,
+        "response_format": {"type": "json_object"}
+    }
+    request["messages"] = packed_prompt_chat_template.fill(examples=example_messages, pairs=pairs)
+    return request
+
+
+class _Without(Sequence):
+    """View of a sorted list of instance indices without the ones at the given sorted positions."""
+
+    def __init__(self, values: list[int], positions: list[int]):
+        self._values = values
+        self._positions = positions
+
+    def __len__(self) -> int:
+        return len(self._values) - len(self._positions)
+
+    def __getitem__(self, ix: int) -> int:
+        if not 0 <= ix < len(self):
+            raise IndexError(ix)
+        for position in self._positions:
+            if ix < position:
+                break
+            ix += 1
+        return self._values[ix]
+
+
+def _without(values: list[int], excluded: list[int]) -> Sequence[int]:
+    positions = []
+    for value in sorted(set(excluded)):
+        position = bisect.bisect_left(values, value)
+        if position < len(values) and values[position] == value:
+            positions.append(position)
+    return _Without(values, positions) if len(positions) > 0 else values
+
+
+def sample_example_instances(
+        excluded_instances: list[int],
+        positive_instances: list[int],
+        negative_instances: list[int],
+        example_random: random.Random,
+        k: int
+) -> list[int]:
+    """Sample k positive and k negative example instances other than the excluded ones, in random order.
+
+    The excluded instances are the instance itself or, for a packed request, all instances of the pack. The positive
+    and negative instances must be sorted. The excluded instances are left out with a view instead of a copy of the
+    lists, which draws the same examples as a copy without them.
+    """
+    chosen_pos_indices = example_random.sample(_without(positive_instances, excluded_instances), k=k)
+    chosen_neg_indices = example_random.sample(_without(negative_instances, excluded_instances), k=k)
+
+    example_instances = chosen_neg_indices + chosen_pos_indices
+    example_random.shuffle(example_instances)
+    return example_instances
+
+
+def prepare_instance_requests(
+        store: InstanceStore,
+        names: Iterable[str],
+        rule_decisions: dict,
+        prompt_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        example_chat_template: CompiledChatTemplate | CompactChatTemplate,
+        linearization_caches: tuple[LinearizationCache, LinearizationCache],
+        requests_dir: pathlib.Path,
+        cfg: DictConfig,
+        example_random: random.Random | None = None,
+        compact_requests: CompactRequests | None = None
+) -> list[int]:
+    """Prepare and save the requests of the named instances that the pre-matching rules have not decided.
+
+    The examples are drawn from example_random in the order of the names or, if it is None, from an RNG derived from
+    sample_examples.seed and the instance index, so that they do not depend on the order or the other instances. With
+    compact requests, whose templates the given chat templates must be, the requests are added to them instead of
+    being saved as JSON files.
+
+    Returns:
+        The instance indices of the prepared requests, for packing.
+    """
+    rows_match = store.column("rows_match")
+    positive_instances, negative_instances = np.flatnonzero(rows_match).tolist(), np.flatnonzero(~rows_match).tolist()
+
+    prepared_instances = []
+    for name in names:
+        instance_idx = int(name)
+
+        example_instances = []
+        if cfg.sample_examples.num_examples > 0:
+            rng = example_random
+            if rng is None:
+                rng = random.Random(f"{cfg.sample_examples.seed}/{instance_idx}")
+            example_instances = sample_example_instances([instance_idx], positive_instances, negative_instances, rng,
+                                                         cfg.sample_examples.num_examples)
+
+        if name in rule_decisions.keys():
+            continue  # after sampling the examples so that the other instances keep theirs
+
+        request = prepare_request(
+            store,
+            instance_idx,
+            example_instances,
+            prompt_chat_template,
+            example_chat_template,
+            linearization_caches,
+            cfg
         )
+        if compact_requests is not None:
+            compact_requests.add(f"{name}.json", request)
+        else:
+            dump_json(request, requests_dir / f"{name}.json")
+        prepared_instances.append(instance_idx)
+    return prepared_instances
+
+
+def _prepare_chunk(
+        names: list[str],
+        rule_decisions: dict,
+        instances_dir: pathlib.Path,
+        requests_dir: pathlib.Path,
+        cfg: DictConfig
+) -> tuple[list[int], tuple[LinearizationCache, LinearizationCache]]:
+    # runs in a worker process, which loads the instance store and creates its own linearization caches that stay warm
+    # for all instances of its chunk
+    store = InstanceStore.load(instances_dir)
+    linearization_caches = create_linearization_caches(cfg, instances_dir)
+    prefill_linearization_caches(store, linearization_caches, cfg)
+    prepared_instances = prepare_instance_requests(
+        store,
+        names,
+        rule_decisions,
+        compile_chat_template(OmegaConf.to_container(cfg.prompt_chat_template)),
+        compile_chat_template(OmegaConf.to_container(cfg.example_chat_template)),
+        linearization_caches,
+        requests_dir,
+        cfg
+    )
+    return prepared_instances, linearization_caches
+
+
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    stage = open_stage("prepare_requests", get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name), {
+        "instances": instances_dir,
+        "rule_decisions": instances_dir / "rule_decisions.json" if cfg.prematch.enabled else None
+    }, OmegaConf.to_container(cfg, resolve=True))
+    if stage is not None and stage.restore():
+        return
+    requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+
+    compact_requests = None
+    if cfg.compact_requests:
+        compact_requests = CompactRequests()
+        prompt_chat_template = compact_requests.template("prompt", OmegaConf.to_container(cfg.prompt_chat_template))
+        example_chat_template = compact_requests.template("example",
+                                                          OmegaConf.to_container(cfg.example_chat_template))
+    else:
+        prompt_chat_template = compile_chat_template(OmegaConf.to_container(cfg.prompt_chat_template))
+        example_chat_template = compile_chat_template(OmegaConf.to_container(cfg.example_chat_template))
+    linearization_caches = create_linearization_caches(cfg, instances_dir)
+    first_cache, following_cache = linearization_caches
+
+    rule_decisions = {}  # instances decided by the pre-matching rules need no request
+    if cfg.prematch.enabled:
+        if not (instances_dir / "rule_decisions.json").is_file():
+            raise AssertionError(f"Missing rule decisions, run {cfg.dataset.dataset_name}/prematch.py first!")
+        rule_decisions = load_json(instances_dir / "rule_decisions.json")
+
+    store = InstanceStore.load(instances_dir)
+    desc = f"{cfg.task_name} - {cfg.dataset.dataset_name} - {cfg.exp_name} - prepare requests"
+    if cfg.parallel_preparation.num_workers > 0:
+        if not cfg.sample_examples.per_instance_seed:
+            raise AssertionError("Parallel request preparation requires `sample_examples.per_instance_seed`!")
+        if cfg.compact_requests:
+            raise AssertionError("Compact requests are prepared in the main process, set `compact_requests=false`!")
+        # one chunk of consecutive instances per worker
+        names = store.names()
+        chunk_size = -(-len(names) // cfg.parallel_preparation.num_workers)
+        chunks = [names[ix:ix + chunk_size] for ix in range(0, len(names), chunk_size)]
+        results = [None] * len(chunks)
+        with ProcessPoolExecutor(max_workers=cfg.parallel_preparation.num_workers) as executor:
+            futures = {executor.submit(_prepare_chunk, chunk, rule_decisions, instances_dir, requests_dir, cfg): ix
+                       for ix, chunk in enumerate(chunks)}
+            for future in tqdm.tqdm(as_completed(futures), desc, total=len(futures)):
+                results[futures[future]] = future.result()
+
+        # the prepared instances in the order of the names, like in a serial run
+        prepared_instances = []
+        for chunk_prepared_instances, (chunk_first_cache, chunk_following_cache) in results:
+            prepared_instances += chunk_prepared_instances
+            first_cache.merge(chunk_first_cache)
+            if following_cache is not first_cache:
+                following_cache.merge(chunk_following_cache)
+    else:
+        prefill_linearization_caches(store, linearization_caches, cfg)
+        prepared_instances = prepare_instance_requests(
+            store,
+            tqdm.tqdm(store.names(), desc),
+            rule_decisions,
+            prompt_chat_template,
+            example_chat_template,
+            linearization_caches,
+            requests_dir,
+            cfg,
+            example_random=None if cfg.sample_examples.per_instance_seed else sample_examples_random,
+            compact_requests=compact_requests
+        )
+        if compact_requests is not None:
+            compact_requests.dump(requests_dir / COMPACT_REQUESTS_FILE)
+
+    if cfg.packing.num_pairs > 1:
+        # the single-pair requests remain as fallback for packed requests whose answers do not line up
+        packed_prompt_chat_template = compile_chat_template(OmegaConf.to_container(cfg.packed_prompt_chat_template))
+        packed_example_chat_template = compile_chat_template(OmegaConf.to_container(cfg.packed_example_chat_template))
+        packed_pair_template = compile_template(cfg.packed_pair_template)
+
+        # pairs of the same match must not end up next to each other
+        packing_random.shuffle(prepared_instances)
+        rows_match = store.column("rows_match")
+        positive_instances = np.flatnonzero(rows_match).tolist()
+        negative_instances = np.flatnonzero(~rows_match).tolist()
+        packs = []
+        for ix in range(0, len(prepared_instances), cfg.packing.num_pairs):
+            pack = prepared_instances[ix:ix + cfg.packing.num_pairs]
+            example_instances = []
+            if cfg.sample_examples.num_examples > 0:
+                # none of the pack's instances may be an example, which would reveal its answer
+                example_instances = sample_example_instances(pack, positive_instances, negative_instances,
+                                                             packing_random, cfg.sample_examples.num_examples)
+            request = prepare_packed_request(
+                store,
+                pack,
+                example_instances,
+                packed_prompt_chat_template,
+                packed_example_chat_template,
+                packed_pair_template,
+                linearization_caches,
+                cfg
+            )
+            packs.append({"request": request, "instances": [f"{instance_idx}.json" for instance_idx in pack]})
+
+        packed_dir = requests_dir / "packed"
+        packed_dir.mkdir()
+        dump_json(packs, packed_dir / "packs.json")
+        logger.info(f"packed {len(prepared_instances)} instances into {len(packs)} requests")
+
+    for cache in [first_cache] if following_cache is first_cache else [first_cache, following_cache]:
+        cache.save()
+        logger.info(f"linearization cache: {cache.stats()}")
 
-        dump_json(request, requests_dir / f"{path.name}.json")
+    if stage is not None:
+        stage.save()
 
 
 if __name__ == "__main__":
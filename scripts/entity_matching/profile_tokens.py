@@ -0,0 +1,68 @@
+import functools
+import logging
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf
+
+from lib.data import get_requests_dir, get_task_dir
+from lib.model._openai import MODEL_PARAMETERS
+from lib.model.generic import num_input_tokens, num_tokens
+from lib.prompting.compact import load_requests
+from lib.prompting.profile import profile_prompt_tokens
+from lib.prompting.template import compile_chat_template
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(version_base=None, config_path="../../config/entity_matching", config_name="config.yaml")
+def main(cfg: DictConfig) -> None:
+    requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    prompt_chat_template = compile_chat_template(OmegaConf.to_container(cfg.prompt_chat_template))
+    is_multi_table = cfg.dataset.schema_mode == "multi-table"
+
+    profiles = []
+    num_unmatched = 0
+    for request in load_requests(requests_dir)[1]:
+        total = num_input_tokens(request, cfg.api_name)
+        profile = profile_prompt_tokens(
+            request["messages"],
+            prompt_chat_template,
+            functools.partial(num_tokens, model=request["model"], api_name=cfg.api_name),
+            total,
+            sub_table_variable="first_table_row" if is_multi_table else None,
+            sub_table_separator=cfg.profile_tokens.sub_table_separator
+        )
+        if profile is None:
+            num_unmatched += 1
+            continue
+        components, sub_tables = profile
+        profiles.append({**components, **sub_tables, "total": total})
+
+    if num_unmatched > 0:
+        logger.warning(f"{num_unmatched} requests do not match the prompt template and are not profiled!")
+    if len(profiles) == 0:
+        raise AssertionError(f"No requests to profile in {requests_dir}!")
+
+    profiles = pd.DataFrame(profiles).fillna(0)
+    sums = profiles.sum()
+    summary = pd.DataFrame({
+        "mean": profiles.mean(),
+        "p50": profiles.quantile(0.5),
+        "p90": profiles.quantile(0.9),
+        "max": profiles.max(),
+        "share": sums / sums["total"]
+    })
+    for model, params in MODEL_PARAMETERS.items():
+        summary[f"usd_{model}"] = sums / 1000 * params["cost_per_1k_input_tokens"]
+    summary.index.name = "component"
+
+    path = get_task_dir(cfg.task_name) / "token_profiles"
+    path.mkdir(exist_ok=True)
+    summary.to_csv(path / f"{cfg.dataset.dataset_name}_{cfg.exp_name}.csv")
+    logger.info(f"input tokens of {len(profiles)} requests by component (sub-tables as component[ix]):\n"
+                f"{summary.to_markdown(floatfmt='.3f')}")
+
+
+if __name__ == "__main__":
+    main()
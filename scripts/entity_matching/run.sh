@@ -11,6 +11,7 @@ for arg in "$@"; do
 done
 
 python scripts/entity_matching/"$dataset"/preprocess.py "$@"
+python scripts/entity_matching/"$dataset"/prematch.py "$@"
 python scripts/entity_matching/prepare_requests.py "$@"
 python scripts/execute_requests.py -cp "../config/entity_matching" "$@"
 python scripts/entity_matching/evaluate.py "$@"
@@ -1,40 +1,84 @@
 import collections
+import itertools
 import logging
 
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
-from lib.data import get_requests_dir, get_responses_dir, load_json, dump_json
-from lib.model.generic import execute_requests
+from lib.data import get_requests_dir, get_responses_dir, load_json, dump_json, dump_records
+from lib.model.generic import REQUEST_SEED, execute_requests, extract_text_from_response
+from lib.prompting.compact import load_requests
+from lib.prompting.packing import unpack_answers, unpacked_response
+from lib.stage_cache import open_stage
 
 logger = logging.getLogger(__name__)
 
-_openai_request_seed: int = 321164097
-
 
 @hydra.main(version_base=None, config_name="config.yaml")  # specify config path via command line flag -cp
 def main(cfg: DictConfig) -> None:
     requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    stage = open_stage("execute_requests", get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name),
+                       {"requests": requests_dir}, OmegaConf.to_container(cfg, resolve=True))
+    if stage is not None and stage.restore():
+        return
     responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
 
-    requests = []
-    request_names = []  # we need to remember these since sorting paths is not numerical
-    for request_path in list(sorted(requests_dir.glob("*.json"))):
-        requests.append(load_json(request_path))
-        request_names.append(request_path.name)
+    # we need to remember the names since sorting paths is not numerical
+    request_names, requests = load_requests(requests_dir)  # loaded or expanded on access
+
+    # packed requests classify multiple pairs at once (see prepare_requests.py)
+    unpacked_responses = {}
+    if (requests_dir / "packed" / "packs.json").is_file():
+        packs = load_json(requests_dir / "packed" / "packs.json")
+        for pack in packs:
+            pack["request"]["seed"] = REQUEST_SEED
+
+        packed_responses = execute_requests([pack["request"] for pack in packs], cfg.api_name)
 
-    for request in requests:
-        request["seed"] = _openai_request_seed
+        num_misaligned = 0
+        for pack, packed_response in zip(packs, packed_responses):
+            num_pairs = len(pack["instances"])
+            answers = unpack_answers(extract_text_from_response(packed_response), num_pairs)
+            if answers is None:
+                num_misaligned += 1
+                continue
+            for ix, (request_name, answer) in enumerate(zip(pack["instances"], answers)):
+                unpacked_responses[request_name] = unpacked_response(packed_response, answer, ix, num_pairs)
 
-    responses = execute_requests(requests, cfg.api_name)
+        if num_misaligned > 0:
+            logger.warning(f"{num_misaligned} of {len(packs)} packed requests failed or their answers do not line up "
+                           f"==> fall back to single-pair requests")
+
+    # execute the single-pair requests for instances without an unpacked response
+    single_names, single_requests = [], []
+    for ix, name in enumerate(request_names):
+        if name not in unpacked_responses.keys():
+            request = requests[ix]
+            request["seed"] = REQUEST_SEED
+            single_names.append(name)
+            single_requests.append(request)
+    single_responses = execute_requests(single_requests, cfg.api_name)
+
+    # the task config can store the responses in segments instead of one JSON file per response
+    segment_storage = cfg.get("segment_storage")
+    records_per_segment = None
+    if segment_storage is not None and segment_storage.enabled:
+        records_per_segment = segment_storage.records_per_segment
 
     num_failed = 0
     finish_reasons = collections.Counter()
-    for response in responses:
+    segment_responses = {}
+    for request_name, response in itertools.chain(unpacked_responses.items(), zip(single_names, single_responses)):
         if "choices" in response.keys():
             finish_reasons[response["choices"][0]["finish_reason"]] += 1
         else:
             num_failed += 1
+        if records_per_segment is None:
+            dump_json(response, responses_dir / request_name)
+        else:
+            segment_responses[request_name] = response
+    if records_per_segment is not None:
+        dump_records(segment_responses, responses_dir, records_per_segment)
 
     for key in finish_reasons.keys():
         if key != "stop":
@@ -43,8 +87,8 @@ def main(cfg: DictConfig) -> None:
     if num_failed > 0:
         logger.warning(f"{num_failed} requests failed!")
 
-    for response, request_name in zip(responses, request_names):
-        dump_json(response, responses_dir / request_name)
+    if stage is not None:
+        stage.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+import pathlib
+
+from lib.data import RecordStore, dump_records, sort_names
+
+
+def test_sort_names_orders_integer_stems_numerically() -> None:
+    assert sort_names(["10.json", "2.json", "1.json"]) == ["1.json", "2.json", "10.json"]
+    assert sort_names(["b.json", "10.json", "2.json"]) == ["10.json", "2.json", "b.json"]
+
+
+def test_record_store_reads_the_records_in_numerical_order(tmp_path: pathlib.Path) -> None:
+    records = {f"{ix}.json": {"ix": ix} for ix in [10, 2, 1, 20]}
+    for name, records_per_segment in [("files", None), ("segments", 3)]:
+        (tmp_path / name).mkdir()
+        dump_records(records, tmp_path / name, records_per_segment)
+
+        store = RecordStore.load(tmp_path / name)
+        assert store.names() == ["1.json", "2.json", "10.json", "20.json"]
+        assert [record["ix"] for _, record in store] == [1, 2, 10, 20]
+        assert store.get("10.json") == {"ix": 10} and "3.json" not in store
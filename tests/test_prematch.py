@@ -0,0 +1,93 @@
+import pathlib
+
+import pandas as pd
+from omegaconf import OmegaConf
+
+from lib.data import InstanceStore, StoreTable, dump_instance_store
+from scripts.entity_matching.pay_to_inv.prematch import apply_rules, candidate_flags, load_instance_frame, \
+    unique_proposal_flags
+
+_CONFIG_PATH = pathlib.Path(__file__).parent.parent / "config" / "entity_matching"
+
+
+def _config(schema_mode: str):
+    cfg = OmegaConf.load(_CONFIG_PATH / "config.yaml")
+    cfg.dataset = OmegaConf.load(_CONFIG_PATH / "dataset" / "pay_to_inv.yaml")
+    cfg.dataset.schema_mode = schema_mode
+    cfg.prematch.enabled = True
+    return cfg
+
+
+def _store(tmp_path: pathlib.Path, instances: list[dict]) -> InstanceStore:
+    invoices = pd.DataFrame({
+        "Billing Number": ["B1000001", "B1000002"],
+        "Assignment Number": ["A2000001", "A2000002"],
+        "Amount": ["100.00", "250.00"],
+        "Currency Code": ["USD", "USD"]
+    })
+    payments = pd.DataFrame({
+        "Memo Line": ["payment", "payment"],
+        "Amount": ["100.00", "999.99"],
+        "Currency": ["USD", "USD"]
+    })
+    tables = {
+        "invoices": StoreTable(invoices, "invoice_id", {1: [0], 2: [1]}),
+        "payments": StoreTable(payments, "payment_id", {1: [0], 2: [1]})
+    }
+    dump_instance_store(instances, tables, tmp_path)
+    return InstanceStore.load(tmp_path)
+
+
+def test_exact_amount_compares_the_invoice_and_the_payment_amount(tmp_path: pathlib.Path) -> None:
+    # in the descriptive schema, invoices and payments both have an "Amount" column
+    store = _store(tmp_path, [
+        {"invoice_id": 1, "payment_id": 1, "rows_match": True},  # same amount
+        {"invoice_id": 2, "payment_id": 1, "rows_match": False},  # 250.00 vs. 100.00
+        {"invoice_id": 1, "payment_id": 2, "rows_match": False}  # 100.00 vs. 999.99
+    ])
+    cfg = _config("descriptive")
+
+    frame = load_instance_frame(store, cfg)
+    assert frame["inv_amount"].tolist() == ["100.00", "250.00", "100.00"]
+    assert frame["pay_amount"].tolist() == ["100.00", "100.00", "999.99"]
+
+    decisions = apply_rules(frame, cfg)
+    assert decisions.at["0", "rule"] == "exact_amount"
+    assert decisions.at["1", "rule"] != "exact_amount"
+    assert decisions.at["2", "rule"] != "exact_amount"
+
+
+def test_not_blocked_decides_the_pairs_that_are_not_candidates(tmp_path: pathlib.Path) -> None:
+    store = _store(tmp_path, [
+        {"invoice_id": 1, "payment_id": 1, "rows_match": True},
+        {"invoice_id": 2, "payment_id": 1, "rows_match": False},
+        {"invoice_id": 2, "payment_id": 2, "rows_match": False}
+    ])
+    cfg = _config("descriptive")
+    cfg.prematch.rules = ["not_blocked"]
+    candidates = pd.DataFrame({"invoice_id": [1, 2, 1], "payment_id": [1, 1, 2]})
+
+    frame = load_instance_frame(store, cfg)
+    frame["is_candidate"] = candidate_flags(store, candidates).reindex(frame.index)
+    decisions = apply_rules(frame, cfg)
+    assert decisions["rule"].tolist() == [None, None, "not_blocked"]
+    assert decisions.at["2", "prediction"] is False
+
+
+def test_subset_sum_accepts_only_the_invoices_of_a_unique_complete_proposal(tmp_path: pathlib.Path) -> None:
+    store = _store(tmp_path, [
+        {"invoice_id": 1, "payment_id": 1, "rows_match": True},
+        {"invoice_id": 2, "payment_id": 1, "rows_match": True},
+        {"invoice_id": 1, "payment_id": 2, "rows_match": False}
+    ])
+    proposals = {
+        1: {"proposals": [[1, 2]], "exhausted": False, "complete": True},
+        2: {"proposals": [[1, 2]], "exhausted": False, "complete": False}  # stopped early, other sets may be missing
+    }
+    cfg = _config("descriptive")
+    cfg.prematch.rules = ["subset_sum"]
+
+    frame = load_instance_frame(store, cfg)
+    frame["in_unique_proposal"] = unique_proposal_flags(store, proposals).reindex(frame.index)
+    decisions = apply_rules(frame, cfg)
+    assert decisions["rule"].tolist() == ["subset_sum", "subset_sum", None]
@@ -0,0 +1,17 @@
+import numpy as np
+
+from lib.subset_sum import find_subsets
+
+
+def test_a_search_that_stops_early_is_not_complete() -> None:
+    amounts = np.asarray([300, 200, 100, 100])
+    result = find_subsets(amounts, 400, 400, min_size=2, max_subsets=10)
+    assert sorted(result.subsets) == [(0, 2), (0, 3), (1, 2, 3)]
+    assert result.complete and not result.exhausted
+
+    result = find_subsets(amounts, 400, 400, min_size=2, max_subsets=1)
+    assert len(result.subsets) == 1
+    assert not result.complete and not result.exhausted
+
+    result = find_subsets(amounts, 400, 400, min_size=2, max_nodes=2)
+    assert not result.complete and result.exhausted